@@ -13,4 +13,5 @@
 # ==============================================================================
 from .folder import FolderDataset
 from .mvtec import MVTecDataset
+from .synthetic import create_synthetic_mvtec
 from .utils import *
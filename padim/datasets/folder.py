@@ -21,8 +21,13 @@ from typing import Any
 
 import albumentations as A
 import cv2
+import numpy as np
 import torch.utils.data
 
+from padim.utils.profiler import get_profiler
+from .utils.cache import ImageCache, split_geometric_transforms
+from .utils.decode import get_resize_size, read_image
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,20 +38,24 @@ class FolderDataset(torch.utils.data.Dataset):
         root (str | Path): root directory of dataset where directory ``mvtec_anomaly_detection`` exists.
         image_transform (A.Compose, optional): image transform. Defaults to None.
         mask_size (tuple[int, int], optional): mask size after resizing. Defaults to (224, 224).
+        train (bool): if True, load the ``good`` images only, else load all images.
+        cache_dir (str | Path, optional): cache the resized and cropped images in this directory. Defaults to None.
+        reduced_decode (bool, optional): decode the images at 1/2, 1/4 or 1/8 resolution when that is still at least the
+            resize size. The interpolation differs slightly from resizing the full resolution image. Defaults to False.
 
     Examples:
         >>> from padim.datasets import FolderDataset
         >>> from omegaconf import OmegaConf
-        >>> from padim.utils import get_data_transform
+        >>> from padim.utils import create_image_and_mask_transforms
         >>> config = OmegaConf.load("configs/folder.yaml")
         >>> config = OmegaConf.create(config)
-        >>> image_transforms = A.Compose(get_data_transform(config.DATASETS.TRANSFORMS))
+        >>> image_transforms, _ = create_image_and_mask_transforms(config.DATASETS.TRANSFORMS)
         >>> mask_size = (224, 224)
         >>> dataset = FolderDataset("data/folder/train", image_transforms, mask_size, True)
         >>> sample = dataset[0]
         >>> image, target, mask, image_path = sample["image"], sample["target"], sample["mask"], sample["image_path"]
-        >>> print(image.shape, target, mask.shape, image_path)
-        torch.Size([3, 224, 224]) 0 torch.Size([1, 224, 224]) ./data/folder/train/good/000.png
+        >>> print(image.shape, image.dtype, target, mask.shape, image_path)
+        torch.Size([3, 224, 224]) torch.uint8 0 torch.Size([1, 224, 224]) ./data/folder/train/good/000.png
     """
 
     def __init__(
@@ -55,12 +64,15 @@ class FolderDataset(torch.utils.data.Dataset):
             image_transform: A.Compose = None,
             mask_size: tuple[int, int] = (224, 224),
             train: bool = True,
+            cache_dir: str | Path | None = None,
+            reduced_decode: bool = False,
     ) -> None:
         super().__init__()
         if isinstance(root, str):
             root = Path(root)
         self.image_transforms = image_transform
         self.mask_size = mask_size
+        self.decode_size = get_resize_size(image_transform) if reduced_decode else None
 
         # load dataset
         if train:
@@ -69,16 +81,30 @@ class FolderDataset(torch.utils.data.Dataset):
             pattern = "*/*"
         self.image_path_list = list(root.glob(pattern))
 
+        # the cache applies the resize and crop, only the remaining transforms run per access
+        self.cache = None
+        if cache_dir is not None:
+            geometric_transforms, self.image_transforms = split_geometric_transforms(image_transform)
+            self.cache = ImageCache(cache_dir, self.image_path_list, [None] * len(self.image_path_list), geometric_transforms,
+                                    {"reduced_decode": reduced_decode})
+
+    def read_image(self, image_path: str) -> np.ndarray:
+        return read_image(image_path, cv2.IMREAD_COLOR, self.decode_size)
+
     def __getitem__(self, index: int) -> dict[str, str | None | Any]:
         image_path = str(self.image_path_list[index])
 
-        image = cv2.imread(image_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = image.astype("float32") / 255.0
-        image = self.image_transforms(image=image)["image"]
+        profiler = get_profiler()
+        with profiler.span("dataset.decode"):
+            if self.cache is None:
+                image = self.read_image(image_path)
+            else:
+                image = self.cache.load_image(index, lambda: self.read_image(image_path))
+        with profiler.span("dataset.transform"):
+            image = self.image_transforms(image=image)["image"]
 
         target_type = 0
-        mask = torch.zeros([1, self.mask_size[0], self.mask_size[1]])
+        mask = torch.zeros([1, *image.shape[-2:]], dtype=torch.uint8)
 
         return {"image": image,
                 "target": target_type,
@@ -21,11 +21,15 @@ from typing import Any
 
 import albumentations as A
 import cv2
+import numpy as np
 import torch
 import torch.utils.data
 from torch import Tensor
 
 from padim.utils.download import DownloadInfo, download_and_extract_archive
+from padim.utils.profiler import get_profiler
+from .utils.cache import ImageCache, split_geometric_transforms
+from .utils.decode import get_resize_size, read_image
 
 logger = logging.getLogger(__name__)
 
@@ -40,21 +44,23 @@ class MVTecDataset(torch.utils.data.Dataset):
         mask_transform (A.Compose, optional): mask transform. Defaults to None.
         mask_size (tuple[int, int], optional): mask size after resizing. Defaults to (224, 224).
         train (bool): if True, load train dataset, else load test dataset.
+        cache_dir (str | Path, optional): cache the resized and cropped images and masks in this directory. Defaults to None.
+        reduced_decode (bool, optional): decode the images at 1/2, 1/4 or 1/8 resolution when that is still at least the
+            resize size. The interpolation differs slightly from resizing the full resolution image. Defaults to False.
 
     Examples:
         >>> from padim.datasets import MVTecDataset
         >>> from omegaconf import OmegaConf
-        >>> from padim.utils import get_data_transform
+        >>> from padim.utils import create_image_and_mask_transforms
         >>> config = OmegaConf.load("configs/mvtec.yaml")
         >>> config = OmegaConf.create(config)
-        >>> image_transforms = A.Compose(get_data_transform(config.DATASETS.TRANSFORMS))
-        >>> mask_transforms = A.Compose(get_data_transform(config.DATASETS.TRANSFORMS))
+        >>> image_transforms, mask_transforms = create_image_and_mask_transforms(config.DATASETS.TRANSFORMS)
         >>> mask_size = (config.DATASETS.TRANSFORMS.CENTER_CROP.HEIGHT, config.DATASETS.TRANSFORMS.CENTER_CROP.WIDTH)
         >>> dataset = MVTecDataset("data/mvtec_anomaly_detection", "bottle", image_transforms, mask_transforms, mask_size, False)
         >>> sample = dataset[0]
         >>> image, target, mask, image_path = sample["image"], sample["target"], sample["mask"], sample["image_path"]
-        >>> print(image.shape, target, mask.shape, image_path)
-        torch.Size([3, 224, 224]) 0 torch.Size([1, 224, 224]) ./data/mvtec_anomaly_detection/bottle/test/broken/good_000.png
+        >>> print(image.shape, image.dtype, target, mask.shape, image_path)
+        torch.Size([3, 224, 224]) torch.uint8 0 torch.Size([1, 224, 224]) ./data/mvtec_anomaly_detection/bottle/test/broken/good_000.png
         >>> len(dataset)
         126
     """
@@ -79,6 +85,8 @@ class MVTecDataset(torch.utils.data.Dataset):
             mask_transform: A.Compose = None,
             mask_size: tuple[int, int] = (224, 224),
             train: bool = True,
+            cache_dir: str | Path | None = None,
+            reduced_decode: bool = False,
     ) -> None:
         super().__init__()
         self.root = Path(root)
@@ -87,26 +95,51 @@ class MVTecDataset(torch.utils.data.Dataset):
         self.mask_transforms = mask_transform
         self.mask_size = mask_size
         self.train = train
+        self.decode_size = get_resize_size(image_transform) if reduced_decode else None
 
         # load dataset
         self.image_path_list, self.target_type_list, self.mask_path_list = self.load()
 
+        # the cache applies the resize and crop, only the remaining transforms run per access
+        self.cache = None
+        if cache_dir is not None:
+            geometric_transforms, self.image_transforms = split_geometric_transforms(image_transform)
+            _, self.mask_transforms = split_geometric_transforms(mask_transform)
+            self.cache = ImageCache(cache_dir, self.image_path_list, self.mask_path_list, geometric_transforms,
+                                    {"reduced_decode": reduced_decode})
+
+    def read_image(self, image_path: str) -> np.ndarray:
+        return read_image(image_path, cv2.IMREAD_UNCHANGED, self.decode_size)
+
+    @staticmethod
+    def read_mask(mask_path: str) -> np.ndarray:
+        # masks are always decoded at full resolution so that they stay binary
+        return cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+
     def __getitem__(self, index: int) -> dict[str, str | int | Tensor | Any]:
         image_path = self.image_path_list[index]
         target_type = self.target_type_list[index]
         mask_path = self.mask_path_list[index]
 
-        image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = image.astype("float32") / 255.0
-        image = self.image_transforms(image=image)["image"]
+        profiler = get_profiler()
+        with profiler.span("dataset.decode"):
+            if self.cache is None:
+                image = self.read_image(image_path)
+            else:
+                image = self.cache.load_image(index, lambda: self.read_image(image_path))
+        with profiler.span("dataset.transform"):
+            image = self.image_transforms(image=image)["image"]
 
         if target_type == 0:
-            mask = torch.zeros([1, self.mask_size[0], self.mask_size[1]])
+            mask = torch.zeros([1, *image.shape[-2:]], dtype=torch.uint8)
         else:
-            mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
-            mask = mask.astype("float32") / 255.0
-            mask = self.mask_transforms(image=mask)["image"]
+            with profiler.span("dataset.decode_mask"):
+                if self.cache is None:
+                    mask = self.read_mask(mask_path)
+                else:
+                    mask = self.cache.load_mask(index, lambda: self.read_mask(mask_path))
+            with profiler.span("dataset.transform_mask"):
+                mask = self.mask_transforms(image=mask)["image"]
 
         return {"image": image,
                 "target": target_type,
@@ -0,0 +1,107 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Synthetic datasets laid out like MVTec AD, for benchmarks and smoke tests without downloading data.
+"""
+import logging
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+__all__ = [
+    "create_synthetic_mvtec",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _create_normal_image(rng: np.random.Generator, image_size: tuple[int, int]) -> np.ndarray:
+    height, width = image_size
+    # smooth random texture: upsampled low resolution noise, plus fine grain
+    texture = rng.integers(60, 200, (max(height // 32, 2), max(width // 32, 2), 3), dtype=np.uint8)
+    image = cv2.resize(texture, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    image += rng.integers(-12, 13, (height, width, 3), dtype=np.int16)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _add_defect(rng: np.random.Generator, image: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    height, width = image.shape[:2]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    center = (int(rng.integers(width // 8, width - width // 8)), int(rng.integers(height // 8, height - height // 8)))
+    if rng.random() < 0.5:
+        axes = (int(rng.integers(width // 32 + 1, width // 8 + 2)), int(rng.integers(height // 32 + 1, height // 8 + 2)))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 255, -1)
+    else:
+        end = (int(np.clip(center[0] + rng.integers(-width // 4, width // 4), 0, width - 1)),
+               int(np.clip(center[1] + rng.integers(-height // 4, height // 4), 0, height - 1)))
+        cv2.line(mask, center, end, 255, max(min(height, width) // 64, 2))
+
+    image = image.copy()
+    image[mask > 0] = rng.integers(0, 256, 3, dtype=np.uint8)
+    return image, mask
+
+
+def create_synthetic_mvtec(
+        root: str | Path,
+        category: str = "synthetic",
+        image_size: tuple[int, int] = (256, 256),
+        num_train: int = 64,
+        num_test_good: int = 16,
+        num_test_defect: int = 16,
+        seed: int = 0,
+) -> Path:
+    r"""Write a synthetic dataset with the directory layout of MVTec AD.
+
+    Normal images are smooth random textures, defective images add an ellipse or a scratch of a random color, with the
+    matching ground truth mask. The same arguments always give the same images.
+
+    Args:
+        root (str | Path): dataset root, the images are written to ``root/category``.
+        category (str, optional): category name. Defaults to "synthetic".
+        image_size (tuple[int, int], optional): image height and width. Defaults to (256, 256).
+        num_train (int, optional): number of normal training images. Defaults to 64.
+        num_test_good (int, optional): number of normal test images. Defaults to 16.
+        num_test_defect (int, optional): number of defective test images. Defaults to 16.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        Path: the category directory.
+
+    Examples:
+        >>> from padim.datasets import MVTecDataset, create_synthetic_mvtec
+        >>> create_synthetic_mvtec("/tmp/synthetic_mvtec", "synthetic", (256, 256))
+        >>> dataset = MVTecDataset("/tmp/synthetic_mvtec", "synthetic", image_transforms, mask_transforms, (224, 224), True)
+    """
+    rng = np.random.default_rng(seed)
+    category_dir = Path(root) / category
+    train_dir = category_dir / "train" / "good"
+    test_good_dir = category_dir / "test" / "good"
+    test_defect_dir = category_dir / "test" / "defect"
+    ground_truth_dir = category_dir / "ground_truth" / "defect"
+    for directory in [train_dir, test_good_dir, test_defect_dir, ground_truth_dir]:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    for i in range(num_train):
+        cv2.imwrite(str(train_dir / f"{i:03d}.png"), _create_normal_image(rng, image_size))
+    for i in range(num_test_good):
+        cv2.imwrite(str(test_good_dir / f"{i:03d}.png"), _create_normal_image(rng, image_size))
+    for i in range(num_test_defect):
+        image, mask = _add_defect(rng, _create_normal_image(rng, image_size))
+        cv2.imwrite(str(test_defect_dir / f"{i:03d}.png"), image)
+        cv2.imwrite(str(ground_truth_dir / f"{i:03d}_mask.png"), mask)
+
+    logger.info(f"Created a synthetic MVTec dataset with {num_train} train and {num_test_good + num_test_defect} test images "
+                f"in '{category_dir}'")
+    return category_dir
@@ -11,8 +11,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
-from .prefetcher import CPUPrefetcher, CUDAPrefetcher, PrefetchDataLoader, PrefetchGenerator
+from .cache import ImageCache, split_geometric_transforms
+from .decode import get_reduction_factor, get_resize_size, read_image
+from .loader import create_dataloader, measure_loader_throughput
+from .prefetcher import BatchTransformLoader, CPUPrefetcher, CUDAPrefetcher, PrefetchDataLoader, PrefetchGenerator, move_batch, pin_batch
 
 __all__ = [
-    "PrefetchGenerator", "PrefetchDataLoader", "CPUPrefetcher", "CUDAPrefetcher"
+    "ImageCache", "split_geometric_transforms", "get_reduction_factor", "get_resize_size", "read_image", "create_dataloader", "measure_loader_throughput", "PrefetchGenerator", "PrefetchDataLoader", "CPUPrefetcher", "CUDAPrefetcher", "BatchTransformLoader", "pin_batch", "move_batch",
 ]
@@ -0,0 +1,170 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Persistent cache of decoded, resized and cropped images
+"""
+import hashlib
+import json
+import logging
+import os
+from collections.abc import Callable
+from pathlib import Path
+
+import albumentations as A
+import numpy as np
+
+__all__ = [
+    "ImageCache", "split_geometric_transforms",
+]
+
+logger = logging.getLogger(__name__)
+
+GEOMETRIC_TRANSFORMS = (A.Resize, A.CenterCrop)
+
+
+def split_geometric_transforms(transforms: A.Compose) -> tuple[A.Compose, A.Compose]:
+    """Split a transform into its leading resize/crop transforms and the transforms that follow them.
+
+    Args:
+        transforms (A.Compose): The whole transform.
+
+    Returns:
+        tuple[A.Compose, A.Compose]: The geometric transforms and the remaining ones.
+    """
+    transforms_list = list(transforms.transforms)
+    num_geometric = 0
+    while num_geometric < len(transforms_list) and isinstance(transforms_list[num_geometric], GEOMETRIC_TRANSFORMS):
+        num_geometric += 1
+
+    return A.Compose(transforms_list[:num_geometric]), A.Compose(transforms_list[num_geometric:])
+
+
+class ImageCache(object):
+    r"""Persistent cache of the uint8 images and masks of a dataset after resizing and cropping.
+
+    The images are stored in one memory-mapped ``.npy`` array per dataset, next to a ``.npy`` array of flags telling
+    which entries are filled. The file names are a hash of the path, mtime and size of every image and mask and of the
+    geometric transforms, so a changed file or transform config creates a new cache. Entries are filled on first access,
+    from any DataLoader worker, after which an access only reads contiguous bytes.
+
+    Args:
+        cache_dir (str | Path): Directory of the cache files.
+        image_path_list (list[str]): Image paths of the dataset.
+        mask_path_list (list[str | None]): Mask paths of the dataset, None where there is no mask.
+        geometric_transforms (A.Compose): Resize and crop transforms applied before caching.
+        decode_config (dict, optional): Any other setting the cached images depend on, e.g. how they are decoded.
+            Defaults to None.
+    """
+
+    def __init__(
+            self,
+            cache_dir: str | Path,
+            image_path_list: list[str],
+            mask_path_list: list[str | None],
+            geometric_transforms: A.Compose,
+            decode_config: dict | None = None,
+    ) -> None:
+        self.geometric_transforms = geometric_transforms
+        self.height, self.width = self.get_output_size(geometric_transforms)
+
+        key = self.get_key(image_path_list, mask_path_list, geometric_transforms, decode_config)
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(exist_ok=True, parents=True)
+        self.images_path = cache_dir / f"{key}.images.npy"
+        self.masks_path = cache_dir / f"{key}.masks.npy"
+        self.filled_path = cache_dir / f"{key}.filled.npy"
+
+        num_images = len(image_path_list)
+        if not self.filled_path.exists():
+            logger.info(f"Create image cache '{self.images_path}'.")
+            np.lib.format.open_memmap(self.images_path, "w+", np.uint8, (num_images, self.height, self.width, 3))
+            np.lib.format.open_memmap(self.masks_path, "w+", np.uint8, (num_images, self.height, self.width))
+            # the flags are created last, their presence means the cache files are complete
+            np.lib.format.open_memmap(str(self.filled_path) + ".tmp.npy", "w+", np.uint8, (num_images, 2))
+            os.replace(str(self.filled_path) + ".tmp.npy", self.filled_path)
+
+        # opened lazily in every DataLoader worker
+        self._images = self._masks = self._filled = None
+
+    @staticmethod
+    def get_output_size(geometric_transforms: A.Compose) -> tuple[int, int]:
+        height = width = None
+        for transform in geometric_transforms.transforms:
+            height, width = transform.height, transform.width
+
+        if height is None:
+            raise ValueError("Only images with a fixed size after resizing or cropping can be cached")
+
+        return height, width
+
+    @staticmethod
+    def get_key(
+            image_path_list: list[str],
+            mask_path_list: list[str | None],
+            geometric_transforms: A.Compose,
+            decode_config: dict | None = None,
+    ) -> str:
+        files = []
+        for path in list(image_path_list) + [path for path in mask_path_list if path is not None]:
+            stat = os.stat(path)
+            files.append([os.path.abspath(path), stat.st_mtime_ns, stat.st_size])
+        transforms = [repr(transform) for transform in geometric_transforms.transforms]
+        key = {"files": files, "transforms": transforms, "decode": decode_config or {}}
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def open(self) -> None:
+        self._images = np.load(self.images_path, mmap_mode="r+")
+        self._masks = np.load(self.masks_path, mmap_mode="r+")
+        self._filled = np.load(self.filled_path, mmap_mode="r+")
+
+    def load_image(self, index: int, read_image: Callable[[], np.ndarray]) -> np.ndarray:
+        """Get a cached (H, W, 3) uint8 image, reading, resizing and caching it on a miss.
+
+        Args:
+            index (int): Index of the image in the dataset.
+            read_image (Callable[[], np.ndarray]): Reads the full resolution RGB uint8 image.
+
+        Returns:
+            np.ndarray: The resized and cropped image.
+        """
+        return self._load(index, 0, read_image)
+
+    def load_mask(self, index: int, read_mask: Callable[[], np.ndarray]) -> np.ndarray:
+        """Get a cached (H, W) uint8 mask, reading, resizing and caching it on a miss.
+
+        Args:
+            index (int): Index of the image in the dataset.
+            read_mask (Callable[[], np.ndarray]): Reads the full resolution uint8 mask.
+
+        Returns:
+            np.ndarray: The resized and cropped mask.
+        """
+        return self._load(index, 1, read_mask)
+
+    def _load(self, index: int, kind: int, read: Callable[[], np.ndarray]) -> np.ndarray:
+        if self._filled is None:
+            self.open()
+        array = self._images if kind == 0 else self._masks
+
+        if not self._filled[index, kind]:
+            array[index] = self.geometric_transforms(image=read())["image"]
+            self._filled[index, kind] = 1
+
+        return np.array(array[index])
+
+    def __getstate__(self) -> dict:
+        # never pickle the mapped arrays into the DataLoader workers
+        state = self.__dict__.copy()
+        state["_images"] = state["_masks"] = state["_filled"] = None
+        return state
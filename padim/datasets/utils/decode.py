@@ -0,0 +1,78 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Decode images to uint8, at a reduced resolution when it is large enough
+"""
+import albumentations as A
+import cv2
+import numpy as np
+from PIL import Image
+
+__all__ = [
+    "get_resize_size", "get_reduction_factor", "read_image",
+]
+
+REDUCED_COLOR_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def get_resize_size(transforms: A.Compose) -> tuple[int, int] | None:
+    """Size of the first resize or crop of a transform, i.e. the smallest size an image can be decoded at."""
+    for transform in transforms.transforms:
+        if isinstance(transform, (A.Resize, A.CenterCrop)):
+            return transform.height, transform.width
+    return None
+
+
+def get_reduction_factor(image_path: str, target_size: tuple[int, int]) -> int:
+    """Largest factor of 2, 4 or 8 the image can be reduced by at decode time while staying at least ``target_size``.
+
+    Only the image header is read.
+    """
+    with Image.open(image_path) as image:
+        width, height = image.size
+
+    factor = 1
+    while factor < 8 and height // (factor * 2) >= target_size[0] and width // (factor * 2) >= target_size[1]:
+        factor *= 2
+    return factor
+
+
+def read_image(image_path: str, flags: int = cv2.IMREAD_COLOR, target_size: tuple[int, int] | None = None) -> np.ndarray:
+    r"""Decode an image to an RGB uint8 array.
+
+    Args:
+        image_path (str): Image path.
+        flags (int, optional): ``cv2.imread`` flags used at full resolution. Defaults to ``cv2.IMREAD_COLOR``.
+        target_size (tuple[int, int], optional): Size the image is resized to next. When given, the image is decoded at
+            1/2, 1/4 or 1/8 of its resolution if that is still at least ``target_size``, which for JPEG skips most of the
+            decoding work. Defaults to None (full resolution).
+
+    Returns:
+        np.ndarray: The (H, W, 3) RGB image.
+    """
+    if target_size is not None:
+        factor = get_reduction_factor(image_path, target_size)
+        if factor > 1:
+            flags = REDUCED_COLOR_FLAGS[factor]
+
+    image = cv2.imread(image_path, flags)
+    if image is None:
+        raise FileNotFoundError(f"Failed to read image '{image_path}'")
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,102 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import time
+from typing import Any
+
+import torch
+import torch.utils.data
+from omegaconf import DictConfig
+
+from .prefetcher import BatchTransformLoader, CPUPrefetcher, CUDAPrefetcher
+
+__all__ = [
+    "create_dataloader", "measure_loader_throughput",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def create_dataloader(
+        datasets: torch.utils.data.Dataset,
+        batch_size: int | None,
+        device: torch.device,
+        dataloader_dict: DictConfig | dict | None = None,
+) -> CPUPrefetcher | CUDAPrefetcher:
+    r"""Create a prefetched data loader from the ``DATALOADER`` config.
+
+    Args:
+        datasets (torch.utils.data.Dataset): dataset.
+        batch_size (int | None): images per batch, None loads the whole dataset as one batch.
+        device (torch.device): device the batches are used on.
+        dataloader_dict (DictConfig | dict, optional): ``NUM_WORKERS``, ``PREFETCH_FACTOR``, ``PIN_MEMORY``,
+            ``PERSISTENT_WORKERS`` and ``PREFETCH_QUEUE_SIZE``. Defaults to None.
+
+    Returns:
+        CPUPrefetcher | CUDAPrefetcher: data loader, batches are moved to the device by :class:`CUDAPrefetcher`.
+
+    Examples:
+        >>> dataloader = create_dataloader(datasets, 32, torch.device("cpu"), {"NUM_WORKERS": 2})
+        >>> batch_data = next(iter(dataloader))
+    """
+    dataloader_dict = dataloader_dict or {}
+    num_workers = dataloader_dict.get("NUM_WORKERS", 4)
+    pin_memory = dataloader_dict.get("PIN_MEMORY", True)
+    use_cuda = torch.device(device).type == "cuda"
+    batch_size = len(datasets) if batch_size is None else max(min(batch_size, len(datasets)), 1)
+
+    loader_kwargs: dict[str, Any] = {
+        "batch_size": batch_size,
+        "num_workers": num_workers,
+        # without CUDA the CPU prefetcher does the pinning in its background thread
+        "pin_memory": pin_memory and use_cuda,
+    }
+    if num_workers > 0:
+        loader_kwargs["prefetch_factor"] = dataloader_dict.get("PREFETCH_FACTOR", 2)
+        loader_kwargs["persistent_workers"] = dataloader_dict.get("PERSISTENT_WORKERS", True)
+    dataloader = torch.utils.data.DataLoader(datasets, **loader_kwargs)
+
+    if use_cuda:
+        return CUDAPrefetcher(dataloader, device)
+    return CPUPrefetcher(dataloader, dataloader_dict.get("PREFETCH_QUEUE_SIZE", 2), pin_memory)
+
+
+def measure_loader_throughput(
+        dataloader: CPUPrefetcher | CUDAPrefetcher | BatchTransformLoader,
+        max_batches: int | None = None,
+) -> float:
+    r"""Measure how many images per second a data loader delivers.
+
+    The clock includes the worker start-up, PaDiM reads its data in a single pass so that cost is paid on every fit.
+
+    Args:
+        dataloader (CPUPrefetcher | CUDAPrefetcher | BatchTransformLoader): data loader.
+        max_batches (int, optional): stop after this many batches, None reads one epoch. Defaults to None.
+
+    Returns:
+        float: images per second.
+    """
+    num_images = 0
+    start_time = time.perf_counter()
+    for i, batch_data in enumerate(dataloader):
+        num_images += len(batch_data["image"])
+        if max_batches is not None and i + 1 >= max_batches:
+            break
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed_time = time.perf_counter() - start_time
+
+    if hasattr(dataloader, "close"):
+        dataloader.close()
+    return num_images / elapsed_time if num_images > 0 else 0.0
@@ -13,40 +13,116 @@
 # ==============================================================================
 import queue
 import threading
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable
+from typing import Any
 
 import torch
 import torch.utils.data
+from torch import Tensor
+
+from padim.utils.profiler import get_profiler
 
 __all__ = [
-    "PrefetchGenerator", "PrefetchDataLoader", "CPUPrefetcher", "CUDAPrefetcher"
+    "PrefetchGenerator", "PrefetchDataLoader", "CPUPrefetcher", "CUDAPrefetcher", "BatchTransformLoader", "pin_batch", "move_batch",
 ]
 
+_END_OF_DATA = object()
+
+
+class _ExceptionWrapper:
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+def pin_batch(batch_data: Any) -> Any:
+    """Copy the tensors of a batch into page-locked memory, so that copies to the GPU can be asynchronous."""
+    if isinstance(batch_data, Tensor):
+        return batch_data.pin_memory()
+    if isinstance(batch_data, dict):
+        return {key: pin_batch(value) for key, value in batch_data.items()}
+    if isinstance(batch_data, (list, tuple)):
+        return type(batch_data)(pin_batch(value) for value in batch_data)
+    return batch_data
+
+
+def move_batch(batch_data: Any, device: torch.device, non_blocking: bool = False) -> Any:
+    """Move the tensors of a batch to ``device``."""
+    if isinstance(batch_data, Tensor):
+        return batch_data.to(device, non_blocking=non_blocking)
+    if isinstance(batch_data, dict):
+        return {key: move_batch(value, device, non_blocking) for key, value in batch_data.items()}
+    if isinstance(batch_data, (list, tuple)):
+        return type(batch_data)(move_batch(value, device, non_blocking) for value in batch_data)
+    return batch_data
+
+
+def _record_stream(batch_data: Any, stream: torch.cuda.Stream) -> None:
+    if isinstance(batch_data, Tensor):
+        batch_data.record_stream(stream)
+    elif isinstance(batch_data, dict):
+        for value in batch_data.values():
+            _record_stream(value, stream)
+    elif isinstance(batch_data, (list, tuple)):
+        for value in batch_data:
+            _record_stream(value, stream)
+
 
 class PrefetchGenerator(threading.Thread):
     """A fast data prefetch generator.
 
+    A background thread pulls the items of ``generator`` into a bounded queue, errors are raised again in the consumer.
+
     Args:
         generator: Data generator.
         num_data_prefetch_queue (int): How many early data load queues.
+        transfer (Callable, optional): Applied to every item in the background thread, e.g. :func:`pin_batch`. Defaults to None.
     """
 
-    def __init__(self, generator: Iterable, num_data_prefetch_queue: int) -> None:
+    def __init__(self, generator: Iterable, num_data_prefetch_queue: int, transfer: Callable[[Any], Any] | None = None) -> None:
         super().__init__()
-        self.queue = queue.Queue(num_data_prefetch_queue)
+        self.queue = queue.Queue(max(num_data_prefetch_queue, 1))
         self.generator = generator
+        self.transfer = transfer
+        self.stop_event = threading.Event()
         self.daemon = True
         self.start()
 
+    def put(self, item: Any) -> bool:
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
     def run(self) -> None:
-        for item in self.generator:
-            self.queue.put(item)
-        self.queue.put(None)
+        try:
+            for item in self.generator:
+                if self.transfer is not None:
+                    item = self.transfer(item)
+                if not self.put(item):
+                    return
+        except Exception as e:
+            self.put(_ExceptionWrapper(e))
+            return
+        self.put(_END_OF_DATA)
+
+    def close(self) -> None:
+        """Stop the background thread, the items not consumed yet are dropped."""
+        self.stop_event.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
 
     def __next__(self):
         next_item = self.queue.get()
-        if next_item is None:
+        if next_item is _END_OF_DATA:
             raise StopIteration
+        if isinstance(next_item, _ExceptionWrapper):
+            raise next_item.exception
         return next_item
 
     def __iter__(self):
@@ -71,22 +147,44 @@ class PrefetchDataLoader(torch.utils.data.DataLoader):
 class CPUPrefetcher:
     """Use the CPU side to accelerate data reading.
 
+    Batches are collected by a background thread into a bounded queue, so that loading overlaps with the model.
+    Every ``iter`` starts a new pass over the data.
+
     Args:
         dataloader (DataLoader): Data loader. Combines a dataset and a sampler, and provides an iterable over the given dataset.
+        num_data_prefetch_queue (int, optional): How many batches are loaded ahead. Defaults to 2.
+        pin_memory (bool, optional): Stage the batches in page-locked memory in the background thread, which only takes
+            effect when CUDA is available. Defaults to False.
     """
 
-    def __init__(self, dataloader: torch.utils.data.DataLoader) -> None:
+    def __init__(self, dataloader: torch.utils.data.DataLoader, num_data_prefetch_queue: int = 2, pin_memory: bool = False) -> None:
         self.original_dataloader = dataloader
-        self.data = iter(dataloader)
+        self.num_data_prefetch_queue = num_data_prefetch_queue
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.data: PrefetchGenerator | None = None
+
+    def reset(self) -> None:
+        self.close()
+        self.data = PrefetchGenerator(iter(self.original_dataloader),
+                                      self.num_data_prefetch_queue,
+                                      pin_batch if self.pin_memory else None)
+
+    def close(self) -> None:
+        if self.data is not None:
+            self.data.close()
+            self.data = None
 
     def __next__(self):
+        if self.data is None:
+            self.reset()
         try:
             return next(self.data)
         except StopIteration:
-            self.data = iter(self.original_dataloader)
+            self.data = None
             raise
 
     def __iter__(self):
+        self.reset()
         return self
 
     def __len__(self) -> int:
@@ -96,6 +194,9 @@ class CPUPrefetcher:
 class CUDAPrefetcher:
     """Use the CUDA side to accelerate data reading.
 
+    The next batch is copied to the device on a side stream while the current one is processed.
+    Every ``iter`` starts a new pass over the data.
+
     Args:
         dataloader (DataLoader): Data loader. Combines a dataset and a sampler, and provides an iterable over the given dataset.
         device (torch.device): Specify running device.
@@ -106,25 +207,74 @@ class CUDAPrefetcher:
         self.original_dataloader = dataloader
         self.device = device
 
-        self.data = iter(dataloader)
-        self.stream = torch.cuda.Stream()
+        self.data = None
+        self.stream = torch.cuda.Stream(device)
+
+    def reset(self) -> None:
+        self.data = iter(self.original_dataloader)
         self.preload()
 
     def preload(self):
         try:
-            self.batch_data = next(self.data)
+            batch_data = next(self.data)
         except StopIteration:
             self.batch_data = None
-            self.data = iter(self.original_dataloader)
             return None
 
+        with torch.cuda.stream(self.stream):
+            self.batch_data = move_batch(batch_data, self.device, non_blocking=True)
+
     def __next__(self):
+        if self.data is None:
+            self.reset()
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
         batch_data = self.batch_data
+        if batch_data is None:
+            self.data = None
+            raise StopIteration
+        # the tensors were allocated on the side stream, keep them alive until the current stream is done with them
+        _record_stream(batch_data, torch.cuda.current_stream(self.device))
         self.preload()
         return batch_data
 
     def __iter__(self):
+        self.reset()
         return self
 
     def __len__(self) -> int:
         return len(self.original_dataloader)
+
+
+class BatchTransformLoader:
+    """Apply batched transforms to the images and masks of every batch, on the device the batches are loaded to.
+
+    Args:
+        dataloader (CPUPrefetcher | CUDAPrefetcher): Data loader of uint8 batches.
+        image_transform (Callable[[Tensor], Tensor]): Transform of the image batches.
+        mask_transform (Callable[[Tensor], Tensor]): Transform of the mask batches.
+    """
+
+    def __init__(
+            self,
+            dataloader: CPUPrefetcher | CUDAPrefetcher,
+            image_transform: Callable[[Tensor], Tensor],
+            mask_transform: Callable[[Tensor], Tensor],
+    ) -> None:
+        self.dataloader = dataloader
+        self.image_transform = image_transform
+        self.mask_transform = mask_transform
+
+    def __iter__(self):
+        profiler = get_profiler()
+        for batch_data in self.dataloader:
+            with profiler.span("data.batch_transform"):
+                batch_data["image"] = self.image_transform(batch_data["image"])
+                batch_data["mask"] = self.mask_transform(batch_data["mask"])
+            yield batch_data
+
+    def close(self) -> None:
+        if hasattr(self.dataloader, "close"):
+            self.dataloader.close()
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
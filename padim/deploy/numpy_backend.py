@@ -0,0 +1,311 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Score with NumPy only, for hosts without PyTorch.
+
+The model is read from a checkpoint directory (see :mod:`padim.models.checkpoint`, the files are parsed here again so
+that this module does not import torch) and the backbone is either an ONNX model exported by ``tools/export_onnx.py``,
+run with ``onnxruntime``, or replaced by backbone features computed elsewhere.
+"""
+import json
+import logging
+import math
+from pathlib import Path
+from typing import Any, Sequence
+
+import numpy as np
+
+__all__ = [
+    "NumpyPaDiM", "read_arrays", "mahalanobis_distances", "get_blur_matrix", "get_bilinear_matrix",
+]
+
+logger = logging.getLogger(__name__)
+
+# the checkpoint format of padim.models.checkpoint
+MANIFEST_FILE_NAME = "manifest.json"
+TENSORS_FILE_NAME = "tensors.bin"
+
+
+def read_arrays(path: str | Path, table: dict[str, dict[str, Any]], mmap: bool = True) -> dict[str, np.ndarray]:
+    """Read the arrays of a checkpoint tensor file, memory-mapped copy-on-write unless ``mmap`` is False."""
+    buffer = np.memmap(path, dtype=np.uint8, mode="c") if mmap else np.fromfile(path, dtype=np.uint8)
+    arrays = {}
+    for name, entry in table.items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=entry["offset"]).reshape(entry["shape"])
+    return arrays
+
+
+def mahalanobis_distances(embedding: np.ndarray, mean: np.ndarray, inv_covariance: np.ndarray, chunk_size: int | None = None) -> np.ndarray:
+    """Mahalanobis distances of every position of a batch of embeddings to its Gaussian.
+
+    Args:
+        embedding (np.ndarray): (B, C, P) embedding vectors.
+        mean (np.ndarray): (C, P) means.
+        inv_covariance (np.ndarray): (P, C, C) inverse covariances.
+        chunk_size (int, optional): Score this many positions at a time, which bounds the transient memory. Defaults to
+            None (all at once).
+
+    Returns:
+        The (B, P) distances.
+    """
+    batch, _, num_positions = embedding.shape
+    chunk_size = chunk_size or num_positions
+    distances = np.empty((batch, num_positions), dtype=np.result_type(embedding, inv_covariance))
+    for start in range(0, num_positions, chunk_size):
+        end = min(start + chunk_size, num_positions)
+        # (p, B, C) deviations, one batched matmul with the inverse covariances and a per row dot product
+        delta = (embedding[:, :, start:end] - mean[:, start:end]).transpose(2, 0, 1)
+        distances[:, start:end] = np.einsum("pbc,pbc->bp", np.matmul(delta, inv_covariance[start:end]), delta)
+    return np.sqrt(np.maximum(distances, 0, out=distances), out=distances)
+
+
+def get_blur_matrix(length: int, sigma: float) -> np.ndarray:
+    """(length, length) matrix of a 1D Gaussian blur with reflect padding, as :func:`padim.models.module.get_blur_matrix`."""
+    kernel_size = 2 * int(4.0 * sigma + 0.5) + 1
+    half_size = (kernel_size - 1) * 0.5
+    kernel = np.exp(-0.5 * (np.linspace(-half_size, half_size, kernel_size) / sigma) ** 2)
+    kernel /= kernel.sum()
+    radius = kernel_size // 2
+
+    # reflect the taps that fall outside without repeating the border, the period of the reflection is 2 * (length - 1)
+    columns = np.arange(length)[:, None] + np.arange(kernel_size)[None, :] - radius
+    if length == 1:
+        columns = np.zeros_like(columns)
+    else:
+        columns = np.abs(columns) % (2 * (length - 1))
+        columns = np.where(columns >= length, 2 * (length - 1) - columns, columns)
+    matrix = np.zeros((length, length))
+    np.add.at(matrix, (np.repeat(np.arange(length), kernel_size), columns.ravel()), np.tile(kernel, length))
+    return matrix
+
+
+def get_bilinear_matrix(output_length: int, input_length: int) -> np.ndarray:
+    """(output length, input length) matrix of a 1D bilinear resize with ``align_corners=False``."""
+    source = np.maximum((np.arange(output_length) + 0.5) * (input_length / output_length) - 0.5, 0.0)
+    lower = source.astype(np.int64)
+    upper = np.where(lower < input_length - 1, lower + 1, lower)
+    weight = source - lower
+    matrix = np.zeros((output_length, input_length))
+    np.add.at(matrix, (np.arange(output_length), lower), 1 - weight)
+    np.add.at(matrix, (np.arange(output_length), upper), weight)
+    return matrix
+
+
+def get_nearest_index(output_length: int, input_length: int) -> np.ndarray:
+    """Source indices of a nearest resize, as ``torch.nn.functional.interpolate(mode="nearest")``."""
+    return np.minimum(np.floor(np.arange(output_length) * (input_length / output_length)).astype(np.int64), input_length - 1)
+
+
+class NumpyPaDiM(object):
+    r"""Score images or backbone features against a fitted checkpoint with NumPy.
+
+    The scores match :class:`padim.models.PaDiM` up to float rounding: the embedding is the same nearest upsampling,
+    concatenation and channel selection, the distances are batched matmuls over the positions, and the upsampling and
+    blur of the anomaly map are one matrix product per axis as in the "fused" post-processing. A "reference" checkpoint
+    is post-processed the "fused" way, which equals it up to float rounding. Tiled checkpoints are not supported.
+
+    Args:
+        path (str | Path): Checkpoint directory.
+        backbone_path (str | Path, optional): ONNX backbone from ``tools/export_onnx.py``, needs ``onnxruntime``.
+            Defaults to None, only features can be scored.
+        mmap (bool, optional): Memory-map the Gaussian parameters. Defaults to True.
+        chunk_size (int, optional): Score this many positions at a time. Defaults to None (all at once).
+        sigma (float, optional): Gaussian blur sigma at image resolution. Defaults to 4.0.
+
+    Examples:
+        >>> from padim.deploy import NumpyPaDiM
+        >>> model = NumpyPaDiM("results/train/mvtec_bottle/model", "results/train/mvtec_bottle/backbone.onnx")
+        >>> anomaly_maps = model(images)  # (B, 3, H, W) uint8 images, resized and cropped
+        >>> scores = model.predict(images)["scores"]
+    """
+
+    def __init__(
+            self,
+            path: str | Path,
+            backbone_path: str | Path | None = None,
+            mmap: bool = True,
+            chunk_size: int | None = None,
+            sigma: float = 4.0,
+    ) -> None:
+        path = Path(path)
+        with open(path / MANIFEST_FILE_NAME) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("tiling") is not None:
+            raise ValueError("Tiled checkpoints are not supported by the NumPy backend")
+        arrays = read_arrays(path / TENSORS_FILE_NAME, self.manifest["tensors"], mmap)
+
+        self.return_nodes = self.manifest["return_nodes"]
+        self.mask_size = tuple(self.manifest["mask_size"])
+        # DEFAULT_POST_PROCESS_MODE of padim.models, which imports torch
+        self.post_process_mode = self.manifest.get("post_process", "fused")
+        self.pool_stride = self.manifest.get("pool_stride", 1)
+        self.chunk_size = chunk_size
+        self.sigma = sigma
+        self.index = arrays["index"]
+        self.mean = arrays["multi_variate_gaussian.mean"]
+        self.inv_covariance = arrays["multi_variate_gaussian.inv_covariance"]
+        self.input_mean = arrays["input_mean"]
+        self.input_std = arrays["input_std"]
+        self.roi_mask = arrays.get("roi_mask")
+        self.score_normalizer = {name.split(".", 1)[1]: float(array) for name, array in arrays.items()
+                                 if name.startswith("score_normalizer.")}
+        self.matrices: dict[tuple, tuple[np.ndarray, np.ndarray]] = {}
+        self.roi_indices: dict[tuple, np.ndarray] = {}
+
+        self.session = None
+        if backbone_path is not None:
+            try:
+                import onnxruntime
+            except ImportError as error:
+                raise ImportError("Running the ONNX backbone needs onnxruntime, 'pip install onnxruntime'") from error
+            self.session = onnxruntime.InferenceSession(str(backbone_path), providers=["CPUExecutionProvider"])
+            self.output_names = [output.name for output in self.session.get_outputs()]
+            if sorted(self.output_names) != sorted(self.return_nodes):
+                raise ValueError(f"The ONNX backbone returns {self.output_names}, the checkpoint uses {self.return_nodes}")
+
+    @property
+    def calibrated(self) -> bool:
+        return not math.isnan(self.score_normalizer.get("min_score", float("nan")))
+
+    def normalize_input(self, images: np.ndarray) -> np.ndarray:
+        """Normalize a batch of uint8 images, float images are expected to be normalized already."""
+        if images.dtype != np.uint8:
+            return images.astype(np.float32, copy=False)
+        return ((images.astype(np.float32) / 255.0 - self.input_mean) / self.input_std).astype(np.float32, copy=False)
+
+    def extract_features(self, images: np.ndarray) -> dict[str, np.ndarray]:
+        """Backbone features of a (B, 3, H, W) batch of images, run by the ONNX backbone."""
+        if self.session is None:
+            raise RuntimeError("No ONNX backbone loaded, score backbone features with score_features()")
+        outputs = self.session.run(self.output_names, {self.session.get_inputs()[0].name: self.normalize_input(images)})
+        return dict(zip(self.output_names, outputs))
+
+    def embed_features(self, features: dict[str, np.ndarray]) -> np.ndarray:
+        """(B, C, h, w) embedding: the features upsampled to the first layer, concatenated and the channels selected."""
+        first = features[self.return_nodes[0]]
+        height, width = first.shape[-2:]
+        # only the selected channels are gathered, the full concatenation is never built
+        layers = [first]
+        for name in self.return_nodes[1:]:
+            layer = features[name]
+            rows = get_nearest_index(height, layer.shape[-2])
+            columns = get_nearest_index(width, layer.shape[-1])
+            layers.append(layer[:, :, rows[:, None], columns[None, :]] if layer.shape[-2:] != (height, width) else layer)
+        offsets = np.cumsum([0] + [layer.shape[1] for layer in layers])
+        embedding = np.empty((first.shape[0], len(self.index), height, width), dtype=np.float32)
+        for layer, start, end in zip(layers, offsets[:-1], offsets[1:]):
+            selected = np.nonzero((self.index >= start) & (self.index < end))[0]
+            embedding[:, selected] = layer[:, self.index[selected] - start]
+
+        # average pooling without padding, the rows and columns that do not fill a window are dropped
+        stride = self.pool_stride
+        if stride > 1:
+            batch, channel = embedding.shape[:2]
+            height, width = height // stride, width // stride
+            embedding = embedding[:, :, :height * stride, :width * stride]
+            embedding = embedding.reshape(batch, channel, height, stride, width, stride).mean(axis=(3, 5), dtype=np.float32)
+        return embedding
+
+    def get_roi_index(self, feature_size: tuple[int, int]) -> np.ndarray | None:
+        """Flat indices of the feature positions overlapping the region of interest, as ``adaptive_max_pool2d``."""
+        if self.roi_mask is None:
+            return None
+        if feature_size not in self.roi_indices:
+            mask_height, mask_width = self.roi_mask.shape
+            height, width = feature_size
+            cells = np.zeros(feature_size, dtype=bool)
+            for i in range(height):
+                rows = slice(i * mask_height // height, -(-(i + 1) * mask_height // height))
+                for j in range(width):
+                    cells[i, j] = self.roi_mask[rows, j * mask_width // width:-(-(j + 1) * mask_width // width)].any()
+            self.roi_indices[feature_size] = np.flatnonzero(cells)
+        return self.roi_indices[feature_size]
+
+    def compute_distance(self, embedding: np.ndarray) -> np.ndarray:
+        """(B, 1, h, w) Mahalanobis distance map, zero outside the region of interest."""
+        batch, channel, height, width = embedding.shape
+        embedding = embedding.reshape(batch, channel, height * width)
+        roi_index = self.get_roi_index((height, width))
+        if roi_index is None:
+            distances = mahalanobis_distances(embedding, self.mean, self.inv_covariance, self.chunk_size)
+        else:
+            distances = np.zeros((batch, height * width), dtype=np.float32)
+            distances[:, roi_index] = mahalanobis_distances(embedding[:, :, roi_index], self.mean, self.inv_covariance,
+                                                            self.chunk_size)
+        return distances.reshape(batch, 1, height, width)
+
+    def get_matrices(self, map_size: tuple[int, int], mode: str) -> tuple[np.ndarray, np.ndarray]:
+        """Row and column matrices of the post-processing, or of the feature resolution blur of the image scores."""
+        key = (map_size, mode)
+        if key not in self.matrices:
+            matrices = []
+            for input_length, output_length in zip(map_size, self.mask_size):
+                low_res_blur = get_blur_matrix(input_length, self.sigma * input_length / output_length)
+                if mode == "score":
+                    matrix = low_res_blur
+                elif mode == "low_res":
+                    matrix = get_bilinear_matrix(output_length, input_length) @ low_res_blur
+                else:
+                    matrix = get_blur_matrix(output_length, self.sigma) @ get_bilinear_matrix(output_length, input_length)
+                matrices.append(matrix.astype(np.float32))
+            self.matrices[key] = (matrices[0], np.ascontiguousarray(matrices[1].T))
+        return self.matrices[key]
+
+    def post_process(self, distances: np.ndarray) -> np.ndarray:
+        """Upsample and smooth (B, 1, h, w) distance maps into (B, 1, H, W) anomaly maps, one matmul per axis."""
+        row_matrix, column_matrix = self.get_matrices(distances.shape[-2:], self.post_process_mode)
+        return np.matmul(np.matmul(row_matrix, distances), column_matrix)
+
+    def compute_image_score(self, distances: np.ndarray) -> np.ndarray:
+        """(B,) image scores of distance maps, smoothed at feature resolution, as ``PaDiM.predict``."""
+        row_matrix, column_matrix = self.get_matrices(distances.shape[-2:], "score")
+        return np.matmul(np.matmul(row_matrix, distances), column_matrix).reshape(len(distances), -1).max(axis=1)
+
+    def normalize(self, scores: np.ndarray) -> np.ndarray:
+        """Normalize raw scores with the calibrated constants."""
+        if not self.calibrated:
+            raise RuntimeError("The checkpoint was not calibrated")
+        min_score = self.score_normalizer["min_score"]
+        return (scores - min_score) / (self.score_normalizer["max_score"] - min_score)
+
+    def score_features(self, features: dict[str, np.ndarray] | Sequence[np.ndarray]) -> np.ndarray:
+        """(B, 1, H, W) anomaly maps of backbone features, by return node or in the order of the return nodes."""
+        if not isinstance(features, dict):
+            features = dict(zip(self.return_nodes, features))
+        return self.post_process(self.compute_distance(self.embed_features(features)))
+
+    def predict(self, images: np.ndarray | None = None, features: dict[str, np.ndarray] | None = None,
+                return_maps: bool = False) -> dict[str, np.ndarray | None]:
+        """Image scores of images or backbone features, and their anomaly maps if ``return_maps``.
+
+        Args:
+            images (np.ndarray, optional): (B, 3, H, W) images, scored by the ONNX backbone. Defaults to None.
+            features (dict[str, np.ndarray], optional): Backbone features by return node. Defaults to None.
+            return_maps (bool, optional): Also build the anomaly maps. Defaults to False.
+
+        Returns:
+            A dict with the raw ``scores`` and the ``anomaly_maps`` or None.
+        """
+        if features is None:
+            features = self.extract_features(images)
+        distances = self.compute_distance(self.embed_features(features))
+        return {
+            "scores": self.compute_image_score(distances),
+            "anomaly_maps": self.post_process(distances) if return_maps else None,
+        }
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        return self.score_features(self.extract_features(images))
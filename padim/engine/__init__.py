@@ -14,3 +14,5 @@
 from .base import *
 from .evaler import *
 from .trainer import *
+from .parallel import *
+from .pipeline import *
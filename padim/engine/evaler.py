@@ -13,6 +13,7 @@
 # ==============================================================================
 import logging
 import os
+import time
 from abc import ABC
 from pathlib import Path
 from typing import Any
@@ -23,13 +24,18 @@ import torch
 import torch.utils.data
 from matplotlib import pyplot as plt
 from omegaconf import DictConfig
-from sklearn.metrics import roc_curve, roc_auc_score, precision_recall_curve
+from sklearn.metrics import f1_score, roc_curve, roc_auc_score, precision_recall_curve
 from torch import nn
 
 from padim.datasets import FolderDataset, MVTecDataset
-from padim.datasets.utils import CPUPrefetcher, CUDAPrefetcher
-from padim.utils import plot_score_map, select_device, plot_fig
+from padim.datasets.utils import BatchTransformLoader, CPUPrefetcher, CUDAPrefetcher, create_dataloader
+from padim.models import PaDiM, assign_tensors, is_checkpoint, load_checkpoint, parse_bytes
+from padim.models.module import ScoreNormalizer
+from padim.utils import plot_score_map, select_device, plot_fig, VisualRenderer, configure_profiler, create_batch_transforms, \
+    create_image_and_mask_transforms, get_normalize_mean_and_std, get_profiler
 from .base import Base
+from .parallel import ParallelScorer, get_available_cores
+from .pipeline import Pipeline
 
 logger = logging.getLogger(__name__)
 
@@ -39,18 +45,77 @@ class Evaler(Base, ABC):
         super().__init__()
         self.config = config
 
+    @staticmethod
+    def load_checkpoint(
+            weights_path: str | Path,
+            device: torch.device,
+            chunk_size: int | None = None,
+            distance_memory_budget: int | None = None,
+    ) -> dict[str, Any]:
+        """Load a checkpoint directory, or a legacy pickled checkpoint whose model is upgraded to the current PaDiM."""
+        if is_checkpoint(weights_path):
+            return load_checkpoint(weights_path, device, chunk_size=chunk_size, distance_memory_budget=distance_memory_budget)
+
+        logger.warning(f"'{weights_path}' is a legacy pickled checkpoint, only load it from a trusted source.")
+        return Evaler.upgrade_legacy_checkpoint(torch.load(weights_path, map_location=device, weights_only=False))
+
+    @staticmethod
+    def upgrade_legacy_checkpoint(checkpoint: dict[str, Any]) -> dict[str, Any]:
+        """Rebuild the model and the transforms of a legacy pickled checkpoint from its config and the pickled state.
+
+        The pickled model is an instance of the PaDiM of its time, without the attributes added since, and the pickled
+        transforms expect the float images the datasets decoded then. The buffers added since get their defaults, the
+        anomaly maps are post-processed the way they were then.
+        """
+        legacy_model = checkpoint["model"]
+        if "config" not in checkpoint or not isinstance(legacy_model, PaDiM):
+            raise ValueError("Unsupported legacy checkpoint, re-export the model with tools/train.py")
+
+        config = checkpoint["config"]
+        mask_size = tuple(checkpoint["mask_size"])
+        normalize_mean, normalize_std = get_normalize_mean_and_std(config.DATASETS.TRANSFORMS)
+        state_dict = legacy_model.state_dict()
+        with torch.device("meta"):
+            model = PaDiM(config.MODEL.BACKBONE, legacy_model.return_nodes, False, mask_size, post_process="reference",
+                          num_features=len(state_dict["index"]))
+
+        backbone_prefix = "feature_extractor."
+        model.feature_extractor.load_state_dict({name[len(backbone_prefix):]: tensor for name, tensor in state_dict.items()
+                                                 if name.startswith(backbone_prefix)}, assign=True)
+        tensors = {
+            "input_mean": torch.tensor(normalize_mean, dtype=torch.float32).view(1, -1, 1, 1),
+            "input_std": torch.tensor(normalize_std, dtype=torch.float32).view(1, -1, 1, 1),
+            **{f"score_normalizer.{name}": tensor for name, tensor in ScoreNormalizer().state_dict().items()},
+        }
+        tensors.update({name: tensor for name, tensor in state_dict.items() if not name.startswith(backbone_prefix)})
+        assign_tensors(model, tensors)
+
+        image_transforms, mask_transforms = create_image_and_mask_transforms(config.DATASETS.TRANSFORMS)
+        return {
+            **checkpoint,
+            "model": model,
+            "image_transforms": image_transforms,
+            "mask_transforms": mask_transforms,
+            "mask_size": mask_size,
+        }
+
     @staticmethod
     def create_model(checkpoint: Any, device: torch.device) -> nn.Module:
         """Create a model from checkpoint."""
         logger.info(f"load model from checkpoint")
         model = checkpoint["model"]
         model.eval()
-        model = model.to(device)
+        if isinstance(model, PaDiM):
+            model = model.place(device)
+        else:
+            model = model.to(device)
         return model
 
     @staticmethod
-    def create_transform(checkpoint: Any) -> tuple[A.Compose, A.Compose]:
-        """Get image and mask transforms."""
+    def create_transform(checkpoint: Any, batched: bool = False) -> tuple[A.Compose, A.Compose]:
+        """Get image and mask transforms, with the resize and crop left to the batched transforms if ``batched``."""
+        if batched:
+            return create_image_and_mask_transforms(checkpoint["manifest"]["transforms"], batched=True)
         return checkpoint["image_transforms"], checkpoint["mask_transforms"]
 
     @staticmethod
@@ -62,37 +127,53 @@ class Evaler(Base, ABC):
             mask_size: tuple[int, int],
             cls_task: bool,
             device: torch.device = torch.device("cpu"),
-    ) -> CPUPrefetcher | CUDAPrefetcher:
+            cache_dir: str | Path | None = None,
+            reduced_decode: bool = False,
+            batch_transforms_dict: DictConfig | dict | None = None,
+            batch_size: int | None = None,
+            dataloader_dict: DictConfig | dict | None = None,
+    ) -> CPUPrefetcher | CUDAPrefetcher | BatchTransformLoader:
         if cls_task:
             logger.info("Load classification dataset.")
-            datasets = FolderDataset(root, image_transforms, mask_size, False)
+            datasets = FolderDataset(root, image_transforms, mask_size, False, cache_dir, reduced_decode)
         else:
             logger.info("Load segmentation dataset.")
-            datasets = MVTecDataset(root, category, image_transforms, mask_transforms, mask_size, False)
-
-        dataloader = torch.utils.data.DataLoader(
-            datasets,
-            batch_size=len(datasets),
-            num_workers=4,
-            pin_memory=True,
-            persistent_workers=True,
-        )
+            datasets = MVTecDataset(root, category, image_transforms, mask_transforms, mask_size, False, cache_dir, reduced_decode)
 
-        if device == "cuda":
-            dataloader = CUDAPrefetcher(dataloader, device)
-        else:
-            dataloader = CPUPrefetcher(dataloader)
+        dataloader = create_dataloader(datasets, batch_size, device, dataloader_dict)
+
+        if batch_transforms_dict is not None:
+            dataloader = BatchTransformLoader(dataloader, *create_batch_transforms(batch_transforms_dict))
         return dataloader
 
+    def create_renderer(self, save_visuals_dir: str | Path) -> VisualRenderer | None:
+        """Create the OpenCV visual renderer, or None to plot with matplotlib."""
+        visuals_dict = self.config.VAL.get("VISUALS", {})
+        if visuals_dict.get("BACKEND", "opencv") != "opencv":
+            return None
+
+        normalize_dict = self.config.DATASETS.TRANSFORMS.get("NORMALIZE", {})
+        return VisualRenderer(
+            save_visuals_dir,
+            num_workers=visuals_dict.get("NUM_WORKERS", 4),
+            top_k=visuals_dict.get("TOP_K"),
+            mean=tuple(normalize_dict.get("MEAN", (0.485, 0.456, 0.406))),
+            std=tuple(normalize_dict.get("STD", (0.229, 0.224, 0.225))),
+        )
+
     @staticmethod
     def run_validation(
             model: nn.Module,
-            val_loader: CPUPrefetcher | CUDAPrefetcher,
+            val_loader: CPUPrefetcher | CUDAPrefetcher | BatchTransformLoader,
             cls_task: bool,
             device: torch.device = torch.device("cpu"),
             save_visuals_dir: str | Path = "results/eval/visual",
+            renderer: VisualRenderer | None = None,
+            scorer: ParallelScorer | None = None,
+            pipeline_queue_size: int | None = None,
     ) -> None:
         model.eval()
+        profiler = get_profiler()
 
         fig, ax = plt.subplots(1, 2, figsize=(20, 10))
         fig_image_roc_auc = ax[0]
@@ -102,63 +183,115 @@ class Evaler(Base, ABC):
         mask_data_list = []
         image_path_list = []
 
-        # Load data
-        batch_data = next(iter(val_loader))
-        image = batch_data["image"].to(device, non_blocking=True)
-        target = batch_data["target"].to(device, non_blocking=True)
-        mask = batch_data["mask"].to(device, non_blocking=True)
-        image_path = batch_data["image_path"]
-
         # get all images anomaly map
-        anomaly_map = model(image)
+        def iterate_images():
+            data_start_time = time.perf_counter()
+            for batch_data in val_loader:
+                profiler.add("eval.data", data_start_time, time.perf_counter())
+                image = batch_data["image"].to(device, non_blocking=True)
+                target = batch_data["target"].to(device, non_blocking=True)
+                mask = batch_data["mask"].to(device, non_blocking=True)
+                if mask.dtype == torch.uint8:
+                    mask = mask.float() / 255.0
+
+                image_data_list.extend(image.cpu().detach().numpy())
+                target_data_list.extend(target.cpu().detach().numpy())
+                mask_data_list.extend(mask.cpu().detach().numpy())
+                image_path_list.extend(batch_data["image_path"])
+                yield image
+                data_start_time = time.perf_counter()
 
-        image_data_list.extend(image.cpu().detach().numpy())
-        target_data_list.extend(target.cpu().detach().numpy())
-        mask_data_list.extend(mask.cpu().detach().numpy())
-        image_path_list.extend(image_path)
+        anomaly_map_list = []
+        if scorer is not None:
+            # the workers score the batches while the next ones load, their time is not recorded in this process
+            anomaly_map_list.extend(scorer.map(iterate_images()))
+        elif pipeline_queue_size is not None:
+            # load the next batches and copy the last maps to the host while the model scores
+            def score(image: torch.Tensor) -> torch.Tensor:
+                with torch.no_grad():
+                    return model(image)
+
+            pipeline = Pipeline([("model", score), ("collect", lambda anomaly_map: anomaly_map.detach().cpu())],
+                                pipeline_queue_size)
+            anomaly_map_list.extend(pipeline.run(iterate_images()))
+            pipeline.report()
+        else:
+            for image in iterate_images():
+                with profiler.span("eval.model"), torch.no_grad():
+                    anomaly_map_list.append(model(image).detach().cpu())
+        anomaly_map = torch.cat(anomaly_map_list)
 
-        # Normalization
-        anomaly_map = anomaly_map.detach().cpu().numpy()
-        max_score = anomaly_map.max()
-        min_score = anomaly_map.min()
-        scores = (anomaly_map - min_score) / (max_score - min_score)
+        # Normalization, use the calibrated constants when the model has them so that scores do not depend on the batch
+        with profiler.span("eval.normalize"):
+            score_normalizer = getattr(model, "score_normalizer", None)
+            calibrated = score_normalizer is not None and score_normalizer.calibrated
+            if calibrated:
+                scores = score_normalizer(anomaly_map).numpy()
+            else:
+                anomaly_map = anomaly_map.numpy()
+                max_score = anomaly_map.max()
+                min_score = anomaly_map.min()
+                scores = (anomaly_map - min_score) / (max_score - min_score)
+        visual_scores = np.clip(scores, 0, 1)
 
         if cls_task:
-            num_images = len(scores)
-            for i in range(num_images):
-                save_visuals_path = Path(save_visuals_dir) / os.path.basename(image_path_list[i])
-                plot_score_map(image_data_list[i], scores[i], 0, 255, save_visuals_path)
+            with profiler.span("eval.render"):
+                if renderer is not None:
+                    image_names = [os.path.basename(image_path) for image_path in image_path_list]
+                    renderer.render_score_map(np.asarray(image_data_list), visual_scores, image_names)
+                else:
+                    num_images = len(scores)
+                    for i in range(num_images):
+                        save_visuals_path = Path(save_visuals_dir) / os.path.basename(image_path_list[i])
+                        plot_score_map(image_data_list[i], visual_scores[i], 0, 255, save_visuals_path)
         else:
-            # calculate image-level ROC AUC score
-            image_scores = scores.reshape(scores.shape[0], -1).max(axis=1)
-            gt_list = np.asarray(target_data_list)
-            fpr, tpr, _ = roc_curve(gt_list, image_scores)
-            image_roc_auc = roc_auc_score(gt_list, image_scores)
-            print(f"image ROC_AUC: {image_roc_auc:.3f}")
-            fig_image_roc_auc.plot(fpr, tpr, label=f"image_ROC_AUC: {image_roc_auc:.3f}")
-
-            # get optimal threshold
-            gt_mask = np.asarray(mask_data_list)
-            precision, recall, thresholds = precision_recall_curve(gt_mask.flatten(), scores.flatten())
-            a = 2 * precision * recall
-            b = precision + recall
-            f1 = np.divide(a, b, out=np.zeros_like(a), where=b != 0)
-            threshold = thresholds[np.argmax(f1)]
-
-            # calculate per-pixel level ROC_AUC
-            fpr, tpr, _ = roc_curve(gt_mask.flatten(), scores.flatten())
-            per_pixel_roc_auc = roc_auc_score(gt_mask.flatten(), scores.flatten())
-            print(f"pixel ROC_AUC: {per_pixel_roc_auc:.3f}")
-
-            fig_pixel_roc_auc.plot(fpr, tpr, label=f"pixel_ROC_AUC: {per_pixel_roc_auc:.3f}")
-            plot_fig(image_data_list, scores, mask_data_list, threshold, save_visuals_dir)
-
-            fig.tight_layout()
-            save_fig_path = Path(save_visuals_dir) / "roc_curve.png"
-            fig.savefig(save_fig_path, dpi=100)
+            with profiler.span("eval.metrics"):
+                # calculate image-level ROC AUC score
+                image_scores = scores.reshape(scores.shape[0], -1).max(axis=1)
+                gt_list = np.asarray(target_data_list)
+                fpr, tpr, _ = roc_curve(gt_list, image_scores)
+                image_roc_auc = roc_auc_score(gt_list, image_scores)
+                print(f"image ROC_AUC: {image_roc_auc:.3f}")
+                fig_image_roc_auc.plot(fpr, tpr, label=f"image_ROC_AUC: {image_roc_auc:.3f}")
+
+                gt_mask = np.asarray(mask_data_list)
+                if calibrated:
+                    # use the thresholds calibrated on normal images
+                    threshold = score_normalizer.normalized_pixel_threshold
+                    image_f1 = f1_score(gt_list, image_scores > score_normalizer.normalized_image_threshold)
+                    print(f"image F1 at calibrated threshold: {image_f1:.3f}")
+                else:
+                    # get optimal threshold
+                    precision, recall, thresholds = precision_recall_curve(gt_mask.flatten(), scores.flatten())
+                    a = 2 * precision * recall
+                    b = precision + recall
+                    f1 = np.divide(a, b, out=np.zeros_like(a), where=b != 0)
+                    threshold = thresholds[np.argmax(f1)]
+
+                # calculate per-pixel level ROC_AUC
+                fpr, tpr, _ = roc_curve(gt_mask.flatten(), scores.flatten())
+                per_pixel_roc_auc = roc_auc_score(gt_mask.flatten(), scores.flatten())
+                print(f"pixel ROC_AUC: {per_pixel_roc_auc:.3f}")
+
+                fig_pixel_roc_auc.plot(fpr, tpr, label=f"pixel_ROC_AUC: {per_pixel_roc_auc:.3f}")
+            with profiler.span("eval.render"):
+                if renderer is not None:
+                    renderer.render_segmentation(np.asarray(image_data_list), visual_scores, gt_mask, threshold)
+                else:
+                    plot_fig(image_data_list, visual_scores, mask_data_list, threshold, save_visuals_dir)
+
+                fig.tight_layout()
+                save_fig_path = Path(save_visuals_dir) / "roc_curve.png"
+                fig.savefig(save_fig_path, dpi=100)
+
+        plt.close(fig)
+        if renderer is not None:
+            with profiler.span("eval.render_wait"):
+                renderer.close()
 
     def validation(self) -> None:
         device = select_device(self.config["DEVICE"])
+        profiler = configure_profiler(self.config.get("PROFILE"))
 
         cls_task = self.config.TASK == "classification"
 
@@ -166,9 +299,15 @@ class Evaler(Base, ABC):
         save_visual_dir = Path("results") / "eval" / self.config.EXP_NAME / "visual"
         save_visual_dir.mkdir(exist_ok=True, parents=True)
 
-        checkpoint = torch.load(self.config.VAL.WEIGHTS_PATH, map_location=device)
+        distance_memory_budget = self.config.MODEL.get("DISTANCE_MEMORY_BUDGET")
+        checkpoint = self.load_checkpoint(self.config.VAL.WEIGHTS_PATH,
+                                          device,
+                                          self.config.MODEL.get("CHUNK_SIZE"),
+                                          None if distance_memory_budget is None else parse_bytes(distance_memory_budget))
         model = self.create_model(checkpoint, device)
-        image_transforms, mask_transforms = self.create_transform(checkpoint)
+        # the batched transforms need the transform config, which only the checkpoint manifest records
+        batched = self.config.DATASETS.get("TRANSFORM_BACKEND", "albumentations") == "torch" and "manifest" in checkpoint
+        image_transforms, mask_transforms = self.create_transform(checkpoint, batched)
         mask_size = checkpoint["mask_size"]
         val_loader = self.get_dataloader(
             self.config.DATASETS.ROOT.get("VAL'") if cls_task else self.config.DATASETS.ROOT,
@@ -177,12 +316,42 @@ class Evaler(Base, ABC):
             mask_transforms,
             mask_size,
             cls_task,
-            device)
-
-        self.run_validation(
-            model,
-            val_loader,
-            cls_task,
             device,
-            save_visual_dir,
-        )
+            self.config.DATASETS.get("CACHE_DIR"),
+            self.config.DATASETS.get("REDUCED_DECODE", False),
+            checkpoint["manifest"]["transforms"] if batched else None,
+            self.config.VAL.get("IMGS_PER_BATCH"),
+            self.config.get("DATALOADER"))
+
+        pipeline_dict = self.config.get("PIPELINE", {})
+        scorer = None
+        num_processes = self.config.VAL.get("NUM_PROCESSES")
+        num_cores = len(get_available_cores())
+        if num_processes is not None and num_processes > num_cores:
+            logger.warning(f"VAL.NUM_PROCESSES {num_processes} exceeds the {num_cores} available cores, using {num_cores}.")
+            num_processes = num_cores
+        if num_processes is not None and num_processes > 1:
+            if device.type != "cpu" or "manifest" not in checkpoint:
+                logger.warning("VAL.NUM_PROCESSES needs a CPU device and a checkpoint directory, scoring in this process.")
+            else:
+                scorer = ParallelScorer(checkpoint,
+                                        num_processes,
+                                        chunk_size=self.config.MODEL.get("CHUNK_SIZE"),
+                                        distance_memory_budget=None if distance_memory_budget is None else parse_bytes(distance_memory_budget))
+
+        try:
+            self.run_validation(
+                model,
+                val_loader,
+                cls_task,
+                device,
+                save_visual_dir,
+                self.create_renderer(save_visual_dir),
+                scorer,
+                pipeline_dict.get("QUEUE_SIZE", 2) if pipeline_dict.get("ENABLED", False) else None,
+            )
+        finally:
+            if scorer is not None:
+                scorer.close()
+
+        profiler.report(self.config.get("PROFILE", {}).get("TRACE_PATH"))
@@ -0,0 +1,271 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Data-parallel inference on CPU hosts, one worker process per partition of the cores.
+"""
+import logging
+import os
+import queue
+import traceback
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+import torch
+import torch.multiprocessing as mp
+
+from padim.models import SharedModel
+
+__all__ = [
+    "ParallelScorer", "get_available_cores", "partition_cores",
+]
+
+logger = logging.getLogger(__name__)
+
+OUTPUTS = ["anomaly_map", "scores"]
+
+
+def get_available_cores() -> list[int]:
+    """The cores this process may run on, honoring the CPU affinity set by e.g. ``taskset`` or a container."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(num_processes: int, cores: list[int] | None = None) -> list[list[int]]:
+    """Split the cores into ``num_processes`` contiguous groups of nearly equal size.
+
+    Neighboring core ids usually share a cache and a memory node, so each worker keeps its threads close together.
+
+    Args:
+        num_processes (int): Number of groups.
+        cores (list[int], optional): Cores to split. Defaults to the available cores.
+
+    Returns:
+        The cores of every group.
+    """
+    cores = get_available_cores() if cores is None else sorted(cores)
+    if not 0 < num_processes <= len(cores):
+        raise ValueError(f"Cannot split {len(cores)} cores into {num_processes} worker processes.")
+    size, remainder = divmod(len(cores), num_processes)
+    groups = []
+    start = 0
+    for rank in range(num_processes):
+        end = start + size + (rank < remainder)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _worker(
+        rank: int,
+        path: str,
+        cores: list[int],
+        output: str,
+        chunk_size: int | None,
+        distance_memory_budget: int | None,
+        input_queue: mp.Queue,
+        output_queue: mp.Queue,
+) -> None:
+    # pin the process and size its thread pools to its cores before the first parallel region
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+    try:
+        model = SharedModel.attach(path, chunk_size=chunk_size, distance_memory_budget=distance_memory_budget)["model"]
+    except Exception:
+        output_queue.put((-1, rank, traceback.format_exc()))
+        return
+    output_queue.put((-1, rank, None))
+
+    while True:
+        item = input_queue.get()
+        if item is None:
+            return
+        index, images = item
+        try:
+            with torch.no_grad():
+                if output == "scores":
+                    result = model.predict(images, threshold=float("inf"))["scores"]
+                else:
+                    result = model(images)
+            output_queue.put((index, result, None))
+        except Exception:
+            output_queue.put((index, None, traceback.format_exc()))
+
+
+class ParallelScorer(object):
+    r"""Score batches in worker processes, each pinned to its own group of cores.
+
+    One process rarely scales past a handful of intra-op threads: the small convolutions of the backbone and the per
+    position Mahalanobis products leave most threads of a large host waiting. Splitting the cores into independent
+    workers and giving each worker whole batches keeps every core busy. The model is published once with
+    :class:`padim.models.SharedModel` and every worker memory-maps it, so the host holds one copy of the parameters.
+
+    Batches go to the worker with the fewest batches in flight and come back in input order. At most ``max_pending``
+    batches per worker are in flight or waiting to be returned, which bounds the memory whatever the order the workers
+    finish in.
+
+    The workers are started with ``spawn``, a script creating the scorer must guard its entry point with
+    ``if __name__ == "__main__":``.
+
+    Args:
+        checkpoint (str | Path | dict): Checkpoint directory, or a checkpoint loaded by
+            :func:`padim.models.load_checkpoint`.
+        num_processes (int, optional): Worker processes. Defaults to one per ``threads_per_process`` available cores.
+        threads_per_process (int, optional): Cores of every worker when ``num_processes`` is None. Defaults to 4.
+        cores (list[int], optional): Cores to run the workers on. Defaults to the available cores.
+        output (str, optional): ``"anomaly_map"`` returns the anomaly maps, ``"scores"`` only the image scores.
+            Defaults to ``"anomaly_map"``.
+        chunk_size (int, optional): Score in chunks of positions. Defaults to None.
+        distance_memory_budget (int, optional): Bytes of transient memory of the distance computation of every worker.
+            Defaults to None.
+        max_pending (int, optional): Batches per worker in flight or waiting to be returned. Defaults to 2.
+
+    Examples:
+        >>> from padim.engine import ParallelScorer
+        >>> with ParallelScorer("results/train/mvtec_bottle/model", num_processes=8) as scorer:
+        ...     for anomaly_map in scorer.map(batches):
+        ...         ...
+    """
+
+    def __init__(
+            self,
+            checkpoint: str | Path | dict[str, Any],
+            num_processes: int | None = None,
+            threads_per_process: int = 4,
+            cores: list[int] | None = None,
+            output: str = "anomaly_map",
+            chunk_size: int | None = None,
+            distance_memory_budget: int | None = None,
+            max_pending: int = 2,
+    ) -> None:
+        if output not in OUTPUTS:
+            raise ValueError(f"Unknown output '{output}', expected one of {OUTPUTS}.")
+        cores = get_available_cores() if cores is None else cores
+        if num_processes is None:
+            num_processes = max(1, len(cores) // threads_per_process)
+        self.core_groups = partition_cores(num_processes, cores)
+        self.num_processes = num_processes
+        self.max_pending = max_pending
+
+        # the shared copy embeds the backbone, so that every worker scores with the same weights
+        if isinstance(checkpoint, dict):
+            self.shared_model = SharedModel(checkpoint["model"], checkpoint["manifest"]["transforms"], checkpoint["mask_size"])
+        else:
+            self.shared_model = SharedModel.from_checkpoint(checkpoint)
+        context = mp.get_context("spawn")
+        self.input_queues = [context.Queue() for _ in range(num_processes)]
+        self.output_queue = context.Queue()
+        self.processes = []
+        for rank, group in enumerate(self.core_groups):
+            process = context.Process(target=_worker,
+                                      args=(rank, str(self.shared_model.path), group, output, chunk_size,
+                                            distance_memory_budget, self.input_queues[rank], self.output_queue),
+                                      daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        try:
+            for _ in range(num_processes):
+                _, rank, error = self.get_result()
+                if error is not None:
+                    raise RuntimeError(f"Worker {rank} failed to load the model:\n{error}")
+        except Exception:
+            self.close()
+            raise
+        logger.info(f"Started {num_processes} scoring processes on cores "
+                    f"{', '.join(f'{group[0]}-{group[-1]}' for group in self.core_groups)}.")
+
+    def get_result(self) -> tuple[int, torch.Tensor | int | None, str | None]:
+        """Wait for the next result of any worker, raise if a worker died."""
+        while True:
+            try:
+                return self.output_queue.get(timeout=1.0)
+            except queue.Empty:
+                for rank, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        raise RuntimeError(f"Worker {rank} exited with code {process.exitcode}.")
+
+    def map(self, batches: Iterable[torch.Tensor]) -> Iterator[torch.Tensor]:
+        """Score every batch, in input order.
+
+        Args:
+            batches (Iterable[torch.Tensor]): Input batches, consumed as the workers free up.
+
+        Returns:
+            The output of every batch.
+        """
+        batches = iter(batches)
+        exhausted = False
+        in_flight = [0] * self.num_processes
+        pending = {}
+        results = {}
+        next_index = 0
+        num_batches = 0
+        try:
+            while True:
+                while not exhausted and min(in_flight) < self.max_pending and \
+                        len(pending) + len(results) < self.max_pending * self.num_processes:
+                    try:
+                        images = next(batches)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    rank = in_flight.index(min(in_flight))
+                    self.input_queues[rank].put((num_batches, images.cpu()))
+                    in_flight[rank] += 1
+                    pending[num_batches] = rank
+                    num_batches += 1
+
+                if next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+                    continue
+                if not pending:
+                    return
+
+                index, result, error = self.get_result()
+                rank = pending.pop(index)
+                in_flight[rank] -= 1
+                if error is not None:
+                    raise RuntimeError(f"Worker {rank} failed on batch {index}:\n{error}")
+                results[index] = result
+        finally:
+            # collect the batches still in flight when the caller stops early, they would be taken for the next results
+            if pending and all(process.is_alive() for process in self.processes):
+                for _ in range(len(pending)):
+                    self.get_result()
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        """Score one batch, split into one shard per worker."""
+        return torch.cat(list(self.map(images.chunk(self.num_processes))))
+
+    def close(self) -> None:
+        """Stop the workers and remove the shared model."""
+        for input_queue, process in zip(self.input_queues, self.processes):
+            if process.is_alive():
+                input_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.shared_model.close()
+
+    def __enter__(self) -> "ParallelScorer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,203 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Run the stages of a batch loop concurrently, connected by bounded queues.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+from padim.utils import get_profiler
+
+__all__ = [
+    "Pipeline",
+]
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class _StageStats(object):
+    __slots__ = ("items", "busy_seconds", "input_wait_seconds", "output_wait_seconds")
+
+    def __init__(self) -> None:
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.input_wait_seconds = 0.0
+        self.output_wait_seconds = 0.0
+
+
+class Pipeline(object):
+    r"""Run a loop of stages with one thread per stage, so that every stage works on its own batch.
+
+    The source stage iterates the input, e.g. a dataloader whose workers decode and transform, and every following stage
+    maps the output of the previous one. Stages hand over through queues of ``queue_size`` items, which bounds the batches
+    in flight and keeps the outputs in input order. Torch releases the GIL in its kernels, so a backbone stage and a
+    scoring or statistics stage run in parallel on the host or overlap with the device.
+
+    Every stage records its busy time, the time it waited for input (starved) and the time it waited for the next stage
+    (blocked). The stage with the highest utilization bounds the throughput. Each item is also recorded as a
+    ``pipeline.<stage>`` profiler span, the Chrome trace shows the stages overlap.
+
+    Args:
+        stages (list[tuple[str, Callable]]): Name and function of every stage after the source.
+        queue_size (int, optional): Items waiting between two stages. Defaults to 2.
+        source_name (str, optional): Name of the stage iterating the input. Defaults to ``"data"``.
+
+    Examples:
+        >>> from padim.engine import Pipeline
+        >>> pipeline = Pipeline([("backbone", model), ("gaussian", gaussian.update)])
+        >>> for _ in pipeline.run(batch["image"] for batch in dataloader):
+        ...     pass
+        >>> pipeline.report()
+    """
+
+    def __init__(self, stages: list[tuple[str, Callable[[Any], Any]]], queue_size: int = 2, source_name: str = "data") -> None:
+        if queue_size < 1:
+            raise ValueError(f"The queue size must be at least 1, got {queue_size}")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.names = [source_name] + [name for name, _ in stages]
+        self.stats = {name: _StageStats() for name in self.names}
+        self.wall_seconds = 0.0
+        self.stopped = threading.Event()
+        self.exception: BaseException | None = None
+
+    def put(self, output_queue: queue.Queue, item: Any) -> bool:
+        """Put an item, give up when the pipeline stopped."""
+        while not self.stopped.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, input_queue: queue.Queue) -> Any:
+        """Get an item, :data:`_END` when the pipeline stopped."""
+        while not self.stopped.is_set():
+            try:
+                return input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def fail(self, exception: BaseException) -> None:
+        if self.exception is None:
+            self.exception = exception
+        self.stopped.set()
+
+    def run_source(self, items: Iterable[Any], output_queue: queue.Queue) -> None:
+        stats = self.stats[self.names[0]]
+        profiler = get_profiler()
+        try:
+            iterator = iter(items)
+            while True:
+                start_time = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                end_time = time.perf_counter()
+                stats.busy_seconds += end_time - start_time
+                profiler.add(f"pipeline.{self.names[0]}", start_time, end_time)
+                stats.items += 1
+                if not self.put(output_queue, item):
+                    return
+                stats.output_wait_seconds += time.perf_counter() - end_time
+            self.put(output_queue, _END)
+        except BaseException as exception:
+            self.fail(exception)
+
+    def run_stage(self, name: str, function: Callable[[Any], Any], input_queue: queue.Queue, output_queue: queue.Queue) -> None:
+        stats = self.stats[name]
+        profiler = get_profiler()
+        try:
+            while True:
+                wait_start_time = time.perf_counter()
+                item = self.get(input_queue)
+                start_time = time.perf_counter()
+                stats.input_wait_seconds += start_time - wait_start_time
+                if item is _END:
+                    self.put(output_queue, _END)
+                    return
+                output = function(item)
+                end_time = time.perf_counter()
+                stats.busy_seconds += end_time - start_time
+                profiler.add(f"pipeline.{name}", start_time, end_time)
+                stats.items += 1
+                if not self.put(output_queue, output):
+                    return
+                stats.output_wait_seconds += time.perf_counter() - end_time
+        except BaseException as exception:
+            self.fail(exception)
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """Run the stages on every item.
+
+        Args:
+            items (Iterable): Input of the pipeline, iterated by the source stage.
+
+        Returns:
+            The output of the last stage for every item, in input order. The exception of a failed stage is re-raised.
+        """
+        self.stopped.clear()
+        self.exception = None
+        queues = [queue.Queue(self.queue_size) for _ in self.names]
+        threads = [threading.Thread(target=self.run_source, args=(items, queues[0]), name=f"pipeline-{self.names[0]}", daemon=True)]
+        for i, (name, function) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self.run_stage,
+                                            args=(name, function, queues[i], queues[i + 1]),
+                                            name=f"pipeline-{name}",
+                                            daemon=True))
+
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self.get(queues[-1])
+                if item is _END:
+                    break
+                yield item
+        finally:
+            # stop the stages when the caller stops early or a stage failed
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            self.wall_seconds += time.perf_counter() - start_time
+        if self.exception is not None:
+            raise self.exception
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Items, busy seconds and the fractions of the wall time every stage was busy, starved and blocked."""
+        wall_seconds = max(self.wall_seconds, 1e-9)
+        return {name: {
+            "items": stats.items,
+            "busy_seconds": stats.busy_seconds,
+            "utilization": stats.busy_seconds / wall_seconds,
+            "starved": stats.input_wait_seconds / wall_seconds,
+            "blocked": stats.output_wait_seconds / wall_seconds,
+        } for name, stats in self.stats.items()}
+
+    def report(self) -> None:
+        """Log the utilization of every stage."""
+        lines = [f"{'stage':<16}{'items':>8}{'busy (s)':>12}{'busy':>8}{'starved':>9}{'blocked':>9}"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:<16}{stats['items']:>8}{stats['busy_seconds']:>12.3f}{stats['utilization']:>8.0%}"
+                         f"{stats['starved']:>9.0%}{stats['blocked']:>9.0%}")
+        logger.info(f"Pipeline over {self.wall_seconds:.3f} s:\n" + "\n".join(lines))
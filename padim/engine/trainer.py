@@ -14,23 +14,25 @@
 import logging
 import time
 from abc import ABC
-from copy import deepcopy
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict
 
 import albumentations as A
+import numpy as np
 import torch
 import torch.utils.data
 from omegaconf import DictConfig
 from torch import nn, Tensor
 
 from padim.datasets import MVTecDataset, FolderDataset
-from padim.datasets.utils import CPUPrefetcher, CUDAPrefetcher
-from padim.models import PaDiM
-from padim.utils import select_device, get_data_transform
+from padim.datasets.utils import BatchTransformLoader, CPUPrefetcher, CUDAPrefetcher, create_dataloader
+from padim.models import DEFAULT_POST_PROCESS_MODE, CheckpointWriter, PaDiM, Tiler, create_manifest, create_roi_mask, get_model_tensors, parse_bytes
+from padim.utils import select_device, configure_profiler, create_batch_transforms, create_image_and_mask_transforms, get_normalize_mean_and_std
 from padim.utils.logger import AverageMeter, ProgressMeter
+from padim.utils.metrics import QuantileSketch
 from .base import Base
 from .evaler import Evaler
+from .pipeline import Pipeline
 
 logger = logging.getLogger(__name__)
 
@@ -39,23 +41,27 @@ class Trainer(Base, ABC):
     def __init__(self, config: DictConfig) -> None:
         self.config = config
         self.device = select_device(config["DEVICE"])
+        self.profiler = configure_profiler(config.get("PROFILE"))
 
         self.stats: list[Tensor] = []
         self.embeddings: list[Tensor] = []
 
         self.cls_task = self.config.TASK == "classification"
+        pipeline_dict = self.config.get("PIPELINE", {})
+        self.pipeline_queue_size = pipeline_dict.get("QUEUE_SIZE", 2) if pipeline_dict.get("ENABLED", False) else None
 
         transforms_dict = self.config.DATASETS.TRANSFORMS
+        self.batched_transforms = self.config.DATASETS.get("TRANSFORM_BACKEND", "albumentations") == "torch"
         self.image_transforms, self.mask_transforms = self.create_transform(transforms_dict)
         self.mask_size = (transforms_dict.CENTER_CROP.get("HEIGHT"), transforms_dict.CENTER_CROP.get("WIDTH"))
         self.model = self.create_model()
-        self.train_loader, self.val_loader = self.get_dataloader()
+        self.train_loader, self.val_loader, self.calibration_loader = self.get_dataloader()
 
         # Evaluate configure
         self.evaler = Evaler(config)
 
         self.save_weights_dir: Path = Path("results") / "train" / config.EXP_NAME
-        self.save_weights_path: Path = Path(self.save_weights_dir) / "model.pkl"
+        self.save_weights_path: Path = Path(self.save_weights_dir) / "model"
         self.save_visuals_dir: Path = Path(self.save_weights_dir) / "visuals"
         self.save_weights_dir.mkdir(exist_ok=True, parents=True)
         self.save_visuals_dir.mkdir(exist_ok=True, parents=True)
@@ -63,19 +69,41 @@ class Trainer(Base, ABC):
     def create_model(self) -> nn.Module:
         """Create a model."""
         logger.info(f"Create model: {self.config.MODEL.BACKBONE}")
-        model = PaDiM(self.config.MODEL.BACKBONE, self.config.MODEL.RETURN_NODES, mask_size=self.mask_size)
+        normalize_mean, normalize_std = get_normalize_mean_and_std(self.config.DATASETS.TRANSFORMS)
+        tiling_dict = self.config.MODEL.get("TILING", {})
+        tiler = None
+        if tiling_dict.get("ENABLED", False):
+            tiler = Tiler(tiling_dict.TILE_SIZE, tiling_dict.get("STRIDE"), tiling_dict.get("BLEND", "mean"))
+            logger.info(f"Score tiles of the input: {tiler}")
+        distance_memory_budget = self.config.MODEL.get("DISTANCE_MEMORY_BUDGET")
+        roi_dict = self.config.MODEL.get("ROI", {})
+        roi_mask = create_roi_mask(self.mask_size, roi_dict.get("BOXES"), roi_dict.get("MASK_PATH"))
+        if roi_mask is not None:
+            logger.info(f"Inspect a region of interest of {float(roi_mask.float().mean()):.1%} of the input.")
+        model = PaDiM(
+            self.config.MODEL.BACKBONE,
+            self.config.MODEL.RETURN_NODES,
+            mask_size=self.mask_size,
+            chunk_size=self.config.MODEL.get("CHUNK_SIZE"),
+            normalize_mean=normalize_mean,
+            normalize_std=normalize_std,
+            tiler=tiler,
+            tile_gaussian=tiling_dict.get("GAUSSIAN", "per_tile"),
+            tiles_per_batch=tiling_dict.get("TILES_PER_BATCH"),
+            post_process=self.config.MODEL.get("POST_PROCESS", DEFAULT_POST_PROCESS_MODE),
+            cascade_rank=self.config.MODEL.get("CASCADE_RANK"),
+            roi_mask=roi_mask,
+            distance_memory_budget=None if distance_memory_budget is None else parse_bytes(distance_memory_budget),
+            pool_stride=self.config.MODEL.get("POOL_STRIDE", 1),
+            num_features=self.config.MODEL.get("NUM_FEATURES"),
+            covariance_epsilon=self.config.MODEL.get("COVARIANCE_EPSILON", 0.01),
+        )
         model = model.to(self.device)
         return model
 
     def create_transform(self, transforms_list: DictConfig) -> [A.Compose, A.Compose]:
         """Get the loader for training and validation."""
-        image_transforms_list = get_data_transform(transforms_list)
-        mask_transforms_list = image_transforms_list.copy()
-        mask_transforms_list.pop(-2)  # Remove the normalization transform
-        image_transforms = A.Compose(image_transforms_list)
-        mask_transforms = A.Compose(mask_transforms_list)
-
-        return image_transforms, mask_transforms
+        return create_image_and_mask_transforms(transforms_list, self.batched_transforms)
 
     def create_datasets(self, train: bool) -> FolderDataset | MVTecDataset:
         if self.cls_task:
@@ -85,6 +113,8 @@ class Trainer(Base, ABC):
                 self.image_transforms,
                 self.mask_size,
                 train,
+                self.config.DATASETS.get("CACHE_DIR"),
+                self.config.DATASETS.get("REDUCED_DECODE", False),
             )
         else:
             logger.info("Load segmentation dataset.")
@@ -95,33 +125,53 @@ class Trainer(Base, ABC):
                 self.mask_transforms,
                 self.mask_size,
                 train,
+                self.config.DATASETS.get("CACHE_DIR"),
+                self.config.DATASETS.get("REDUCED_DECODE", False),
             )
         return datasets
 
-    def create_dataloader(self, datasets: FolderDataset | MVTecDataset, train: bool):
-        dataloader = torch.utils.data.DataLoader(
+    @staticmethod
+    def split_calibration_datasets(
+            datasets: FolderDataset | MVTecDataset,
+            config: DictConfig,
+    ) -> tuple[torch.utils.data.Dataset, torch.utils.data.Dataset | None]:
+        """Hold out a part of the normal training images for score calibration."""
+        calibration_dict = config.TRAIN.get("CALIBRATION")
+        if not calibration_dict:
+            return datasets, None
+
+        num_calibration = int(round(len(datasets) * calibration_dict.get("HOLDOUT_RATIO", 0.1)))
+        num_calibration = min(max(num_calibration, 1), len(datasets) - 1)
+        generator = torch.Generator().manual_seed(config.get("SEED") or 0)
+        train_datasets, calibration_datasets = torch.utils.data.random_split(
             datasets,
-            batch_size=self.config.TRAIN.HYP.get("IMGS_PER_BATCH") if train else len(datasets),
-            num_workers=4,
-            pin_memory=True,
-            persistent_workers=True,
+            [len(datasets) - num_calibration, num_calibration],
+            generator=generator,
         )
+        logger.info(f"Hold out {num_calibration} normal images for score calibration.")
+        return train_datasets, calibration_datasets
 
-        if self.device == "cuda":
-            dataloader = CUDAPrefetcher(dataloader, self.device)
-        else:
-            dataloader = CPUPrefetcher(dataloader)
+    def create_dataloader(self, datasets: torch.utils.data.Dataset, train: bool):
+        batch_size = self.config.TRAIN.HYP.get("IMGS_PER_BATCH") if train else self.config.VAL.get("IMGS_PER_BATCH")
+        dataloader = create_dataloader(datasets, batch_size, self.device, self.config.get("DATALOADER"))
+
+        if self.batched_transforms:
+            dataloader = BatchTransformLoader(dataloader, *create_batch_transforms(self.config.DATASETS.TRANSFORMS))
 
         return dataloader
 
-    def get_dataloader(self) -> [CPUPrefetcher | CUDAPrefetcher, CPUPrefetcher | CUDAPrefetcher]:
+    def get_dataloader(self) -> [CPUPrefetcher | CUDAPrefetcher, CPUPrefetcher | CUDAPrefetcher, CPUPrefetcher | CUDAPrefetcher | None]:
         train_datasets = self.create_datasets(train=True)
         val_datasets = self.create_datasets(train=False)
+        train_datasets, calibration_datasets = self.split_calibration_datasets(train_datasets, self.config)
 
         train_dataloader = self.create_dataloader(train_datasets, train=True)
         val_dataloader = self.create_dataloader(val_datasets, train=False)
+        calibration_dataloader = None
+        if calibration_datasets is not None:
+            calibration_dataloader = self.create_dataloader(calibration_datasets, train=True)
 
-        return train_dataloader, val_dataloader
+        return train_dataloader, val_dataloader, calibration_dataloader
 
     def get_embeddings(self) -> None:
         """Get features from the backbone network."""
@@ -130,11 +180,14 @@ class Trainer(Base, ABC):
         progress = ProgressMeter(len(self.train_loader), [batch_time, data_time], prefix="Get features ")
 
         end = time.time()
+        data_start_time = time.perf_counter()
         for i, batch_data in enumerate(self.train_loader):
             # measure data loading time
             data_time.update(time.time() - end)
-            image = batch_data["image"].to(self.device, non_blocking=True)
-            embedding = self.model(image)
+            self.profiler.add("train.data", data_start_time, time.perf_counter())
+            with self.profiler.span("train.model"):
+                image = batch_data["image"].to(self.device, non_blocking=True)
+                embedding = self.model(image)
             self.embeddings.append(embedding)
 
             # measure elapsed time
@@ -143,37 +196,108 @@ class Trainer(Base, ABC):
 
             if i % self.config.TRAIN.PRINT_FREQ == 0:
                 progress.display(i + 1)
+            data_start_time = time.perf_counter()
+
+    def fit_pipelined(self) -> None:
+        """Fit the Gaussian while the backbone runs, streaming every batch of embeddings into its running statistics."""
+        batch_time = AverageMeter("Time", ":6.3f")
+        progress = ProgressMeter(len(self.train_loader), [batch_time], prefix="Get features ")
+        gaussian = self.model.multi_variate_gaussian
+
+        def extract_embedding(batch_data: dict[str, Any]) -> Tensor:
+            return self.model(batch_data["image"].to(self.device, non_blocking=True))
+
+        pipeline = Pipeline([("backbone", extract_embedding), ("gaussian", gaussian.update)], self.pipeline_queue_size)
+        end = time.time()
+        for i, _ in enumerate(pipeline.run(self.train_loader)):
+            batch_time.update(time.time() - end)
+            end = time.time()
+            if i % self.config.TRAIN.PRINT_FREQ == 0:
+                progress.display(i + 1)
+
+        logger.info("Applying Gaussian fitting to the accumulated statistics of the training set.")
+        with self.profiler.span("train.gaussian_fit"):
+            self.stats = gaussian.finalize()
+        pipeline.report()
 
     def compute_patch_distribution(self):
         logger.info("Collecting the embeddings from the training set.")
         embeddings = torch.vstack(self.embeddings)
 
         logger.info("Applying Gaussian fitting to the embeddings from the training set.")
-        self.stats = self.model.multi_variate_gaussian.fit(embeddings)
+        with self.profiler.span("train.gaussian_fit"):
+            self.stats = self.model.multi_variate_gaussian.fit(embeddings)
+
+    def calibrate(self) -> None:
+        """Calibrate the score normalization and thresholds on the held-out normal images.
+
+        A single streaming pass feeds the image scores and the pixel scores into quantile sketches, so the memory used does
+        not grow with the number of calibration images.
+        """
+        if self.calibration_loader is None:
+            logger.info("No calibration images configured, skip score calibration.")
+            return
+
+        calibration_dict = self.config.TRAIN.CALIBRATION
+        image_sketch = QuantileSketch(seed=self.config.get("SEED"))
+        pixel_sketch = QuantileSketch(seed=self.config.get("SEED"))
+        score_sketch = QuantileSketch(seed=self.config.get("SEED"))
+        max_score_error = 0.0
+
+        logger.info("Calibrating the anomaly scores on the held-out normal images.")
+        # the pixels outside the region of interest are not scored
+        roi_mask = None if self.model.roi_mask is None else self.model.roi_mask.cpu().numpy()
+        self.model.eval()
+        for batch_data in self.calibration_loader:
+            image = batch_data["image"].to(self.device, non_blocking=True)
+            output = self.model.predict(image, return_maps=True)
+            anomaly_map = output["anomaly_maps"].cpu().numpy()
+            image_scores = anomaly_map.reshape(anomaly_map.shape[0], -1).max(axis=1)
+            scores = output["scores"].cpu().numpy()
+            image_sketch.update(image_scores)
+            pixel_sketch.update(anomaly_map if roi_mask is None else anomaly_map[..., roi_mask])
+            score_sketch.update(scores)
+            max_score_error = max(max_score_error, float(np.abs(scores - image_scores).max()))
+        self.model.train()
+
+        score_normalizer = self.model.score_normalizer
+        score_normalizer.calibrate(
+            pixel_sketch.min,
+            pixel_sketch.max,
+            image_sketch.quantile(calibration_dict.get("IMAGE_QUANTILE", 0.99)),
+            pixel_sketch.quantile(calibration_dict.get("PIXEL_QUANTILE", 0.999)),
+            score_sketch.quantile(calibration_dict.get("IMAGE_QUANTILE", 0.99)),
+        )
+        logger.info(f"Score range: [{pixel_sketch.min:.4f}, {pixel_sketch.max:.4f}], "
+                    f"image threshold: {float(score_normalizer.image_threshold):.4f}, "
+                    f"pixel threshold: {float(score_normalizer.pixel_threshold):.4f}, "
+                    f"score threshold: {float(score_normalizer.score_threshold):.4f}, "
+                    f"max feature resolution score error: {max_score_error:.4f}")
 
     def create_state_dict(self) -> Dict:
-        """Create a state dictionary for saving the model."""
+        """Create a state dictionary for saving the model, the fitted tensors are not copied."""
         state_dict = {
-            "model": deepcopy(self.model),
-            "image_transforms": self.image_transforms,
-            "mask_transforms": self.mask_transforms,
-            "mask_size": self.mask_size,
-            "config": self.config,
+            "manifest": create_manifest(self.model, self.config.DATASETS.TRANSFORMS, self.mask_size),
+            "tensors": get_model_tensors(self.model),
         }
         return state_dict
 
-    def save_checkpoint(self, state_dict: Dict) -> None:
-        """Save the model checkpoint."""
-        logger.info(f"Save the model to '{self.save_weights_path}'. please wait...")
-        torch.save(state_dict, self.save_weights_path)
-        logger.info("Save the model successfully.")
+    def save_checkpoint(self, state_dict: Dict) -> CheckpointWriter:
+        """Save the model checkpoint from a background thread."""
+        logger.info(f"Save the model to '{self.save_weights_path}'.")
+        return CheckpointWriter(self.save_weights_path, state_dict["manifest"], state_dict["tensors"])
 
     def train(self) -> None:
-        self.get_embeddings()
-        self.compute_patch_distribution()
+        if self.pipeline_queue_size is not None:
+            self.fit_pipelined()
+        else:
+            self.get_embeddings()
+            self.compute_patch_distribution()
+        with self.profiler.span("train.calibrate"):
+            self.calibrate()
 
         state_dict = self.create_state_dict()
-        self.save_checkpoint(state_dict)
+        checkpoint_writer = self.save_checkpoint(state_dict)
 
         self.evaler.run_validation(
             self.model,
@@ -181,4 +305,12 @@ class Trainer(Base, ABC):
             self.cls_task,
             self.device,
             self.save_visuals_dir,
+            self.evaler.create_renderer(self.save_visuals_dir),
+            pipeline_queue_size=self.pipeline_queue_size,
         )
+
+        with self.profiler.span("train.save_checkpoint_wait"):
+            checkpoint_writer.wait()
+        logger.info("Save the model successfully.")
+
+        self.profiler.report(self.config.get("PROFILE", {}).get("TRACE_PATH"))
@@ -11,5 +11,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+from .checkpoint import *
 from .module import *
+from .multi_head import *
 from .padim import *
+from .planner import *
+from .registry import *
+from .shared import *
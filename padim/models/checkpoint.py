@@ -0,0 +1,302 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Pickle-free checkpoint format.
+
+A checkpoint is a directory holding two files:
+
+- ``manifest.json``: format version, backbone name and a reference to its pretrained weights, return nodes, mask size,
+  transforms config and the table of tensors (dtype, shape, byte offset).
+- ``tensors.bin``: the raw bytes of the fitted tensors (``index``, ``mean``, ``inv_covariance``, ...), each aligned to
+  64 bytes so that it can be memory-mapped in place.
+
+The backbone weights are not copied, they are loaded from the referenced torchvision weights, unless the checkpoint
+embeds them (see :class:`padim.models.SharedModel`).
+"""
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+from torch import Tensor, nn
+
+from padim.utils.transform import create_image_and_mask_transforms, get_normalize_mean_and_std
+from .module.anomaly_map import DEFAULT_POST_PROCESS_MODE
+from .module.feature_extractor import BACKBONE_WEIGHTS_DICT, FeatureExtractor
+from .module.tiler import Tiler
+from .padim import PaDiM
+
+__all__ = [
+    "FORMAT_VERSION", "CheckpointWriter", "is_checkpoint", "create_manifest", "get_model_tensors", "write_tensors", "read_tensors",
+    "assign_tensors", "save_checkpoint", "load_checkpoint",
+]
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST_FILE_NAME = "manifest.json"
+TENSORS_FILE_NAME = "tensors.bin"
+ALIGNMENT = 64
+BACKBONE_PREFIX = "feature_extractor."
+
+
+def is_checkpoint(path: str | Path) -> bool:
+    """Whether ``path`` is a checkpoint directory of this format."""
+    return Path(path, MANIFEST_FILE_NAME).is_file()
+
+
+def create_manifest(model: PaDiM, transforms_dict: DictConfig | dict, mask_size: tuple[int, int]) -> dict[str, Any]:
+    """Describe everything but the tensors that is needed to rebuild the model and its transforms.
+
+    Args:
+        model (PaDiM): The fitted model.
+        transforms_dict (DictConfig | dict): ``DATASETS.TRANSFORMS`` config.
+        mask_size (tuple[int, int]): The mask size of the model.
+
+    Returns:
+        The manifest, without the tensor table.
+    """
+    if isinstance(transforms_dict, DictConfig):
+        transforms_dict = OmegaConf.to_container(transforms_dict)
+
+    return {
+        "format_version": FORMAT_VERSION,
+        "backbone": {
+            "name": model.backbone,
+            "weights": str(BACKBONE_WEIGHTS_DICT[model.backbone]),
+            "url": BACKBONE_WEIGHTS_DICT[model.backbone].url,
+        },
+        "return_nodes": list(model.return_nodes),
+        "mask_size": list(mask_size),
+        "transforms": transforms_dict,
+        "tiling": None if model.tiler is None else {
+            **model.tiler.get_config(),
+            "gaussian": model.tile_gaussian,
+            "tiles_per_batch": model.tiles_per_batch,
+        },
+        "post_process": model.anomaly_map.post_process_mode,
+        "cascade_rank": model.cascade_rank,
+        "roi": model.roi_mask is not None,
+        "pool_stride": model.pool_stride,
+        "num_features": model.num_features,
+        "covariance_epsilon": model.multi_variate_gaussian.epsilon,
+    }
+
+
+def get_model_tensors(model: PaDiM, include_backbone: bool = False) -> dict[str, Tensor]:
+    """The fitted tensors of the model, i.e. its state without the backbone weights unless ``include_backbone``."""
+    return {
+        name: tensor.detach().cpu() for name, tensor in model.state_dict().items()
+        if include_backbone or not name.startswith(BACKBONE_PREFIX)
+    }
+
+
+def write_tensors(path: str | Path, tensors: dict[str, Tensor]) -> dict[str, dict[str, Any]]:
+    """Write tensors back to back into a flat binary file.
+
+    Args:
+        path (str | Path): Path of the tensor file.
+        tensors (dict[str, Tensor]): Tensors to write.
+
+    Returns:
+        The tensor table: dtype, shape and byte offset of every tensor.
+    """
+    table = {}
+    offset = 0
+    with open(path, "wb") as f:
+        for name, tensor in tensors.items():
+            array = tensor.contiguous().numpy()
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            table[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            f.write(memoryview(array).cast("B"))
+            offset += array.nbytes
+
+    return table
+
+
+def read_tensors(path: str | Path, table: dict[str, dict[str, Any]], mmap: bool = True) -> dict[str, Tensor]:
+    """Read the tensors of a flat binary file.
+
+    Args:
+        path (str | Path): Path of the tensor file.
+        table (dict[str, dict[str, Any]]): Tensor table written by :func:`write_tensors`.
+        mmap (bool, optional): Map the file copy-on-write instead of reading it, the pages are only read when a tensor
+            is used. Defaults to True.
+
+    Returns:
+        The tensors by name.
+    """
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+
+    tensors = {}
+    for name, entry in table.items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=entry["offset"]).reshape(entry["shape"])
+        tensors[name] = torch.from_numpy(array)
+
+    return tensors
+
+
+def save_checkpoint(path: str | Path, manifest: dict[str, Any], tensors: dict[str, Tensor]) -> None:
+    """Write a checkpoint directory. The files are written next to it first and then moved in place.
+
+    Args:
+        path (str | Path): Checkpoint directory.
+        manifest (dict[str, Any]): Manifest created by :func:`create_manifest`.
+        tensors (dict[str, Tensor]): Tensors created by :func:`get_model_tensors`.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    manifest = dict(manifest, tensors=write_tensors(tmp_path / TENSORS_FILE_NAME, tensors))
+    with open(tmp_path / MANIFEST_FILE_NAME, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter(threading.Thread):
+    """Write a checkpoint from a background thread.
+
+    The tensors are written as they are, they must not be modified until :meth:`wait` returns.
+
+    Args:
+        path (str | Path): Checkpoint directory.
+        manifest (dict[str, Any]): Manifest created by :func:`create_manifest`.
+        tensors (dict[str, Tensor]): Tensors created by :func:`get_model_tensors`.
+    """
+
+    def __init__(self, path: str | Path, manifest: dict[str, Any], tensors: dict[str, Tensor]) -> None:
+        super().__init__(name="checkpoint-writer")
+        self.path = path
+        self.manifest = manifest
+        self.tensors = tensors
+        self.exception: BaseException | None = None
+        self.start()
+
+    def run(self) -> None:
+        try:
+            save_checkpoint(self.path, self.manifest, self.tensors)
+        except BaseException as e:
+            self.exception = e
+
+    def wait(self) -> None:
+        """Wait for the checkpoint to be written, re-raise the error of the writer thread if any."""
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+
+def assign_tensors(model: nn.Module, tensors: dict[str, Tensor]) -> None:
+    """Replace the buffers of the model by the tensors of the same name, without copying them.
+
+    Raises:
+        ValueError: If a parameter or buffer is still a meta placeholder afterwards.
+    """
+    for name, tensor in tensors.items():
+        module_name, _, buffer_name = name.rpartition(".")
+        setattr(model.get_submodule(module_name), buffer_name, tensor)
+
+    missing = [name for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise ValueError(f"The checkpoint has no tensors for {missing}")
+
+
+def load_checkpoint(
+        path: str | Path,
+        device: torch.device = torch.device("cpu"),
+        mmap: bool = True,
+        chunk_size: int | None = None,
+        distance_memory_budget: int | None = None,
+) -> dict[str, Any]:
+    """Load a checkpoint directory.
+
+    Args:
+        path (str | Path): Checkpoint directory.
+        device (torch.device, optional): Device of the model. Defaults to CPU, where the fitted tensors stay memory-mapped.
+        mmap (bool, optional): Memory-map the tensor file. Defaults to True.
+        chunk_size (int, optional): Score in chunks of positions. The Gaussian parameters then stay memory-mapped on the
+            host whatever the device and are streamed to it chunk by chunk. Defaults to None.
+        distance_memory_budget (int, optional): Bytes of transient memory of the distance computation. Defaults to None.
+
+    Returns:
+        A dict with the ``model``, ``image_transforms``, ``mask_transforms``, ``mask_size`` and ``manifest``.
+    """
+    path = Path(path)
+    with open(path / MANIFEST_FILE_NAME) as f:
+        manifest = json.load(f)
+
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported checkpoint format version {manifest.get('format_version')}, expected {FORMAT_VERSION}")
+
+    backbone = manifest["backbone"]["name"]
+    if str(BACKBONE_WEIGHTS_DICT[backbone]) != manifest["backbone"]["weights"]:
+        raise ValueError(f"Checkpoint references backbone weights {manifest['backbone']['weights']}, "
+                         f"but {backbone} is loaded with {BACKBONE_WEIGHTS_DICT[backbone]}")
+
+    tensors = read_tensors(path / TENSORS_FILE_NAME, manifest["tensors"], mmap)
+    backbone_tensors = {name[len(BACKBONE_PREFIX):]: tensors.pop(name) for name in list(tensors) if name.startswith(BACKBONE_PREFIX)}
+
+    # an embedded backbone replaces the referenced pretrained weights
+    mask_size = tuple(manifest["mask_size"])
+    normalize_mean, normalize_std = get_normalize_mean_and_std(manifest["transforms"])
+    tiling = manifest.get("tiling")
+    tiling_kwargs = {}
+    if tiling is not None:
+        tiling_kwargs = {
+            "tiler": Tiler(tiling["tile_size"], tiling["stride"], tiling["blend"]),
+            "tile_gaussian": tiling["gaussian"],
+            "tiles_per_batch": tiling["tiles_per_batch"],
+        }
+    # built on the meta device, the placeholders take no memory and are replaced by the mapped tensors
+    with torch.device("meta"):
+        model = PaDiM(backbone, manifest["return_nodes"], False, mask_size, chunk_size, normalize_mean, normalize_std,
+                      post_process=manifest.get("post_process", DEFAULT_POST_PROCESS_MODE), cascade_rank=manifest.get("cascade_rank"),
+                      roi_mask=torch.ones(mask_size, dtype=torch.bool) if manifest.get("roi") else None,
+                      distance_memory_budget=distance_memory_budget, pool_stride=manifest.get("pool_stride", 1),
+                      num_features=manifest.get("num_features"), covariance_epsilon=manifest.get("covariance_epsilon", 0.01),
+                      **tiling_kwargs)
+    if backbone_tensors:
+        model.feature_extractor.load_state_dict(backbone_tensors, assign=True)
+    else:
+        model.feature_extractor = FeatureExtractor(backbone, manifest["return_nodes"])
+    assign_tensors(model, tensors)
+    model = model.place(device)
+
+    image_transforms, mask_transforms = create_image_and_mask_transforms(manifest["transforms"])
+
+    return {
+        "model": model,
+        "image_transforms": image_transforms,
+        "mask_transforms": mask_transforms,
+        "mask_size": mask_size,
+        "manifest": manifest,
+    }
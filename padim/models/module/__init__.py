@@ -11,6 +11,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
-from .anomaly_map import AnomalyMap
-from .feature_extractor import FeatureExtractor
+from .anomaly_map import AnomalyMap, DEFAULT_POST_PROCESS_MODE, POST_PROCESS_MODES
+from .cascade import CascadedScorer
+from .feature_extractor import FeatureExtractor, get_feature_shapes
 from .multi_variate_gaussian import MultiVariateGaussian
+from .roi import create_roi_mask, get_roi_index
+from .score_normalizer import ScoreNormalizer
+from .tiler import Tiler
@@ -14,23 +14,116 @@
 """
 Modified from 'https://github.com/openvinotoolkit/anomalib/blob/main/src/anomalib/models/padim/anomaly_map.py'
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from omegaconf import ListConfig
 from torch import nn, Tensor
 from torch.nn import functional as F_torch
 from torchvision.transforms import GaussianBlur
 
+from padim.utils.profiler import get_profiler
+
 __all__ = [
-    "AnomalyMap",
+    "AnomalyMap", "DEFAULT_POST_PROCESS_MODE", "POST_PROCESS_MODES",
 ]
 
+POST_PROCESS_MODES = ["reference", "fused", "low_res"]
+DEFAULT_POST_PROCESS_MODE = "fused"
+# (positions, batch, channels) tensors alive while a tile is scored: the deviations, their product with the inverse
+# covariance and the deviations gathered from the embedding
+DISTANCE_TRANSIENT_COPIES = 3
+
+
+def get_gaussian_kernel1d(sigma: float) -> Tensor:
+    """The 1D kernel of :class:`torchvision.transforms.GaussianBlur`, truncated at 4 sigma."""
+    kernel_size = 2 * int(4.0 * sigma + 0.5) + 1
+    half_size = (kernel_size - 1) * 0.5
+    x = torch.linspace(-half_size, half_size, steps=kernel_size, dtype=torch.float64)
+    pdf = torch.exp(-0.5 * (x / sigma).pow(2))
+    return pdf / pdf.sum()
+
+
+def get_blur_matrix(length: int, sigma: float) -> Tensor:
+    """(length, length) matrix of a 1D Gaussian blur with reflect padding."""
+    kernel = get_gaussian_kernel1d(sigma)
+    radius = len(kernel) // 2
+    matrix = torch.zeros(length, length, dtype=torch.float64)
+    for i in range(length):
+        for t, weight in enumerate(kernel):
+            j = i + t - radius
+            # reflect without repeating the border, as torch.nn.functional.pad(mode="reflect")
+            while j < 0 or j >= length:
+                j = -j if j < 0 else 2 * (length - 1) - j
+                if length == 1:
+                    j = 0
+            matrix[i, j] += weight
+    return matrix
+
+
+def get_bilinear_matrix(output_length: int, input_length: int) -> Tensor:
+    """(output length, input length) matrix of a 1D bilinear resize with ``align_corners=False``."""
+    matrix = torch.zeros(output_length, input_length, dtype=torch.float64)
+    scale = input_length / output_length
+    for o in range(output_length):
+        source = max(scale * (o + 0.5) - 0.5, 0.0)
+        i0 = int(source)
+        i1 = i0 + 1 if i0 < input_length - 1 else i0
+        weight = source - i0
+        matrix[o, i0] += 1 - weight
+        matrix[o, i1] += weight
+    return matrix
+
 
 class AnomalyMap(nn.Module):
-    def __init__(self, image_size: ListConfig | tuple, sigma: float = 4.0):
+    r"""Score embeddings against the Gaussian and post-process the distance map into an anomaly map.
+
+    The post-processing upsamples the distance map to the image size and smooths it with a Gaussian blur. Both are
+    linear and separable, so they are applied per axis as small matrices, the modes differ in the order:
+
+    - "reference": bilinear upsampling, then the 2D ``GaussianBlur`` at full resolution.
+    - "fused": the blur matrix times the upsampling matrix, one matmul per axis. It equals "reference" up to float
+      rounding.
+    - "low_res": the blur at feature resolution with sigma scaled by the size ratio, then the upsampling. It is an
+      approximation, the blur no longer spreads scores across the borders of the upsampled pixels the same way.
+
+    The image score, the maximum of the anomaly map, can be computed without the map by :meth:`compute_image_score`. It
+    smooths the distance map at feature resolution like "low_res" and skips the upsampling. It relates to the score of
+    the full map as follows:
+
+    - "low_res": the full map score is at most the feature resolution score, the upsampling only averages neighbouring
+      values. The two are equal when the maximum falls on a feature position.
+    - "fused" and "reference": the scores differ by the approximation of "low_res", in either direction.
+    - any mode: the full map score is at most the maximum distance, see :meth:`compute_score_bound`.
+
+    Args:
+        image_size (ListConfig | tuple): anomaly map size.
+        sigma (float, optional): Gaussian blur sigma at image resolution. Defaults to 4.0.
+        chunk_size (int, optional): score the positions in chunks of this size. Defaults to None.
+        post_process_mode (str, optional): one of :data:`POST_PROCESS_MODES`. Defaults to "fused".
+        memory_budget (int, optional): bytes of transient memory of the distance computation, the positions and the
+            batch are scored in tiles that fit. Defaults to None (all at once).
+    """
+
+    def __init__(
+            self,
+            image_size: ListConfig | tuple,
+            sigma: float = 4.0,
+            chunk_size: int | None = None,
+            post_process_mode: str = DEFAULT_POST_PROCESS_MODE,
+            memory_budget: int | None = None,
+    ):
         super().__init__()
+        if post_process_mode not in POST_PROCESS_MODES:
+            raise ValueError(f"Post process mode '{post_process_mode}' not supported. Choices: {POST_PROCESS_MODES}")
         self.image_size = image_size if isinstance(image_size, tuple) else tuple(image_size)
+        self.sigma = sigma
+        self.chunk_size = chunk_size
+        self.post_process_mode = post_process_mode
+        self.memory_budget = memory_budget
         kernel_size = 2 * int(4.0 * sigma + 0.5) + 1
         self.blur = GaussianBlur(kernel_size=kernel_size, sigma=(sigma, sigma))
+        self.matrices: dict[tuple, tuple[Tensor, Tensor]] = {}
 
     @staticmethod
     def compute_distance(embedding: Tensor, stats: list[Tensor]) -> Tensor:
@@ -55,17 +148,204 @@ class AnomalyMap(nn.Module):
 
         return distances
 
-    def forward(self, embedding: Tensor, mean: Tensor, inv_covariance: Tensor) -> Tensor:
-        mean = mean.to(embedding.device)
-        inv_covariance = inv_covariance.to(embedding.device)
-
-        anomaly_map = self.compute_distance(embedding, [mean, inv_covariance])
-        anomaly_map = F_torch.interpolate(
-            anomaly_map,
-            size=self.image_size,
-            mode="bilinear",
-            align_corners=False,
-        )
-        anomaly_map = self.blur(anomaly_map)
+    @staticmethod
+    def get_tile_sizes(batch: int, channel: int, num_positions: int, memory_budget: int, element_size: int) -> tuple[int, int]:
+        """The largest batch tile, then the largest position tile, whose transient tensors fit in ``memory_budget``
+        bytes. At least one image and one position are scored at a time, whatever the budget."""
+        max_elements = max(memory_budget // (DISTANCE_TRANSIENT_COPIES * channel * element_size), 1)
+        batch_tile = min(batch, max_elements)
+        position_tile = max(min(num_positions, max_elements // batch_tile), 1)
+        return batch_tile, position_tile
+
+    @staticmethod
+    def score_tiles(embedding: Tensor, mean: Tensor, inv_covariance: Tensor, output: Tensor, batch_tile: int, position_tile: int) -> None:
+        """Write the squared distances of (B, C, P) embeddings into the (B, P) ``output``, a tile of images and positions
+        at a time."""
+        batch, _, num_positions = embedding.shape
+        for position_start in range(0, num_positions, position_tile):
+            position_end = min(position_start + position_tile, num_positions)
+            tile_mean = mean[:, position_start:position_end].T.unsqueeze(2)
+            tile_inv_covariance = inv_covariance[position_start:position_end]
+            for batch_start in range(0, batch, batch_tile):
+                batch_end = min(batch_start + batch_tile, batch)
+                # (P, B, C) deviations, gathered from the embedding once
+                delta = embedding[batch_start:batch_end, :, position_start:position_end].permute(2, 1, 0) - tile_mean
+                delta = delta.transpose(1, 2).contiguous()
+                product = torch.matmul(delta, tile_inv_covariance).mul_(delta)
+                output[batch_start:batch_end, position_start:position_end].copy_(product.sum(2).T)
+
+    def compute_distance_budgeted(self, embedding: Tensor, stats: list[Tensor]) -> Tensor:
+        r"""Compute the anomaly score like :meth:`compute_distance`, in tiles of images and positions that keep the
+        transient tensors within ``memory_budget`` bytes, written directly into the output.
+
+        Args:
+            embedding (Tensor): Embedding Vector
+            stats (list[Tensor]): Mean and Covariance Matrix of the multivariate Gaussian distribution
+
+        Returns:
+            Anomaly score of a test image via mahalanobis distance.
+        """
+        batch, channel, height, width = embedding.shape
+        num_positions = height * width
+        mean, inv_covariance = stats
+        distances = torch.empty(batch, 1, height, width, dtype=embedding.dtype, device=embedding.device)
+        batch_tile, position_tile = self.get_tile_sizes(batch, channel, num_positions, self.memory_budget, embedding.element_size())
+        self.score_tiles(embedding.reshape(batch, channel, num_positions),
+                         mean,
+                         inv_covariance,
+                         distances.view(batch, num_positions),
+                         batch_tile,
+                         position_tile)
+        return distances.clamp_(0).sqrt_()
+
+    def compute_distance_chunked(self, embedding: Tensor, stats: list[Tensor], chunk_size: int) -> Tensor:
+        r"""Compute the anomaly score like :meth:`compute_distance`, streaming the statistics in chunks of positions.
+
+        The statistics may live anywhere, e.g. memory-mapped from a checkpoint on the host. While a chunk is scored, the
+        next one is read and moved to the embedding device by a background thread, so only two chunks are resident.
+
+        Args:
+            embedding (Tensor): Embedding Vector
+            stats (list[Tensor]): Mean and Covariance Matrix of the multivariate Gaussian distribution
+            chunk_size (int): Number of positions per chunk.
+
+        Returns:
+            Anomaly score of a test image via mahalanobis distance.
+        """
+        batch, channel, height, width = embedding.shape
+        num_positions = height * width
+        embedding = embedding.reshape(batch, channel, num_positions)
+        mean, inv_covariance = stats
+        distances = torch.empty(batch, num_positions, dtype=embedding.dtype, device=embedding.device)
+
+        def load_chunk(start: int) -> tuple[Tensor, Tensor]:
+            end = min(start + chunk_size, num_positions)
+            # copy so that the pages of a memory-mapped file are read here and not in the scoring thread
+            return mean[:, start:end].to(embedding.device, copy=True), inv_covariance[start:end].to(embedding.device, copy=True)
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch-stats") as executor:
+            future = executor.submit(load_chunk, 0)
+            for start in range(0, num_positions, chunk_size):
+                chunk_mean, chunk_inv_covariance = future.result()
+                if start + chunk_size < num_positions:
+                    future = executor.submit(load_chunk, start + chunk_size)
+
+                if self.memory_budget is not None:
+                    chunk_embedding = embedding[:, :, start:start + chunk_size]
+                    batch_tile, position_tile = self.get_tile_sizes(batch, channel, chunk_embedding.shape[-1],
+                                                                    self.memory_budget, embedding.element_size())
+                    self.score_tiles(chunk_embedding, chunk_mean, chunk_inv_covariance, distances[:, start:start + chunk_size],
+                                     batch_tile, position_tile)
+                    continue
+
+                delta = (embedding[:, :, start:start + chunk_size] - chunk_mean).permute(2, 0, 1)
+                distances[:, start:start + chunk_size] = (torch.matmul(delta, chunk_inv_covariance) * delta).sum(2).permute(1, 0)
+
+        distances = distances.reshape(batch, 1, height, width)
+        distances = distances.clamp(0).sqrt()
+
+        return distances
+
+    @staticmethod
+    def select_positions(embedding: Tensor, index: Tensor) -> Tensor:
+        """The (B, C, K, 1) embedding of the positions at the flat ``index`` of a (B, C, H, W) embedding."""
+        return embedding.flatten(2).index_select(2, index.to(embedding.device)).unsqueeze(-1)
+
+    @staticmethod
+    def scatter_positions(values: Tensor, index: Tensor, size: tuple[int, int]) -> Tensor:
+        """Place (B, 1, K, 1) values of the positions at ``index`` in a (B, 1, H, W) map of zeros."""
+        output = values.new_zeros(values.shape[0], 1, size[0] * size[1])
+        output.index_copy_(2, index.to(values.device), values.flatten(2))
+        return output.reshape(values.shape[0], 1, *size)
+
+    def compute_anomaly_distance(
+            self,
+            embedding: Tensor,
+            mean: Tensor,
+            inv_covariance: Tensor,
+            roi_index: Tensor | None = None,
+    ) -> Tensor:
+        """Mahalanobis distance map at embedding resolution, in chunks of positions if ``chunk_size`` is set. With a
+        ``roi_index`` only those positions are scored, the Gaussian holds only them, and the others are zero."""
+        if roi_index is not None:
+            distances = self.compute_anomaly_distance(self.select_positions(embedding, roi_index), mean, inv_covariance)
+            return self.scatter_positions(distances, roi_index, tuple(embedding.shape[-2:]))
+
+        with get_profiler().span("anomaly_map.compute_distance"):
+            if self.chunk_size is None:
+                mean = mean.to(embedding.device)
+                inv_covariance = inv_covariance.to(embedding.device)
+                if self.memory_budget is not None:
+                    return self.compute_distance_budgeted(embedding, [mean, inv_covariance])
+                return self.compute_distance(embedding, [mean, inv_covariance])
+            return self.compute_distance_chunked(embedding, [mean, inv_covariance], self.chunk_size)
+
+    def forward(self, embedding: Tensor, mean: Tensor, inv_covariance: Tensor, roi_index: Tensor | None = None) -> Tensor:
+        anomaly_map = self.compute_anomaly_distance(embedding, mean, inv_covariance, roi_index)
+        return self.post_process(anomaly_map)
+
+    def get_post_process_matrices(self, map_size: tuple[int, int], device: torch.device, dtype: torch.dtype) -> tuple[Tensor, Tensor]:
+        """Row and column matrices of the upsampling and the blur, built once per map size and device."""
+        key = (map_size, device, dtype, self.post_process_mode)
+        if key not in self.matrices:
+            matrices = []
+            for input_length, output_length in zip(map_size, self.image_size):
+                upsample = get_bilinear_matrix(output_length, input_length)
+                if self.post_process_mode == "fused":
+                    matrix = get_blur_matrix(output_length, self.sigma) @ upsample
+                else:
+                    matrix = upsample @ get_blur_matrix(input_length, self.sigma * input_length / output_length)
+                matrices.append(matrix.to(device=device, dtype=dtype))
+            self.matrices[key] = (matrices[0], matrices[1].T.contiguous())
+        return self.matrices[key]
+
+    def get_score_matrices(self, map_size: tuple[int, int], device: torch.device, dtype: torch.dtype) -> tuple[Tensor, Tensor]:
+        """Row and column matrices of the blur at feature resolution, with sigma scaled to the feature map."""
+        key = (map_size, device, dtype, "score")
+        if key not in self.matrices:
+            matrices = [get_blur_matrix(input_length, self.sigma * input_length / output_length).to(device=device, dtype=dtype)
+                        for input_length, output_length in zip(map_size, self.image_size)]
+            self.matrices[key] = (matrices[0], matrices[1].T.contiguous())
+        return self.matrices[key]
+
+    def compute_image_score(self, distances: Tensor) -> Tensor:
+        """Image scores of (B, 1, h, w) distance maps, smoothed at feature resolution without building the full map.
+
+        Args:
+            distances (Tensor): Distance maps from :meth:`compute_anomaly_distance`.
+
+        Returns:
+            The (B,) image scores in the units of the anomaly map.
+        """
+        with get_profiler().span("anomaly_map.image_score"):
+            row_matrix, column_matrix = self.get_score_matrices(tuple(distances.shape[-2:]), distances.device, distances.dtype)
+            smoothed = torch.matmul(torch.matmul(row_matrix, distances), column_matrix)
+            return smoothed.flatten(1).amax(1)
+
+    @staticmethod
+    def compute_score_bound(distances: Tensor) -> Tensor:
+        """Upper bound of the full map image score in every post-processing mode, the upsampling and the blur only take
+        weighted averages of the distances."""
+        return distances.flatten(1).amax(1)
+
+    def post_process(self, anomaly_map: Tensor) -> Tensor:
+        """Upsample a distance map to the image size and smooth it."""
+        profiler = get_profiler()
+        if self.post_process_mode != "reference":
+            with profiler.span("anomaly_map.post_process"):
+                row_matrix, column_matrix = self.get_post_process_matrices(tuple(anomaly_map.shape[-2:]),
+                                                                           anomaly_map.device,
+                                                                           anomaly_map.dtype)
+                return torch.matmul(torch.matmul(row_matrix, anomaly_map), column_matrix)
+
+        with profiler.span("anomaly_map.interpolate"):
+            anomaly_map = F_torch.interpolate(
+                anomaly_map,
+                size=self.image_size,
+                mode="bilinear",
+                align_corners=False,
+            )
+        with profiler.span("anomaly_map.gaussian_blur"):
+            anomaly_map = self.blur(anomaly_map)
 
         return anomaly_map
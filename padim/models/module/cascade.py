@@ -0,0 +1,119 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import torch
+from torch import Tensor
+
+from padim.utils.profiler import get_profiler
+
+__all__ = [
+    "CascadedScorer",
+]
+
+
+class CascadedScorer:
+    r"""Upper bounds of the Mahalanobis distances that prune clearly normal images before the exact scoring.
+
+    The inverse covariance of every position is split into its ``rank`` smallest eigenvalues, the directions of largest
+    variance where the deviations of the embeddings concentrate, and the rest bounded by the largest eigenvalue:
+
+    .. math::
+        d^2 = \sum_{i \le k} \lambda_i (v_i^T \delta)^2 + \sum_{i > k} \lambda_i (v_i^T \delta)^2
+            \le \sum_{i \le k} \lambda_i (v_i^T \delta)^2 + \lambda_{max} (\|\delta\|^2 - \sum_{i \le k} (v_i^T \delta)^2)
+
+    The bound costs about ``rank`` instead of ``C`` multiply-adds per channel and position. It is exact when the other
+    eigenvalues all equal the largest one, as for Gaussians fitted on at most ``rank`` images, whose remaining
+    eigenvalues are those of the regularization. The image score is a positive weighted average of the distances, so the
+    score of the bounds bounds the image score and an image whose bound is below the threshold needs no exact distances.
+    The candidates are scored as a smaller batch, their scores and maps match those of the full batch up to float rounding
+    (a few 1e-5 absolute), since the matmul kernels depend on the number of rows.
+    The scorer is built from the fitted Gaussian and not stored in the checkpoint.
+
+    Args:
+        mean (Tensor): (C, P) Gaussian means.
+        inv_covariance (Tensor): (P, C, C) inverse covariances.
+        rank (int): Number of eigenvalues kept per position.
+        margin (float, optional): Relative margin added to the squared bounds against float rounding. Defaults to 1e-3.
+        chunk_size (int, optional): Positions per eigendecomposition, bounds the memory of building. Defaults to 256.
+
+    Examples:
+        >>> scorer = CascadedScorer(gaussian.mean, gaussian.inv_covariance, rank=16)
+        >>> bounds = scorer.compute_bound(embedding)
+        >>> candidates = scorer.select_candidates(bounds.flatten(1).amax(1), threshold)
+    """
+
+    def __init__(self, mean: Tensor, inv_covariance: Tensor, rank: int, margin: float = 1e-3, chunk_size: int = 256) -> None:
+        num_features, num_positions = mean.shape
+        if not 0 < rank < num_features:
+            raise ValueError(f"Cascade rank must be in [1, {num_features - 1}], got {rank}")
+
+        self.rank = rank
+        self.margin = margin
+        self.mean = mean
+        self.vectors = torch.empty(num_positions, rank, num_features, dtype=mean.dtype, device=mean.device)
+        self.head_eigenvalues = torch.empty(num_positions, rank, dtype=mean.dtype, device=mean.device)
+        self.tail_eigenvalues = torch.empty(num_positions, dtype=mean.dtype, device=mean.device)
+        for start in range(0, num_positions, chunk_size):
+            end = min(start + chunk_size, num_positions)
+            # ascending eigenvalues, in double precision for a tight bound
+            eigenvalues, eigenvectors = torch.linalg.eigh(inv_covariance[start:end].to(mean.device, torch.float64))
+            eigenvalues = eigenvalues.clamp(min=0)
+            self.vectors[start:end] = eigenvectors[..., :rank].transpose(1, 2).to(mean.dtype)
+            self.head_eigenvalues[start:end] = eigenvalues[..., :rank].to(mean.dtype)
+            self.tail_eigenvalues[start:end] = eigenvalues[..., -1].to(mean.dtype)
+
+        self.reset()
+
+    def reset(self) -> None:
+        """Reset the work counters."""
+        self.num_images = 0
+        self.num_candidates = 0
+
+    def compute_bound(self, embedding: Tensor) -> Tensor:
+        """Upper bounds of the Mahalanobis distances of (B, C, H, W) embeddings, returned as (B, 1, H, W)."""
+        with get_profiler().span("cascade.compute_bound"):
+            batch, channel, height, width = embedding.shape
+            delta = embedding.reshape(batch, channel, height * width) - self.mean.to(embedding.device)
+            # (P, rank, C) @ (P, C, B), the deviations are not copied into position-major order
+            projections = torch.bmm(self.vectors.to(embedding.device), delta.permute(2, 1, 0)).pow(2)
+            head = (projections * self.head_eigenvalues.to(embedding.device).unsqueeze(2)).sum(1)
+            residual = (delta.pow(2).sum(1).T - projections.sum(1)).clamp(0)
+            bounds = (head + residual * self.tail_eigenvalues.to(embedding.device).unsqueeze(1)) * (1 + self.margin)
+            return bounds.T.reshape(batch, 1, height, width).sqrt()
+
+    def select_candidates(self, score_bounds: Tensor, threshold: float) -> Tensor:
+        """Indices of the images whose (B,) score bounds reach ``threshold``, counted in the work report."""
+        candidates = torch.nonzero(score_bounds >= threshold).flatten()
+        self.num_images += len(score_bounds)
+        self.num_candidates += len(candidates)
+        return candidates
+
+    def report(self) -> dict[str, float]:
+        """Work of the cascade since the last reset, in multiply-adds of the distance computation.
+
+        Returns:
+            The number of ``images``, of exactly scored ``candidates``, the ``exact_work`` without the cascade, the
+            ``cascade_work`` with it and the ``work_saved`` fraction.
+        """
+        num_features, num_positions = self.mean.shape
+        exact_work = (num_features * num_features + num_features) * num_positions
+        bound_work = (num_features * self.rank + 2 * num_features + 2 * self.rank) * num_positions
+        cascade_work = self.num_images * bound_work + self.num_candidates * exact_work
+        total_exact_work = self.num_images * exact_work
+        return {
+            "images": self.num_images,
+            "candidates": self.num_candidates,
+            "exact_work": total_exact_work,
+            "cascade_work": cascade_work,
+            "work_saved": 1 - cascade_work / total_exact_work if total_exact_work else 0.0,
+        }
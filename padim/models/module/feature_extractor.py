@@ -11,13 +11,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+from functools import lru_cache
+
 import torch
 from torch import nn, Tensor
 from torchvision import models
 from torchvision.models.feature_extraction import create_feature_extractor
 
 __all__ = [
-    "FeatureExtractor",
+    "FeatureExtractor", "get_feature_shapes",
 ]
 
 BACKBONE_WEIGHTS_DICT = {
@@ -69,3 +71,26 @@ class FeatureExtractor(nn.Module):
 
     def forward(self, x: Tensor) -> Tensor:
         return self.feature_extractor(x)
+
+
+@lru_cache(maxsize=None)
+def _get_feature_shapes(backbone: str, return_nodes: tuple[str, ...], input_size: tuple[int, int]) -> dict[str, tuple[int, ...]]:
+    with torch.device("meta"):
+        feature_extractor = FeatureExtractor(backbone, list(return_nodes), pretrained=False)
+    with torch.no_grad():
+        features = feature_extractor(torch.empty(1, 3, *input_size, device="meta"))
+    return {name: tuple(feature.shape[1:]) for name, feature in features.items()}
+
+
+def get_feature_shapes(backbone: str, return_nodes: list[str], input_size: tuple[int, int] = (224, 224)) -> dict[str, tuple[int, ...]]:
+    """(C, H, W) shapes of the features of the return nodes, traced on the meta device without weights or compute.
+
+    Args:
+        backbone (str): The backbone name.
+        return_nodes (list[str]): Nodes of the backbone.
+        input_size (tuple[int, int], optional): Input image size. Defaults to (224, 224).
+
+    Returns:
+        The feature shape of every return node.
+    """
+    return dict(_get_feature_shapes(backbone, tuple(return_nodes), tuple(input_size)))
@@ -25,18 +25,36 @@ __all__ = [
 
 
 class MultiVariateGaussian(nn.Module):
-    """Multi Variate Gaussian Distribution."""
+    """Multi Variate Gaussian Distribution.
 
-    def __init__(self, num_features: int, max_features: int):
+    Args:
+        num_features (int): Channels of the embedding.
+        max_features (int): Channels the embedding is selected from, at least ``num_features``.
+        epsilon (float, optional): Added to the diagonal of every covariance before inverting it. Defaults to 0.01.
+
+    Until it is fitted, the (C, P) mean and the (P, C, C) inverse covariance have no positions, P = 0. They take no
+    memory and are replaced by the fitted or the loaded tensors.
+    """
+
+    def __init__(self, num_features: int, max_features: int, epsilon: float = 0.01):
         super().__init__()
+        if num_features > max_features:
+            raise ValueError(f"Cannot select {num_features} of {max_features} channels")
+        self.epsilon = epsilon
 
-        self.register_buffer("mean", torch.zeros(num_features, max_features))
-        self.register_buffer("inv_covariance", torch.eye(num_features).unsqueeze(0).repeat(max_features, 1, 1))
+        self.register_buffer("mean", torch.zeros(num_features, 0))
+        self.register_buffer("inv_covariance", torch.zeros(0, num_features, num_features))
         self.register_buffer("identity", torch.eye(num_features))
 
         self.mean: Tensor
         self.inv_covariance: Tensor
 
+        # running statistics of update(), not part of the state dict
+        self.count = 0
+        self.shift: Tensor | None = None
+        self.shifted_sum: Tensor | None = None
+        self.shifted_outer_sum: Tensor | None = None
+
     @staticmethod
     def _cov(
             observations: Tensor,
@@ -136,13 +154,57 @@ class MultiVariateGaussian(nn.Module):
         self.mean = torch.mean(embedding_vectors, dim=0)
         covariance = torch.zeros(size=(channel, channel, height * width), device=device)
         for i in range(height * width):
-            covariance[:, :, i] = self._cov(embedding_vectors[:, :, i], rowvar=False) + 0.01 * self.identity
+            covariance[:, :, i] = self._cov(embedding_vectors[:, :, i], rowvar=False) + self.epsilon * self.identity
 
         # calculate inverse covariance as we need only the inverse
         self.inv_covariance = torch.linalg.inv(covariance.permute(2, 0, 1))
 
         return [self.mean, self.inv_covariance]
 
+    def update(self, embedding: Tensor) -> None:
+        """Accumulate the statistics of a batch of embeddings, fit the Gaussian with :meth:`finalize` after the last batch.
+
+        Only the sums are kept, so the memory does not grow with the number of images and the accumulation of a batch can
+        overlap with the backbone of the next one. The sums are taken around the mean of the first batch, which keeps the
+        float32 covariance as accurate as the two-pass estimate of :meth:`fit`.
+
+        Args:
+            embedding (Tensor): Embedding vector extracted from CNN, (B, C, H, W).
+        """
+        batch, channel, height, width = embedding.size()
+        embedding_vectors = embedding.reshape(batch, channel, height * width)
+        if self.shift is None:
+            self.shift = embedding_vectors.mean(dim=0)
+            self.shifted_sum = torch.zeros_like(self.shift)
+            self.shifted_outer_sum = torch.zeros(height * width, channel, channel, device=embedding.device)
+
+        # (P, B, C) deviations, their outer products summed over the batch per position
+        deviations = (embedding_vectors - self.shift).permute(2, 0, 1)
+        self.shifted_sum += deviations.sum(dim=1).T
+        self.shifted_outer_sum.baddbmm_(deviations.transpose(1, 2), deviations)
+        self.count += batch
+
+    def finalize(self) -> list[Tensor]:
+        """Fit the Gaussian to the embeddings accumulated by :meth:`update` and reset the running statistics.
+
+        Returns:
+            Mean and the inverse covariance of the embeddings.
+        """
+        if self.count < 2:
+            raise ValueError(f"At least 2 embeddings are needed to estimate the covariance, got {self.count}")
+
+        mean_deviation = self.shifted_sum / self.count
+        self.mean = self.shift + mean_deviation
+        # sum of (x - mean)(x - mean)^T = sum of (x - shift)(x - shift)^T - n (mean - shift)(mean - shift)^T
+        deviation = mean_deviation.T.unsqueeze(2)
+        covariance = self.shifted_outer_sum.baddbmm_(deviation, deviation.transpose(1, 2), alpha=-self.count)
+        covariance = covariance.div_(self.count - 1) + self.epsilon * self.identity
+        self.inv_covariance = torch.linalg.inv(covariance)
+
+        self.count = 0
+        self.shift = self.shifted_sum = self.shifted_outer_sum = None
+        return [self.mean, self.inv_covariance]
+
     def fit(self, embedding: Tensor) -> list[Tensor]:
         """Fit multi-variate gaussian distribution to the input embedding.
 
@@ -0,0 +1,83 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+from pathlib import Path
+
+import cv2
+import torch
+from omegaconf import ListConfig
+from torch import Tensor
+from torch.nn import functional as F_torch
+
+__all__ = [
+    "create_roi_mask", "get_roi_index",
+]
+
+
+def create_roi_mask(
+        mask_size: tuple[int, int],
+        boxes: ListConfig | list[list[int]] | None = None,
+        mask_path: str | Path | None = None,
+) -> Tensor | None:
+    """Create the region of interest of a model in input image coordinates, i.e. after resizing and cropping.
+
+    Args:
+        mask_size (tuple[int, int]): Model input size.
+        boxes (ListConfig | list[list[int]], optional): ``[x_min, y_min, x_max, y_max]`` boxes of inspected pixels, the
+            maximum excluded. Defaults to None.
+        mask_path (str | Path, optional): Mask image whose non-zero pixels are inspected, resized to the input size.
+            Defaults to None.
+
+    Returns:
+        A (H, W) bool mask, the union of the boxes and the mask image, or None if neither is given.
+
+    Examples:
+        >>> roi_mask = create_roi_mask((224, 224), boxes=[[32, 16, 192, 208]])
+        >>> float(roi_mask.float().mean())
+            0.5102...
+    """
+    if not boxes and mask_path is None:
+        return None
+
+    height, width = mask_size
+    roi_mask = torch.zeros(height, width, dtype=torch.bool)
+    for box in boxes or []:
+        if len(box) != 4:
+            raise ValueError(f"ROI boxes are [x_min, y_min, x_max, y_max], got {list(box)}")
+        x_min, y_min, x_max, y_max = box
+        roi_mask[max(y_min, 0):min(y_max, height), max(x_min, 0):min(x_max, width)] = True
+
+    if mask_path is not None:
+        image = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise FileNotFoundError(f"ROI mask '{mask_path}' not found")
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_NEAREST)
+        roi_mask |= torch.from_numpy(image > 0)
+
+    if not roi_mask.any():
+        raise ValueError("The region of interest is empty")
+    return roi_mask
+
+
+def get_roi_index(roi_mask: Tensor, feature_size: tuple[int, int]) -> Tensor:
+    """Flat indices of the feature positions whose cell of the input overlaps the region of interest.
+
+    Args:
+        roi_mask (Tensor): (H, W) bool mask from :func:`create_roi_mask`.
+        feature_size (tuple[int, int]): Size of the embedding.
+
+    Returns:
+        The sorted (K,) indices into the ``h * w`` positions.
+    """
+    cells = F_torch.adaptive_max_pool2d(roi_mask[None, None].float(), tuple(feature_size))
+    return torch.nonzero(cells.flatten()).flatten()
@@ -0,0 +1,104 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import torch
+from torch import nn, Tensor
+
+__all__ = [
+    "ScoreNormalizer",
+]
+
+
+class ScoreNormalizer(nn.Module):
+    """Fixed min-max normalization of anomaly scores and the image and pixel thresholds.
+
+    The constants are calibrated once on held-out normal images at the end of training and stored with the model, so the
+    normalized score of an image does not depend on the other images it is evaluated with. The score threshold is the
+    image threshold for the image scores computed at feature resolution by :meth:`PaDiM.predict`.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.register_buffer("min_score", torch.tensor(float("nan")))
+        self.register_buffer("max_score", torch.tensor(float("nan")))
+        self.register_buffer("image_threshold", torch.tensor(float("nan")))
+        self.register_buffer("pixel_threshold", torch.tensor(float("nan")))
+        self.register_buffer("score_threshold", torch.tensor(float("nan")))
+
+        self.min_score: Tensor
+        self.max_score: Tensor
+        self.image_threshold: Tensor
+        self.pixel_threshold: Tensor
+        self.score_threshold: Tensor
+
+    @property
+    def calibrated(self) -> bool:
+        return not bool(torch.isnan(self.min_score))
+
+    def calibrate(
+            self,
+            min_score: float,
+            max_score: float,
+            image_threshold: float,
+            pixel_threshold: float,
+            score_threshold: float | None = None,
+    ) -> None:
+        """Store the normalization constants and thresholds, all in raw anomaly score units.
+
+        Args:
+            min_score (float): Score mapped to 0.
+            max_score (float): Score mapped to 1.
+            image_threshold (float): Image-level decision threshold.
+            pixel_threshold (float): Pixel-level decision threshold.
+            score_threshold (float, optional): Image-level decision threshold of the feature resolution image scores.
+                Defaults to None, the image threshold is used instead.
+        """
+        if max_score <= min_score:
+            raise ValueError(f"max_score ({max_score}) must be greater than min_score ({min_score})")
+
+        self.min_score.fill_(min_score)
+        self.max_score.fill_(max_score)
+        self.image_threshold.fill_(image_threshold)
+        self.pixel_threshold.fill_(pixel_threshold)
+        self.score_threshold.fill_(image_threshold if score_threshold is None else score_threshold)
+
+    def forward(self, scores: Tensor) -> Tensor:
+        """Normalize raw anomaly scores. Anomalous scores may exceed 1, they are not clipped.
+
+        Args:
+            scores (Tensor): Raw anomaly scores of any shape.
+
+        Returns:
+            Normalized anomaly scores.
+        """
+        if not self.calibrated:
+            raise RuntimeError("ScoreNormalizer is not calibrated")
+
+        min_score = self.min_score.to(scores.device)
+        max_score = self.max_score.to(scores.device)
+        return (scores - min_score) / (max_score - min_score)
+
+    @property
+    def normalized_image_threshold(self) -> float:
+        return float(self(self.image_threshold))
+
+    @property
+    def fast_score_threshold(self) -> float:
+        """Raw threshold of the feature resolution image scores, the image threshold for models calibrated without one."""
+        if torch.isnan(self.score_threshold):
+            return float(self.image_threshold)
+        return float(self.score_threshold)
+
+    @property
+    def normalized_pixel_threshold(self) -> float:
+        return float(self(self.pixel_threshold))
@@ -0,0 +1,114 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+from typing import Any
+
+import torch
+from omegaconf import ListConfig
+from torch import nn, Tensor
+
+__all__ = [
+    "Tiler",
+]
+
+
+class Tiler(nn.Module):
+    r"""Cut images into a fixed grid of overlapping tiles and blend per-tile maps back into full images.
+
+    Along each axis the tiles start every ``stride`` pixels, plus a last tile aligned with the image border when the
+    stride does not divide the remaining length, so the tiles always cover the whole image.
+
+    Args:
+        tile_size (ListConfig | tuple[int, int]): tile height and width.
+        stride (ListConfig | tuple[int, int], optional): distance between tile origins, defaults to the tile size, i.e.
+            no overlap.
+        blend (str, optional): "mean" averages overlapping tiles, "gaussian" weights every tile pixel by a Gaussian
+            window centered on the tile, which hides the seams. Defaults to "mean".
+
+    Examples:
+        >>> import torch
+        >>> from padim.models import Tiler
+        >>> tiler = Tiler((224, 224), (192, 192))
+        >>> images = torch.rand(2, 3, 800, 800)
+        >>> tiles = tiler.tile(images)
+        >>> tiles.shape
+            torch.Size([32, 3, 224, 224])
+        >>> tiler.untile(tiles[:, :1], images.shape[-2:]).shape
+            torch.Size([2, 1, 800, 800])
+    """
+
+    def __init__(self, tile_size: ListConfig | tuple[int, int], stride: ListConfig | tuple[int, int] | None = None,
+                 blend: str = "mean") -> None:
+        super().__init__()
+        if blend not in ["mean", "gaussian"]:
+            raise ValueError(f"Blend '{blend}' not supported. Choices: ['mean', 'gaussian']")
+        self.tile_size = tuple(tile_size)
+        self.stride = tuple(stride) if stride is not None else self.tile_size
+        self.blend = blend
+
+    def get_config(self) -> dict[str, Any]:
+        return {"tile_size": list(self.tile_size), "stride": list(self.stride), "blend": self.blend}
+
+    @staticmethod
+    def get_starts(length: int, tile_length: int, stride: int) -> list[int]:
+        if length < tile_length:
+            raise ValueError(f"Image length {length} is smaller than the tile length {tile_length}")
+        starts = list(range(0, length - tile_length + 1, stride))
+        if starts[-1] != length - tile_length:
+            starts.append(length - tile_length)
+        return starts
+
+    def get_positions(self, image_size: tuple[int, int]) -> list[tuple[int, int]]:
+        """Top left corners of the tiles, row by row."""
+        tops = self.get_starts(image_size[0], self.tile_size[0], self.stride[0])
+        lefts = self.get_starts(image_size[1], self.tile_size[1], self.stride[1])
+        return [(top, left) for top in tops for left in lefts]
+
+    def get_num_tiles(self, image_size: tuple[int, int]) -> int:
+        return len(self.get_positions(image_size))
+
+    def get_window(self, device: torch.device) -> Tensor:
+        tile_height, tile_width = self.tile_size
+        if self.blend == "mean":
+            return torch.ones(tile_height, tile_width, device=device)
+
+        def gaussian(length: int) -> Tensor:
+            coordinates = torch.arange(length, dtype=torch.float32, device=device) - (length - 1) / 2
+            sigma = length / 4
+            return torch.exp(-coordinates ** 2 / (2 * sigma ** 2))
+
+        return gaussian(tile_height)[:, None] * gaussian(tile_width)[None, :]
+
+    def tile(self, images: Tensor) -> Tensor:
+        """(B, C, H, W) images to (B * N, C, tile height, tile width) tiles, the tiles of an image are contiguous."""
+        tile_height, tile_width = self.tile_size
+        positions = self.get_positions(tuple(images.shape[-2:]))
+        tiles = torch.stack([images[..., top:top + tile_height, left:left + tile_width] for top, left in positions], dim=1)
+        return tiles.flatten(0, 1)
+
+    def untile(self, tiles: Tensor, image_size: tuple[int, int]) -> Tensor:
+        """Blend (B * N, C, tile height, tile width) tile maps into (B, C, H, W) maps."""
+        tile_height, tile_width = self.tile_size
+        positions = self.get_positions(tuple(image_size))
+        tiles = tiles.reshape(-1, len(positions), *tiles.shape[1:])
+        window = self.get_window(tiles.device).to(tiles.dtype)
+
+        images = torch.zeros(tiles.shape[0], tiles.shape[2], *image_size, dtype=tiles.dtype, device=tiles.device)
+        weights = torch.zeros(*image_size, dtype=tiles.dtype, device=tiles.device)
+        for i, (top, left) in enumerate(positions):
+            images[..., top:top + tile_height, left:left + tile_width] += tiles[:, i] * window
+            weights[top:top + tile_height, left:left + tile_width] += window
+        return images / weights.clamp_min(torch.finfo(tiles.dtype).tiny)
+
+    def extra_repr(self) -> str:
+        return f"tile_size={self.tile_size}, stride={self.stride}, blend={self.blend}"
@@ -0,0 +1,162 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Score images against several fitted models that share one backbone pass.
+"""
+from pathlib import Path
+from typing import Any
+
+import torch
+from torch import nn, Tensor
+
+from padim.utils.profiler import get_profiler
+from .checkpoint import load_checkpoint
+from .padim import PaDiM
+
+__all__ = [
+    "MultiHeadPaDiM",
+]
+
+
+class MultiHeadPaDiM(nn.Module):
+    r"""Several fitted PaDiM heads that score the features of one backbone pass.
+
+    Every head keeps its own channel index, Gaussian, score normalization and region of interest, the backbone of the
+    first head is shared by all of them and the backbones of the others are released.
+
+    Args:
+        heads (dict[str, PaDiM]): Fitted models by name. They must have the same backbone, return nodes, backbone weights
+            and input normalization, and no tiling.
+
+    Raises:
+        ValueError: If the heads can not share a backbone pass.
+
+    Examples:
+        >>> from padim.models import MultiHeadPaDiM
+        >>> checkpoint = MultiHeadPaDiM.from_checkpoints({"red": "results/train/red/model", "blue": "results/train/blue/model"})
+        >>> model = checkpoint["model"]
+        >>> anomaly_maps = model(images)
+        >>> anomaly_maps["red"].shape
+            torch.Size([32, 1, 224, 224])
+    """
+
+    def __init__(self, heads: dict[str, PaDiM]) -> None:
+        super().__init__()
+        if not heads:
+            raise ValueError("MultiHeadPaDiM needs at least one head")
+
+        self.reference_name, reference = next(iter(heads.items()))
+        for name, head in heads.items():
+            self.check_compatible(reference, head, name)
+        self.feature_extractor = reference.feature_extractor
+        for head in heads.values():
+            head.feature_extractor = self.feature_extractor
+        self.heads = nn.ModuleDict(heads)
+
+    @property
+    def reference(self) -> PaDiM:
+        """The head whose backbone is shared."""
+        return self.heads[self.reference_name]
+
+    @staticmethod
+    def check_compatible(reference: PaDiM, head: PaDiM, name: str) -> None:
+        """Check that ``head`` computes the same features as ``reference`` for the same input."""
+        if head.tiler is not None:
+            raise ValueError(f"Head '{name}' scores tiles, which can not share the features of the whole input")
+        if head.backbone != reference.backbone or list(head.return_nodes) != list(reference.return_nodes):
+            raise ValueError(f"Head '{name}' uses {head.backbone} {list(head.return_nodes)}, "
+                             f"expected {reference.backbone} {list(reference.return_nodes)}")
+        if not (torch.equal(head.input_mean.cpu(), reference.input_mean.cpu()) and
+                torch.equal(head.input_std.cpu(), reference.input_std.cpu())):
+            raise ValueError(f"Head '{name}' normalizes its input differently")
+        if head.feature_extractor is not reference.feature_extractor:
+            reference_state = reference.feature_extractor.state_dict()
+            for key, tensor in head.feature_extractor.state_dict().items():
+                if not torch.equal(tensor.cpu(), reference_state[key].cpu()):
+                    raise ValueError(f"Head '{name}' has other backbone weights, '{key}' differs")
+
+    @classmethod
+    def from_checkpoints(
+            cls,
+            paths: dict[str, str | Path],
+            device: torch.device = torch.device("cpu"),
+            chunk_size: int | None = None,
+            distance_memory_budget: int | None = None,
+    ) -> dict[str, Any]:
+        """Load the heads from checkpoint directories, see :func:`padim.models.load_checkpoint`.
+
+        Args:
+            paths (dict[str, str | Path]): Checkpoint directories by head name.
+            device (torch.device, optional): Device of the model. Defaults to CPU.
+            chunk_size (int, optional): Score in chunks of positions. Defaults to None.
+            distance_memory_budget (int, optional): Bytes of transient memory of the distance computation. Defaults to None.
+
+        Returns:
+            A dict with the ``model``, the shared ``image_transforms``, ``mask_transforms`` and ``mask_size``, and the
+            ``manifests`` by head name.
+
+        Raises:
+            ValueError: If the heads are not preprocessed alike or can not share a backbone pass.
+        """
+        checkpoints = {name: load_checkpoint(path, device, chunk_size=chunk_size, distance_memory_budget=distance_memory_budget)
+                       for name, path in paths.items()}
+        reference_name, reference = next(iter(checkpoints.items()))
+        for name, checkpoint in checkpoints.items():
+            if checkpoint["manifest"]["transforms"] != reference["manifest"]["transforms"]:
+                raise ValueError(f"Head '{name}' transforms its input differently from head '{reference_name}'")
+
+        model = cls({name: checkpoint["model"] for name, checkpoint in checkpoints.items()})
+        return {
+            "model": model,
+            "image_transforms": reference["image_transforms"],
+            "mask_transforms": reference["mask_transforms"],
+            "mask_size": reference["mask_size"],
+            "manifests": {name: checkpoint["manifest"] for name, checkpoint in checkpoints.items()},
+        }
+
+    def extract_features(self, x: Tensor) -> dict[str, Tensor]:
+        """Normalize the input and run the shared backbone once."""
+        with torch.no_grad():
+            with get_profiler().span("model.normalize_input"):
+                x = self.reference.normalize_input(x)
+            return self.reference.extract_features(x)
+
+    def forward(self, x: Tensor) -> dict[str, Tensor]:
+        """Anomaly maps of every head, by head name."""
+        features = self.extract_features(x)
+        return {name: head.score_features(features) for name, head in self.heads.items()}
+
+    def predict(
+            self,
+            x: Tensor,
+            thresholds: dict[str, float] | float | None = None,
+            return_maps: bool = False,
+    ) -> dict[str, dict[str, Tensor | None]]:
+        """Score the images against every head, see :meth:`PaDiM.predict`.
+
+        Args:
+            x (Tensor): Batch of images, uint8 or normalized float.
+            thresholds (dict[str, float] | float, optional): Raw score threshold of every head, or of each head by name.
+                Defaults to the calibrated threshold of each head.
+            return_maps (bool, optional): Build the maps of all images. Defaults to False.
+
+        Returns:
+            The output of :meth:`PaDiM.predict` by head name.
+        """
+        features = self.extract_features(x)
+        outputs = {}
+        for name, head in self.heads.items():
+            threshold = thresholds.get(name) if isinstance(thresholds, dict) else thresholds
+            outputs[name] = head.predict_features(features, threshold, return_maps)
+        return outputs
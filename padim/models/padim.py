@@ -18,7 +18,9 @@ from omegaconf import ListConfig, OmegaConf
 from torch import nn, Tensor
 from torch.nn import functional as F_torch
 
-from padim.models.module import AnomalyMap, FeatureExtractor, MultiVariateGaussian
+from padim.models.module import DEFAULT_POST_PROCESS_MODE, AnomalyMap, CascadedScorer, FeatureExtractor, MultiVariateGaussian, \
+    ScoreNormalizer, Tiler, get_feature_shapes, get_roi_index
+from padim.utils.profiler import get_profiler
 
 
 class PaDiM(nn.Module):
@@ -29,6 +31,29 @@ class PaDiM(nn.Module):
         return_nodes (list[str]): The nodes to return from the feature extractor.
         pretrained (bool): Whether to use pretrained weights for the feature extractor.
         mask_size (tuple[int, int], optional): The input image size. Default: (224, 224)
+        chunk_size (int, optional): Score the positions in chunks of this size, streaming the Gaussian parameters
+            from wherever they live. Default: None (score all positions at once)
+        normalize_mean (tuple[float, ...], optional): Mean used to normalize uint8 input images. Default: ImageNet mean
+        normalize_std (tuple[float, ...], optional): Std used to normalize uint8 input images. Default: ImageNet std
+        tiler (Tiler, optional): Score overlapping tiles of the input and blend their maps into a full resolution map, the
+            mask size is then usually the input size. Default: None
+        tile_gaussian (str, optional): "per_tile" fits a Gaussian per position of every tile, "shared" fits one
+            Gaussian per position for all tiles. Default: "per_tile"
+        tiles_per_batch (int, optional): Run the backbone on at most this many tiles at a time. Default: None (all tiles)
+        post_process (str, optional): Anomaly map upsampling and blur, see :class:`AnomalyMap`. Default: "fused"
+        cascade_rank (int, optional): Prune clearly normal images in :meth:`predict` with distance bounds of this rank,
+            see :class:`CascadedScorer`. The other images score as without the cascade up to float rounding, a few 1e-5.
+            Default: None (score all images exactly)
+        roi_mask (Tensor, optional): (H, W) bool region of interest in input coordinates, see :func:`create_roi_mask`.
+            Only the feature positions overlapping it are fitted and scored, the others score zero. Default: None
+        distance_memory_budget (int, optional): Bytes of transient memory of the Mahalanobis distances, large batches
+            are scored in tiles of images and positions that fit. Default: None (score the batch at once)
+        pool_stride (int, optional): Average-pool the embedding with this kernel and stride, e.g. 2 fits and scores a
+            28x28 instead of a 56x56 grid at a 224 input: 4x fewer Gaussians and distances at a coarser localization.
+            Default: 1 (no pooling)
+        num_features (int, optional): Channels randomly selected from the concatenated features of the return nodes.
+            Default: None (100 for resnet18, 550 for wide_resnet50_2, at most the channels of the return nodes)
+        covariance_epsilon (float, optional): Regularization added to the diagonal of the covariances. Default: 0.01
 
     Raises:
         ValueError: If the backbone is not supported.
@@ -57,31 +82,287 @@ class PaDiM(nn.Module):
             backbone: str,
             return_nodes: ListConfig | list[str],
             pretrained: bool = True,
-            mask_size: tuple[int, int] = (224, 224)
+            mask_size: tuple[int, int] = (224, 224),
+            chunk_size: int | None = None,
+            normalize_mean: tuple[float, ...] = (0.485, 0.456, 0.406),
+            normalize_std: tuple[float, ...] = (0.229, 0.224, 0.225),
+            tiler: Tiler | None = None,
+            tile_gaussian: str = "per_tile",
+            tiles_per_batch: int | None = None,
+            post_process: str = DEFAULT_POST_PROCESS_MODE,
+            cascade_rank: int | None = None,
+            roi_mask: Tensor | None = None,
+            distance_memory_budget: int | None = None,
+            pool_stride: int = 1,
+            num_features: int | None = None,
+            covariance_epsilon: float = 0.01,
     ) -> None:
         super().__init__()
         if isinstance(return_nodes, ListConfig):
             return_nodes = OmegaConf.to_container(return_nodes)
+        self.backbone = backbone
         self.return_nodes = return_nodes
         self.feature_extractor = FeatureExtractor(backbone, return_nodes, pretrained)
-        self.anomaly_map = AnomalyMap(mask_size)
+        self.anomaly_map = AnomalyMap(mask_size, chunk_size=chunk_size, post_process_mode=post_process,
+                                      memory_budget=distance_memory_budget)
+        if tile_gaussian not in ["per_tile", "shared"]:
+            raise ValueError(f"Tile Gaussian '{tile_gaussian}' not supported. Choices: ['per_tile', 'shared']")
+        if pool_stride < 1:
+            raise ValueError(f"The pool stride must be at least 1, got {pool_stride}")
+        self.pool_stride = pool_stride
+        if tiler is not None and roi_mask is not None:
+            raise ValueError("A region of interest is not supported with tiling")
+        self.tiler = tiler
+        self.tile_gaussian = tile_gaussian
+        self.tiles_per_batch = tiles_per_batch
+        self.cascade_rank = cascade_rank
+        self.cascade: CascadedScorer | None = None
+        self.roi_mask: Tensor | None
+        if roi_mask is None:
+            self.roi_mask = None
+        else:
+            self.register_buffer("roi_mask", roi_mask.bool())
+        self.roi_indices: dict[tuple, Tensor] = {}
+
+        self.input_mean: Tensor
+        self.input_std: Tensor
+        self.register_buffer("input_mean", torch.tensor(normalize_mean, dtype=torch.float32).view(1, -1, 1, 1))
+        self.register_buffer("input_std", torch.tensor(normalize_std, dtype=torch.float32).view(1, -1, 1, 1))
 
         self.index: Tensor
-        max_features = self.max_features_dict[backbone]
-        num_features = self.num_features_dict[backbone]
+        # the channels of the return nodes, max_features_dict for the default layer1 to layer3 nodes
+        max_features = sum(shape[0] for shape in get_feature_shapes(backbone, return_nodes).values())
+        if num_features is None:
+            num_features = min(self.num_features_dict[backbone], max_features)
+        if not 0 < num_features <= max_features:
+            raise ValueError(f"Cannot select {num_features} of the {max_features} channels of the return nodes")
+        self.num_features = num_features
         self.register_buffer("index", torch.tensor(random.sample(range(0, max_features), num_features)))
 
-        self.multi_variate_gaussian = MultiVariateGaussian(num_features, max_features)
+        self.multi_variate_gaussian = MultiVariateGaussian(num_features, max_features, covariance_epsilon)
+        self.score_normalizer = ScoreNormalizer()
+
+    def place(self, device: torch.device) -> "PaDiM":
+        """Move the model to ``device``. With chunked scoring the Gaussian parameters stay where they are, e.g.
+        memory-mapped on the host, and are streamed to the device chunk by chunk."""
+        if self.anomaly_map.chunk_size is None:
+            return self.to(device)
+
+        self.feature_extractor.to(device)
+        return self
+
+    def normalize_input(self, x: Tensor) -> Tensor:
+        """Normalize a batch of uint8 images, float images are expected to be normalized already."""
+        if x.dtype != torch.uint8:
+            return x
+
+        input_mean = self.input_mean.to(x.device)
+        input_std = self.input_std.to(x.device)
+        return (x.float() / 255.0 - input_mean) / input_std
 
     def forward(self, x: Tensor) -> Tensor:
+        profiler = get_profiler()
         with torch.no_grad():
-            features = self.feature_extractor(x)
-            embeddings = self.generate_embedding(features)
+            with profiler.span("model.normalize_input"):
+                x = self.normalize_input(x)
 
+            if self.tiler is None:
+                embeddings = self.extract_embedding(x)
+            else:
+                image_size = tuple(x.shape[-2:])
+                with profiler.span("model.tile"):
+                    tiles = self.tiler.tile(x)
+                step = self.tiles_per_batch or len(tiles)
+                embeddings = torch.cat([self.extract_embedding(tiles[i:i + step]) for i in range(0, len(tiles), step)])
+
+        if self.tiler is None:
+            if self.training:
+                roi_index = self.get_roi_index(embeddings)
+                return embeddings if roi_index is None else self.anomaly_map.select_positions(embeddings, roi_index)
+            return self.score_embeddings(embeddings)
+
+        num_tiles = self.tiler.get_num_tiles(image_size)
         if self.training:
+            return self.group_tiles(embeddings, num_tiles)
+        return self.compute_tiled_anomaly_map(embeddings, num_tiles, image_size)
+
+    def predict(self, x: Tensor, threshold: float | None = None, return_maps: bool = False) -> dict[str, Tensor | None]:
+        """Score images without building their anomaly maps, then build the maps of the images that need one.
+
+        The image scores are computed at feature resolution, see :meth:`AnomalyMap.compute_image_score` for how they
+        relate to the maximum of the full anomaly map. Tiled models build the full maps to score the images.
+
+        Args:
+            x (Tensor): Batch of images, uint8 or normalized float.
+            threshold (float, optional): Build the maps of the images scoring at least this raw score. Defaults to the
+                calibrated score threshold, or no maps if the model is not calibrated.
+            return_maps (bool, optional): Build the maps of all images. Defaults to False.
+
+        Returns:
+            A dict with the raw ``scores`` (B,), the ``anomaly_maps`` (K, 1, H, W) and their ``map_indices`` (K,) in the
+            batch, both None when no map is built.
+
+        Examples:
+            >>> output = model.predict(images, threshold=12.5)
+            >>> rejected = output["scores"] >= 12.5
+        """
+        if self.tiler is not None:
+            anomaly_maps = self(x)
+            scores = anomaly_maps.flatten(1).amax(1)
+            map_indices = torch.arange(len(scores), device=scores.device)
+            if not return_maps:
+                map_indices = self.select_map_indices(scores, threshold)
+            return {
+                "scores": scores,
+                "anomaly_maps": None if map_indices is None else anomaly_maps[map_indices],
+                "map_indices": map_indices,
+            }
+
+        with torch.no_grad():
+            with get_profiler().span("model.normalize_input"):
+                x = self.normalize_input(x)
+            return self.predict_features(self.extract_features(x), threshold, return_maps)
+
+    def predict_features(
+            self,
+            features: dict[str, Tensor],
+            threshold: float | None = None,
+            return_maps: bool = False,
+    ) -> dict[str, Tensor | None]:
+        """Like :meth:`predict`, from the backbone features of the images, e.g. shared with other models of the same
+        backbone. Not supported with tiling."""
+        if self.tiler is not None:
+            raise ValueError("Tiled models score tiles of the input, not the features of the whole input")
+
+        with torch.no_grad():
+            embeddings = self.embed_features(features)
+            cascade = None if return_maps else self.get_cascade()
+            threshold = self.get_score_threshold(threshold)
+            roi_index = self.get_roi_index(embeddings)
+            candidates = torch.arange(len(embeddings), device=embeddings.device)
+            if cascade is not None and threshold is not None:
+                # the bounds are the scores of the pruned images, the candidates are scored exactly
+                if roi_index is None:
+                    bounds = cascade.compute_bound(embeddings)
+                else:
+                    bounds = self.anomaly_map.scatter_positions(
+                        cascade.compute_bound(self.anomaly_map.select_positions(embeddings, roi_index)),
+                        roi_index,
+                        tuple(embeddings.shape[-2:]),
+                    )
+                bounds = self.anomaly_map.compute_image_score(bounds)
+                candidates = cascade.select_candidates(bounds, threshold)
+                # the matmul kernels depend on the number of rows, the candidates score as in the full batch up to float
+                # rounding
+                embeddings = embeddings[candidates]
+            distances = self.anomaly_map.compute_anomaly_distance(embeddings,
+                                                                  self.multi_variate_gaussian.mean,
+                                                                  self.multi_variate_gaussian.inv_covariance,
+                                                                  roi_index)
+            scores = self.anomaly_map.compute_image_score(distances)
+            if cascade is not None and threshold is not None:
+                scores = bounds.index_copy(0, candidates, scores)
+
+            if return_maps:
+                map_indices = torch.arange(len(scores), device=scores.device)
+            else:
+                map_indices = self.select_map_indices(scores, threshold)
+            anomaly_maps = None
+            if map_indices is not None:
+                # the maps are only built for candidates, whose distances are rows of the distance maps in order
+                anomaly_maps = self.anomaly_map.post_process(distances[torch.searchsorted(candidates, map_indices)])
+
+        return {
+            "scores": scores,
+            "anomaly_maps": anomaly_maps,
+            "map_indices": map_indices,
+        }
+
+    def get_roi_index(self, embeddings: Tensor) -> Tensor | None:
+        """Flat indices of the region of interest positions of the embeddings, mapped once per embedding size."""
+        if self.roi_mask is None:
+            return None
+        key = (tuple(embeddings.shape[-2:]), embeddings.device)
+        if key not in self.roi_indices:
+            self.roi_indices[key] = get_roi_index(self.roi_mask.cpu(), key[0]).to(embeddings.device)
+        return self.roi_indices[key]
+
+    def get_score_threshold(self, threshold: float | None) -> float | None:
+        """The given threshold, or the calibrated score threshold, or None for an uncalibrated model."""
+        if threshold is None and self.score_normalizer.calibrated:
+            return self.score_normalizer.fast_score_threshold
+        return threshold
+
+    def get_cascade(self) -> CascadedScorer | None:
+        """The cascaded scorer of the fitted Gaussian, built on first use and again after the Gaussian changes."""
+        if self.cascade_rank is None:
+            return None
+        gaussian = self.multi_variate_gaussian
+        if self.cascade is None or self.cascade.mean is not gaussian.mean:
+            self.cascade = CascadedScorer(gaussian.mean, gaussian.inv_covariance, self.cascade_rank)
+        return self.cascade
+
+    def select_map_indices(self, scores: Tensor, threshold: float | None) -> Tensor | None:
+        """Indices of the scores at or above the threshold, None if no threshold is given or calibrated."""
+        threshold = self.get_score_threshold(threshold)
+        if threshold is None:
+            return None
+        indices = torch.nonzero(scores >= threshold).flatten()
+        return indices if len(indices) > 0 else None
+
+    def extract_features(self, x: Tensor) -> dict[str, Tensor]:
+        with get_profiler().span("model.backbone"):
+            return self.feature_extractor(x)
+
+    def embed_features(self, features: dict[str, Tensor]) -> Tensor:
+        with get_profiler().span("model.generate_embedding"):
+            return self.generate_embedding(features)
+
+    def extract_embedding(self, x: Tensor) -> Tensor:
+        return self.embed_features(self.extract_features(x))
+
+    def score_embeddings(self, embeddings: Tensor) -> Tensor:
+        """Anomaly maps of (B, C, h, w) embeddings, in the region of interest if the model has one."""
+        return self.anomaly_map(embeddings,
+                                self.multi_variate_gaussian.mean,
+                                self.multi_variate_gaussian.inv_covariance,
+                                self.get_roi_index(embeddings))
+
+    def score_features(self, features: dict[str, Tensor]) -> Tensor:
+        """Anomaly maps from the backbone features of the images, e.g. shared with other models of the same backbone.
+        Not supported with tiling."""
+        if self.tiler is not None:
+            raise ValueError("Tiled models score tiles of the input, not the features of the whole input")
+        with torch.no_grad():
+            return self.score_embeddings(self.embed_features(features))
+
+    def group_tiles(self, embeddings: Tensor, num_tiles: int) -> Tensor:
+        """With per-tile Gaussians, stack the (B * N, C, h, w) tile embeddings into (B, C, N * h, w) image embeddings so
+        that every position of every tile gets its own Gaussian."""
+        if self.tile_gaussian == "shared":
             return embeddings
-        else:
-            return self.anomaly_map(embeddings, self.multi_variate_gaussian.mean, self.multi_variate_gaussian.inv_covariance)
+        _, channels, height, width = embeddings.shape
+        embeddings = embeddings.reshape(-1, num_tiles, channels, height, width).transpose(1, 2)
+        return embeddings.reshape(-1, channels, num_tiles * height, width)
+
+    def compute_tiled_anomaly_map(self, embeddings: Tensor, num_tiles: int, image_size: tuple[int, int]) -> Tensor:
+        """Score the tile embeddings, blend the tile maps at input resolution and post-process the blended map."""
+        mean = self.multi_variate_gaussian.mean
+        _, channels, height, width = embeddings.shape
+        if self.tile_gaussian == "per_tile" and mean.shape[-1] != num_tiles * height * width:
+            raise ValueError(f"The model was fitted for {mean.shape[-1] // (height * width)} tiles per image, "
+                             f"but an input of size {image_size} gives {num_tiles} tiles")
+
+        distances = self.anomaly_map.compute_anomaly_distance(self.group_tiles(embeddings, num_tiles),
+                                                              mean,
+                                                              self.multi_variate_gaussian.inv_covariance)
+        if self.tile_gaussian == "per_tile":
+            distances = distances.reshape(-1, 1, num_tiles, height, width).transpose(1, 2).reshape(-1, 1, height, width)
+
+        with get_profiler().span("model.untile"):
+            tile_maps = F_torch.interpolate(distances, size=self.tiler.tile_size, mode="bilinear", align_corners=False)
+            anomaly_map = self.tiler.untile(tile_maps, image_size)
+        return self.anomaly_map.post_process(anomaly_map)
 
     def generate_embedding(self, features: dict[str, Tensor]) -> Tensor:
         """Generate embedding from hierarchical feature map.
@@ -93,13 +374,23 @@ class PaDiM(nn.Module):
             Embedding vector
         """
 
-        embeddings = features[self.return_nodes[0]]
-        for layer in self.return_nodes[1:]:
+        return self.assemble_embedding(features, self.return_nodes, self.index, self.pool_stride)
+
+    @staticmethod
+    def assemble_embedding(features: dict[str, Tensor], return_nodes: list[str], index: Tensor, pool_stride: int = 1) -> Tensor:
+        """Upsample the features of the return nodes to the first one, concatenate them, select the ``index`` channels and
+        average-pool the positions with ``pool_stride``."""
+        embeddings = features[return_nodes[0]]
+        for layer in return_nodes[1:]:
             layer_embedding = features[layer]
             layer_embedding = F_torch.interpolate(layer_embedding, size=embeddings.shape[-2:], mode="nearest")
             embeddings = torch.cat((embeddings, layer_embedding), 1)
 
         # subsample embeddings
-        index = self.index.to(embeddings.device)
+        index = index.to(embeddings.device)
         embeddings = torch.index_select(embeddings, 1, index)
+
+        # average neighbouring positions after the channel selection, the Gaussian and the anomaly map follow the grid
+        if pool_stride > 1:
+            embeddings = F_torch.avg_pool2d(embeddings, pool_stride)
         return embeddings
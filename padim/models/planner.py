@@ -0,0 +1,264 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Predict the memory of the fit and of the inference before running them.
+
+The feature shapes come from a forward pass on the ``meta`` device, nothing is allocated and no weights are downloaded.
+The estimates count the large float32 tensors of every phase, the framework overhead (Python, CUDA context, allocator
+caching) comes on top.
+"""
+import logging
+from typing import Any
+
+import torch
+from omegaconf import ListConfig, OmegaConf
+from torch import Tensor
+
+from padim.models.module import FeatureExtractor, Tiler, get_roi_index
+from padim.models.padim import PaDiM
+
+__all__ = [
+    "MemoryPlanner", "format_bytes", "parse_bytes",
+]
+
+logger = logging.getLogger(__name__)
+
+FLOAT_BYTES = 4
+# the input of a residual block stays alive next to the input and the output of the running layer
+LIVE_ACTIVATIONS = 3
+# interpolated map, padded map and blurred map
+ANOMALY_MAP_COPIES = 3
+
+
+def format_bytes(num_bytes: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+def parse_bytes(size: str | int) -> int:
+    """Parse ``"8GB"``, ``"512MiB"`` or a number of bytes."""
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper().replace("IB", "B")
+    for suffix, factor in [("TB", 2 ** 40), ("GB", 2 ** 30), ("MB", 2 ** 20), ("KB", 2 ** 10), ("B", 1)]:
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * factor)
+    return int(float(size))
+
+
+class MemoryPlanner:
+    r"""Predict the peak memory of the PaDiM phases for a backbone and an input size.
+
+    Args:
+        backbone (str): backbone name.
+        return_nodes (ListConfig | list[str]): return nodes of the backbone.
+        image_size (tuple[int, int]): model input size, i.e. the crop size.
+        tiler (Tiler, optional): tiles scored by the backbone, see :class:`padim.models.PaDiM`. Defaults to None.
+        tile_gaussian (str, optional): "per_tile" or "shared" Gaussians of the tiles. Defaults to "per_tile".
+        tiles_per_batch (int, optional): tiles run through the backbone at a time. Defaults to None (all tiles).
+        roi_mask (Tensor, optional): region of interest, only its positions are fitted and scored. Defaults to None.
+        pool_stride (int, optional): average pooling stride of the embedding. Defaults to 1.
+        num_features (int, optional): selected embedding channels. Defaults to None (the default of the backbone).
+
+    Examples:
+        >>> from padim.models import MemoryPlanner, format_bytes
+        >>> planner = MemoryPlanner("wide_resnet50_2", ["layer1", "layer2", "layer3"], (224, 224))
+        >>> fit = planner.plan_fit(num_images=209, batch_size=32)
+        >>> format_bytes(fit["peak"])
+            '13.4 GiB'
+        >>> planner.suggest(parse_bytes("8GB"), num_train_images=209, num_val_images=83)
+    """
+
+    def __init__(
+            self,
+            backbone: str,
+            return_nodes: ListConfig | list[str],
+            image_size: tuple[int, int],
+            tiler: Tiler | None = None,
+            tile_gaussian: str = "per_tile",
+            tiles_per_batch: int | None = None,
+            roi_mask: Tensor | None = None,
+            pool_stride: int = 1,
+            num_features: int | None = None,
+    ) -> None:
+        if isinstance(return_nodes, ListConfig):
+            return_nodes = OmegaConf.to_container(return_nodes)
+        self.backbone = backbone
+        self.return_nodes = return_nodes
+        self.image_size = tuple(image_size)
+        self.tiler = tiler
+        self.num_tiles = 1 if tiler is None else tiler.get_num_tiles(self.image_size)
+        input_size = self.image_size if tiler is None else tiler.tile_size
+        tiles_in_flight = min(tiles_per_batch or self.num_tiles, self.num_tiles)
+
+        with torch.device("meta"):
+            feature_extractor = FeatureExtractor(backbone, return_nodes, pretrained=False)
+        self.parameter_bytes = sum(parameter.numel() * parameter.element_size() for parameter in feature_extractor.parameters())
+
+        max_output = 0
+
+        def record_output(module, inputs, output) -> None:
+            nonlocal max_output
+            if isinstance(output, torch.Tensor):
+                max_output = max(max_output, output.numel())
+
+        hooks = [module.register_forward_hook(record_output) for module in feature_extractor.modules() if not list(module.children())]
+        with torch.no_grad():
+            features = feature_extractor(torch.empty(1, 3, *input_size, device="meta"))
+        for hook in hooks:
+            hook.remove()
+
+        self.feature_shapes = {name: tuple(feature.shape[1:]) for name, feature in features.items()}
+        self.max_features = sum(shape[0] for shape in self.feature_shapes.values())
+        self.num_features = num_features or min(PaDiM.num_features_dict[backbone], self.max_features)
+        feature_size = features[return_nodes[0]].shape[-2:]
+        feature_positions = feature_size[0] * feature_size[1]
+        self.embedding_size = (feature_size[0] // pool_stride, feature_size[1] // pool_stride)
+        tile_positions = self.embedding_size[0] * self.embedding_size[1]
+        roi_positions = tile_positions if roi_mask is None else len(get_roi_index(roi_mask, self.embedding_size))
+        # positions with a Gaussian, and positions scored per image
+        self.num_positions = roi_positions * (self.num_tiles if tile_gaussian == "per_tile" else 1)
+        self.scored_positions = roi_positions * self.num_tiles
+        feature_numel = sum(feature.numel() for feature in features.values())
+        # per image: live backbone activations, the returned features and the concatenated embedding of the tiles in the
+        # backbone, and the selected and pooled embedding of all tiles
+        self.activation_bytes_per_image = (tiles_in_flight * (LIVE_ACTIVATIONS * max_output + feature_numel +
+                                                              self.max_features * feature_positions)
+                                           + self.num_features * self.scored_positions) * FLOAT_BYTES
+
+    @property
+    def embedding_bytes_per_image(self) -> int:
+        return self.num_features * self.scored_positions * FLOAT_BYTES
+
+    @property
+    def gaussian_bytes(self) -> int:
+        """Mean and inverse covariance."""
+        return (self.num_features + self.num_features ** 2) * self.num_positions * FLOAT_BYTES
+
+    def checkpoint_bytes(self, include_backbone: bool = False) -> int:
+        index_bytes = self.num_features * 8
+        return self.gaussian_bytes + index_bytes + (self.parameter_bytes if include_backbone else 0)
+
+    def plan_fit(self, num_images: int, batch_size: int) -> dict[str, int]:
+        """Memory of the fit, the embeddings of all training images are kept until the Gaussian is fitted."""
+        embeddings = num_images * self.embedding_bytes_per_image
+        extraction = self.parameter_bytes + embeddings + batch_size * self.activation_bytes_per_image
+        # the list of batch embeddings and its stacked copy, then the covariance, its inverse and the permuted input of the inverse
+        covariance = self.num_features ** 2 * self.num_positions * FLOAT_BYTES
+        gaussian_fit = self.parameter_bytes + 2 * embeddings + 3 * covariance
+        return {
+            "parameters": self.parameter_bytes,
+            "embeddings": embeddings,
+            "activations": batch_size * self.activation_bytes_per_image,
+            "covariance": covariance,
+            "feature_extraction": extraction,
+            "gaussian_fit": gaussian_fit,
+            "peak": max(extraction, gaussian_fit),
+        }
+
+    def plan_inference(self, batch_size: int, chunk_size: int | None = None, distance_budget: int | None = None) -> dict[str, int]:
+        """Memory of scoring one batch, ``chunk_size`` streams the Gaussian parameters in chunks of positions and
+        ``distance_budget`` caps the transient memory of the distances."""
+        positions = self.num_positions if chunk_size is None else min(chunk_size, self.num_positions)
+        # all parameters, or the chunk being scored and the prefetched one
+        gaussian = self.gaussian_bytes if chunk_size is None else 2 * self.gaussian_bytes * positions // self.num_positions
+        embedding = batch_size * self.embedding_bytes_per_image
+        # delta, its product with the inverse covariance and the elementwise product, for the scored positions
+        distance = 3 * batch_size * self.num_features * (self.scored_positions * positions // self.num_positions) * FLOAT_BYTES
+        if distance_budget is not None:
+            distance = min(distance, max(distance_budget, 3 * self.num_features * FLOAT_BYTES))
+        anomaly_map = ANOMALY_MAP_COPIES * batch_size * self.image_size[0] * self.image_size[1] * FLOAT_BYTES
+        if self.tiler is not None:
+            # upsampled tile maps
+            anomaly_map += batch_size * self.num_tiles * self.tiler.tile_size[0] * self.tiler.tile_size[1] * FLOAT_BYTES
+        activations = batch_size * self.activation_bytes_per_image
+        return {
+            "parameters": self.parameter_bytes,
+            "gaussian": gaussian,
+            "activations": activations,
+            "embedding": embedding,
+            "compute_distance": distance,
+            "anomaly_map": anomaly_map,
+            "peak": self.parameter_bytes + gaussian + max(activations, embedding + distance, embedding + anomaly_map),
+        }
+
+    def plan_validation(
+            self,
+            num_images: int,
+            batch_size: int | None,
+            chunk_size: int | None = None,
+            distance_budget: int | None = None,
+    ) -> dict[str, int]:
+        """Memory of the validation, which keeps the images, masks and maps of the whole set for the metrics."""
+        batch_size = num_images if batch_size is None else batch_size
+        inference = self.plan_inference(batch_size, chunk_size, distance_budget)
+        height, width = self.image_size
+        # float images, float masks, anomaly maps and normalized scores
+        results = num_images * height * width * (3 + 1 + 1 + 1) * FLOAT_BYTES
+        return {
+            "inference": inference["peak"],
+            "results": results,
+            "peak": inference["peak"] + results,
+        }
+
+    def max_batch_size(self, budget: int, fixed: int, per_image: int, limit: int) -> int:
+        if per_image <= 0:
+            return limit
+        return int(max(min((budget - fixed) // per_image, limit), 0))
+
+    def suggest(
+            self,
+            budget: int,
+            num_train_images: int,
+            num_val_images: int | None = None,
+            max_batch_size: int = 256,
+    ) -> dict[str, Any]:
+        r"""Suggest the batch sizes and the chunk size that fit in ``budget`` bytes.
+
+        Args:
+            budget (int): memory budget in bytes.
+            num_train_images (int): number of training images.
+            num_val_images (int, optional): number of validation images. Defaults to None.
+            max_batch_size (int, optional): largest suggested batch size. Defaults to 256.
+
+        Returns:
+            dict[str, Any]: ``TRAIN_BATCH_SIZE``, ``VAL_BATCH_SIZE`` and ``CHUNK_SIZE``, None when no value fits, and the
+            ``fit_feasible`` flag, false when the embeddings and the covariance of the fit do not fit whatever the batch size.
+        """
+        fit = self.plan_fit(num_train_images, 1)
+        fit_feasible = fit["gaussian_fit"] <= budget
+        train_batch_size = self.max_batch_size(budget, self.parameter_bytes + fit["embeddings"], self.activation_bytes_per_image,
+                                               min(max_batch_size, num_train_images))
+
+        # keep every parameter resident unless streaming them in chunks leaves room for a larger validation batch
+        val_limit = min(max_batch_size, num_val_images) if num_val_images else max_batch_size
+        results = self.plan_validation(num_val_images, 1)["results"] if num_val_images else 0
+        chunk_size, val_batch_size = None, 0
+        candidate_chunk_size = self.num_positions
+        for candidate in [None] + [candidate_chunk_size >> i for i in range(candidate_chunk_size.bit_length())]:
+            inference_fixed = self.plan_inference(0, candidate)["peak"]
+            per_image = self.plan_inference(1, candidate)["peak"] - inference_fixed
+            batch_size = self.max_batch_size(budget, inference_fixed + results, per_image, val_limit)
+            if batch_size > val_batch_size:
+                chunk_size, val_batch_size = candidate, batch_size
+
+        return {
+            "TRAIN_BATCH_SIZE": train_batch_size or None,
+            "VAL_BATCH_SIZE": val_batch_size or None,
+            "CHUNK_SIZE": chunk_size,
+            "fit_feasible": fit_feasible,
+        }
@@ -0,0 +1,262 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Serve many fitted models from a memory budget.
+"""
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import torch
+
+from .checkpoint import BACKBONE_PREFIX, MANIFEST_FILE_NAME, is_checkpoint, load_checkpoint
+from .module.feature_extractor import FeatureExtractor
+from .planner import format_bytes, parse_bytes
+
+__all__ = [
+    "ModelRegistry",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def natural_key(version: str) -> list[tuple[int, int, str]]:
+    """Sort key of versions that orders the numbers in them by value, e.g. ``v2`` before ``v10``."""
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in re.split(r"(\d+)", version) if part]
+
+
+def get_fitted_bytes(manifest: dict[str, Any]) -> int:
+    """Bytes of the fitted tensors of a checkpoint, i.e. the Gaussian parameters and the buffers, without the backbone."""
+    return sum(int(np.prod(entry["shape"], dtype=np.int64)) * np.dtype(entry["dtype"]).itemsize
+               for name, entry in manifest["tensors"].items() if not name.startswith(BACKBONE_PREFIX))
+
+
+def get_backbone_bytes(manifest: dict[str, Any]) -> int:
+    """Bytes of the backbone weights of a checkpoint, embedded or the referenced pretrained ones."""
+    entries = [entry for name, entry in manifest["tensors"].items() if name.startswith(BACKBONE_PREFIX)]
+    if entries:
+        return sum(int(np.prod(entry["shape"], dtype=np.int64)) * np.dtype(entry["dtype"]).itemsize for entry in entries)
+
+    with torch.device("meta"):
+        feature_extractor = FeatureExtractor(manifest["backbone"]["name"], manifest["return_nodes"], pretrained=False)
+    return sum(tensor.numel() * tensor.element_size() for tensor in feature_extractor.state_dict().values())
+
+
+class ModelRegistry:
+    r"""Checkpoints by category and version, loaded on first request and evicted least recently used first.
+
+    By default only the fitted tensors count against the budget, most of them are the Gaussian parameters. The backbone
+    weights are not counted: they are mapped or loaded with the model and become resident once it is used, about 11 MB
+    for resnet18 and 69 MB for wide_resnet50_2 up to the default return nodes, which can push the memory of the process
+    over the budget. Set ``count_backbone`` to count them too. The sizes are read from the manifest, so models are
+    evicted before a new one is loaded. The default loader builds the model on the meta device and maps the tensors into
+    it, a load allocates no placeholders; a custom ``loader`` that allocates more is not accounted for. Memory-mapped
+    tensors are counted in full, although the OS may keep only the pages that were read resident. An evicted model is
+    released by the registry, a caller still holding it keeps it alive.
+
+    Pinned models are never evicted. A model larger than the budget, or a budget taken by pinned models, is loaded anyway
+    with a warning. All methods are thread-safe.
+
+    Args:
+        memory_budget (int | str, optional): Bytes of fitted tensors kept loaded, e.g. ``"4GB"``. Defaults to None (no
+            limit).
+        device (torch.device, optional): Device of the models. Defaults to CPU.
+        loader (Callable, optional): Load a checkpoint directory, called with the path and the device. Defaults to
+            :func:`padim.models.load_checkpoint`.
+        count_backbone (bool, optional): Count the backbone weights of every model against the budget, also when models
+            share the same pretrained backbone. Defaults to False.
+
+    Examples:
+        >>> from padim.models import ModelRegistry
+        >>> registry = ModelRegistry("2GB")
+        >>> registry.scan("results/registry")  # <root>/<category>/<version>/manifest.json
+        >>> registry.pin("bottle")
+        >>> model = registry.get("screw", "v2")
+        >>> anomaly_map = model(images)
+    """
+
+    def __init__(
+            self,
+            memory_budget: int | str | None = None,
+            device: torch.device = torch.device("cpu"),
+            loader: Callable[[Path, torch.device], dict[str, Any]] | None = None,
+            count_backbone: bool = False,
+    ) -> None:
+        self.memory_budget = None if memory_budget is None else parse_bytes(memory_budget)
+        self.device = device
+        self.loader = loader or (lambda path, device: load_checkpoint(path, device))
+        self.count_backbone = count_backbone
+
+        self.paths: dict[tuple[str, str], Path] = {}
+        self.sizes: dict[tuple[str, str], int] = {}
+        # loaded checkpoints, least recently used first
+        self.loaded: OrderedDict[tuple[str, str], dict[str, Any]] = OrderedDict()
+        self.pinned: set[tuple[str, str]] = set()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def register(self, category: str, version: str, path: str | Path) -> None:
+        """Register a checkpoint directory under ``category`` and ``version``, without loading it."""
+        path = Path(path)
+        if not is_checkpoint(path):
+            raise ValueError(f"'{path}' is not a checkpoint directory")
+        with open(path / MANIFEST_FILE_NAME) as f:
+            manifest = json.load(f)
+        with self.lock:
+            key = (category, str(version))
+            if key in self.loaded and self.paths[key] != path:
+                self.unload(*key)
+            self.paths[key] = path
+            self.sizes[key] = get_fitted_bytes(manifest) + (get_backbone_bytes(manifest) if self.count_backbone else 0)
+
+    def scan(self, root: str | Path) -> int:
+        """Register every ``<root>/<category>/<version>`` checkpoint directory.
+
+        Returns:
+            The number of registered checkpoints.
+        """
+        count = 0
+        for path in sorted(Path(root).glob("*/*")):
+            if is_checkpoint(path):
+                self.register(path.parent.name, path.name, path)
+                count += 1
+        logger.info(f"Registered {count} checkpoints from '{root}'.")
+        return count
+
+    def versions(self, category: str) -> list[str]:
+        """The registered versions of ``category``, oldest first in natural sort order."""
+        with self.lock:
+            versions = [version for key_category, version in self.paths if key_category == category]
+        return sorted(versions, key=natural_key)
+
+    def resolve(self, category: str, version: str | None = None) -> tuple[str, str]:
+        """The registry key of ``category`` at ``version``, the latest version if None."""
+        if version is None:
+            versions = self.versions(category)
+            if not versions:
+                raise KeyError(f"No model registered for category '{category}'")
+            version = versions[-1]
+        key = (category, str(version))
+        if key not in self.paths:
+            raise KeyError(f"No model registered for category '{category}' version '{version}'")
+        return key
+
+    def get_checkpoint(self, category: str, version: str | None = None) -> dict[str, Any]:
+        """The loaded checkpoint dict of a model, see :func:`padim.models.load_checkpoint`, loading it if needed."""
+        with self.lock:
+            key = self.resolve(category, version)
+            if key in self.loaded:
+                self.hits += 1
+                self.loaded.move_to_end(key)
+                return self.loaded[key]
+
+            self.misses += 1
+            self.make_room(self.sizes[key], keep={key})
+            logger.info(f"Load model {key[0]}:{key[1]} ({format_bytes(self.sizes[key])}) from '{self.paths[key]}'.")
+            checkpoint = self.loader(self.paths[key], self.device)
+            checkpoint["model"].eval()
+            self.loaded[key] = checkpoint
+            return checkpoint
+
+    def get(self, category: str, version: str | None = None) -> torch.nn.Module:
+        """The model of ``category`` at ``version``, the latest version if None, loading it if needed."""
+        return self.get_checkpoint(category, version)["model"]
+
+    def make_room(self, size: int, keep: set[tuple[str, str]]) -> None:
+        """Evict least recently used models until ``size`` more bytes fit in the budget, never those in ``keep``."""
+        if self.memory_budget is None:
+            return
+        for key in list(self.loaded):
+            if self.resident_bytes + size <= self.memory_budget:
+                return
+            if key not in self.pinned and key not in keep:
+                self.evict(key)
+        if self.resident_bytes + size > self.memory_budget:
+            logger.warning(f"Model memory {format_bytes(self.resident_bytes + size)} exceeds the budget of "
+                           f"{format_bytes(self.memory_budget)}, the loaded models are pinned or in use.")
+
+    def evict(self, key: tuple[str, str]) -> None:
+        del self.loaded[key]
+        self.evictions += 1
+        logger.info(f"Evict model {key[0]}:{key[1]} ({format_bytes(self.sizes[key])}).")
+
+    def unload(self, category: str, version: str | None = None) -> None:
+        """Release a loaded model, pinned or not."""
+        with self.lock:
+            key = self.resolve(category, version)
+            self.pinned.discard(key)
+            self.loaded.pop(key, None)
+
+    def pin(self, category: str, version: str | None = None) -> None:
+        """Load a model and keep it loaded until it is unpinned."""
+        with self.lock:
+            key = self.resolve(category, version)
+            self.pinned.add(key)
+            self.get_checkpoint(*key)
+
+    def unpin(self, category: str, version: str | None = None) -> None:
+        """Let a pinned model be evicted again."""
+        with self.lock:
+            self.pinned.discard(self.resolve(category, version))
+
+    def preload(self, hints: list[str | tuple[str, str | None]]) -> list[tuple[str, str]]:
+        """Load the hinted models, e.g. the categories of the next shift, most important first.
+
+        Loading stops before a hint would evict a model loaded by an earlier hint.
+
+        Args:
+            hints (list[str | tuple[str, str | None]]): Categories, at their latest version, or (category, version) pairs.
+
+        Returns:
+            The keys of the loaded models.
+        """
+        preloaded: list[tuple[str, str]] = []
+        with self.lock:
+            for hint in hints:
+                key = self.resolve(*hint) if isinstance(hint, tuple) else self.resolve(hint)
+                if self.memory_budget is not None and key not in self.loaded:
+                    evictable = sum(self.sizes[loaded_key] for loaded_key in self.loaded
+                                    if loaded_key not in self.pinned and loaded_key not in preloaded)
+                    if self.resident_bytes - evictable + self.sizes[key] > self.memory_budget:
+                        logger.info(f"Stop preloading at {key[0]}:{key[1]}, the budget is taken by the earlier hints.")
+                        break
+                self.get_checkpoint(*key)
+                preloaded.append(key)
+        return preloaded
+
+    @property
+    def resident_bytes(self) -> int:
+        """Bytes of the fitted tensors of the loaded models."""
+        return sum(self.sizes[key] for key in self.loaded)
+
+    def stats(self) -> dict[str, Any]:
+        """Loaded and pinned models, their bytes, and the hits, misses and evictions so far."""
+        with self.lock:
+            return {
+                "registered": len(self.paths),
+                "loaded": [f"{category}:{version}" for category, version in self.loaded],
+                "pinned": sorted(f"{category}:{version}" for category, version in self.pinned),
+                "resident_bytes": self.resident_bytes,
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,120 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Share one copy of a fitted model between the processes of a host.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
+from typing import Any
+
+import torch
+from omegaconf import DictConfig
+
+from .checkpoint import BACKBONE_PREFIX, create_manifest, get_model_tensors, load_checkpoint, save_checkpoint
+from .padim import PaDiM
+
+__all__ = [
+    "SharedModel",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _shared_memory_dir() -> Path:
+    # /dev/shm is a tmpfs on Linux: its files live in the page cache and are never written to disk
+    if Path("/dev/shm").is_dir():
+        return Path("/dev/shm")
+    return Path(tempfile.gettempdir())
+
+
+class SharedModel(object):
+    r"""Publish a fitted model, backbone weights included, as a checkpoint in shared memory.
+
+    Worker processes :meth:`attach` to it by memory-mapping the tensor file, so every process maps the same physical
+    pages instead of holding its own copy: the memory per host is one model plus the activations of each worker.
+    The tensors are mapped copy-on-write, a worker that modifies them only gets private copies of the pages it touches.
+
+    Args:
+        model (PaDiM): The fitted model.
+        transforms_dict (DictConfig | dict): ``DATASETS.TRANSFORMS`` config.
+        mask_size (tuple[int, int]): The mask size of the model.
+        name (str, optional): Name of the shared checkpoint. Defaults to a random name.
+
+    Examples:
+        >>> from padim.models import SharedModel, load_checkpoint
+        >>> checkpoint = load_checkpoint("results/train/mvtec_bottle/model")
+        >>> with SharedModel(checkpoint["model"], checkpoint["manifest"]["transforms"], checkpoint["mask_size"]) as shared_model:
+        ...     # in every worker process
+        ...     model = SharedModel.attach(shared_model.path)["model"]
+    """
+
+    def __init__(
+            self,
+            model: PaDiM,
+            transforms_dict: DictConfig | dict,
+            mask_size: tuple[int, int],
+            name: str = None,
+    ) -> None:
+        self.path = _shared_memory_dir() / f"padim-{name or uuid.uuid4().hex}"
+        save_checkpoint(self.path, create_manifest(model, transforms_dict, mask_size), get_model_tensors(model, include_backbone=True))
+        self.owner_pid = os.getpid()
+        logger.info(f"Published the model in shared memory at '{self.path}'.")
+
+    @classmethod
+    def from_checkpoint(cls, path: str | Path, name: str = None) -> "SharedModel":
+        """Publish the model of a checkpoint directory."""
+        checkpoint = load_checkpoint(path)
+        return cls(checkpoint["model"], checkpoint["manifest"]["transforms"], checkpoint["mask_size"], name)
+
+    @staticmethod
+    def attach(
+            path: str | Path,
+            device: torch.device = torch.device("cpu"),
+            chunk_size: int | None = None,
+            distance_memory_budget: int | None = None,
+    ) -> dict[str, Any]:
+        """Attach to a published model without copying its tensors.
+
+        The model is built on the meta device and its parameters and buffers are the mapped tensors, so attaching
+        allocates no private copy of them, however many processes attach at once.
+
+        Args:
+            path (str | Path): Path of the published model, i.e. :attr:`path`.
+            device (torch.device, optional): Device of the model. Only a CPU model shares the memory. Defaults to CPU.
+            chunk_size (int, optional): Score in chunks of positions. Defaults to None.
+            distance_memory_budget (int, optional): Bytes of transient memory of the distance computation. Defaults to None.
+
+        Returns:
+            The same dict as :func:`padim.models.load_checkpoint`.
+        """
+        checkpoint = load_checkpoint(path, device, mmap=True, chunk_size=chunk_size, distance_memory_budget=distance_memory_budget)
+        if not any(name.startswith(BACKBONE_PREFIX) for name in checkpoint["manifest"]["tensors"]):
+            logger.warning(f"'{path}' does not embed the backbone weights, every process that attaches loads its own copy.")
+        checkpoint["model"].eval()
+        return checkpoint
+
+    def close(self) -> None:
+        """Remove the published model. Processes attached to it keep their mapping until they release it."""
+        if os.getpid() == self.owner_pid:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self) -> "SharedModel":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
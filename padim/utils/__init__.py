@@ -15,5 +15,7 @@ from .common import *
 from .download import *
 from .ops import *
 from .plots import *
+from .profiler import *
+from .render import *
 from .seed import *
 from .transform import *
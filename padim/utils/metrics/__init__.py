@@ -11,3 +11,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+from .quantile_sketch import QuantileSketch
+
+__all__ = [
+    "QuantileSketch",
+]
@@ -0,0 +1,124 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Streaming quantile estimation with a KLL-style compactor sketch
+"""
+import numpy as np
+
+__all__ = [
+    "QuantileSketch",
+]
+
+
+class QuantileSketch(object):
+    r"""Mergeable streaming quantile sketch.
+
+    Values are buffered in a hierarchy of compactors. When a compactor holds more than ``k`` items it is sorted and every
+    other item is promoted to the next level, where each item stands for twice as many observations. The memory footprint
+    is ``O(k log(n / k))`` and the rank error shrinks as ``k`` grows. The exact minimum and maximum are tracked separately.
+
+    Args:
+        k (int, optional): Capacity of each compactor. Defaults to 4096.
+        seed (int, optional): Seed of the random offset used when compacting. Defaults to None.
+
+    Examples:
+        >>> import numpy as np
+        >>> from padim.utils.metrics import QuantileSketch
+        >>> sketch = QuantileSketch()
+        >>> for _ in range(10):
+        ...     sketch.update(np.random.rand(100000))
+        >>> round(sketch.quantile(0.5), 2)
+            0.5
+    """
+
+    def __init__(self, k: int = 4096, seed: int = None) -> None:
+        self.k = k
+        self.count = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.compactors: list[np.ndarray] = [np.empty(0, dtype=np.float64)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of observations to the sketch.
+
+        Args:
+            values (np.ndarray): Observations of any shape, they are flattened.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.compactors[0] = np.concatenate((self.compactors[0], values))
+        self._compress()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Merge another sketch into this one.
+
+        Args:
+            other (QuantileSketch): Sketch built over a disjoint part of the stream.
+        """
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for level, items in enumerate(other.compactors):
+            if level == len(self.compactors):
+                self.compactors.append(np.empty(0, dtype=np.float64))
+            self.compactors[level] = np.concatenate((self.compactors[level], items))
+        self._compress()
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if items.size > self.k:
+                items = np.sort(items)
+                # An odd item out stays at this level so that no weight is lost
+                keep = items[-1:] if items.size % 2 else items[:0]
+                items = items[:items.size - keep.size]
+                promoted = items[self._rng.integers(2)::2]
+
+                self.compactors[level] = keep
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0, dtype=np.float64))
+                self.compactors[level + 1] = np.concatenate((self.compactors[level + 1], promoted))
+            level += 1
+
+    def quantile(self, q: float | np.ndarray) -> float | np.ndarray:
+        """Estimate one or several quantiles of the observed stream.
+
+        Args:
+            q (float | np.ndarray): Quantile(s) in ``[0, 1]``.
+
+        Returns:
+            float | np.ndarray: Estimated quantile value(s). ``q=0`` and ``q=1`` return the exact minimum and maximum.
+        """
+        if self.count == 0:
+            raise ValueError("Cannot compute a quantile of an empty sketch")
+
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(level_items.size, 2 ** level, dtype=np.float64) for level, level_items in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        items = items[order]
+        cumulative_weights = np.cumsum(weights[order])
+
+        q = np.asarray(q, dtype=np.float64)
+        index = np.searchsorted(cumulative_weights, q * cumulative_weights[-1], side="left")
+        values = items[np.clip(index, 0, items.size - 1)]
+        values = np.where(q <= 0, self.min, np.where(q >= 1, self.max, values))
+
+        return float(values) if values.ndim == 0 else values
@@ -16,10 +16,11 @@ from typing import Any
 import numpy as np
 import torch
 from scipy.ndimage import gaussian_filter
-from scipy.spatial.distance import mahalanobis
 from torch import Tensor
 from torch.nn import functional as F_torch
 
+from padim.deploy import mahalanobis_distances
+
 __all__ = [
     "calculate_distance_matrix", "cal_multivariate_gaussian_distribution", "generate_embedding", "get_anomaly_map", "de_normalization",
     "embedding_concat",
@@ -46,16 +47,12 @@ def calculate_distance_matrix(embedding: Tensor, stats: list[Tensor]) -> np.ndar
         distances (np.ndarray): The distance matrix of the input tensor.
     """
     batch_size, channels, height, width = embedding.size()
-    embedding_vectors = embedding.cpu().view(batch_size, channels, height * width).numpy()
-    distances = []
-    for i in range(height * width):
-        mean = stats[0][:, i]
-        conv_inv = np.linalg.inv(stats[1][:, :, i])
-        distance = [mahalanobis(sample[:, i], mean, conv_inv) for sample in embedding_vectors]
-        distances.append(distance)
-
-    distances = np.array(distances).transpose(1, 0).reshape(batch_size, height, width)
-    return distances
+    embedding_vectors = embedding.cpu().reshape(batch_size, channels, height * width).numpy().astype(np.float64)
+    mean = np.asarray(stats[0], dtype=np.float64)
+    # the (C, C, P) covariances are inverted as one (P, C, C) batch
+    inv_covariance = np.linalg.inv(np.asarray(stats[1], dtype=np.float64).transpose(2, 0, 1))
+    distances = mahalanobis_distances(embedding_vectors, mean, inv_covariance)
+    return distances.reshape(batch_size, height, width)
 
 
 def cal_multivariate_gaussian_distribution(x: Tensor) -> [np.ndarray, np.ndarray]:
@@ -79,12 +76,12 @@ def cal_multivariate_gaussian_distribution(x: Tensor) -> [np.ndarray, np.ndarray
         cov_inv (np.ndarray): The inverse covariance of the multivariate Gaussian distribution.
     """
     batch_size, channels, height, width = x.size()
-    embedding_vectors = x.view(batch_size, channels, height * width).cpu()
-    mean = torch.mean(embedding_vectors, dim=0).numpy()
-    inv_covariance = torch.zeros(channels, channels, height * width).numpy()
-    I = np.identity(channels)
-    for i in range(height * width):
-        inv_covariance[:, :, i] = np.cov(embedding_vectors[:, :, i], rowvar=False) + 0.01 * I
+    embedding_vectors = x.reshape(batch_size, channels, height * width).cpu().numpy()
+    mean = embedding_vectors.mean(axis=0)
+    deviations = (embedding_vectors - mean).astype(np.float64)
+    # the unbiased covariance of every position at once, in float64 as np.cov
+    covariance = np.einsum("bcp,bdp->cdp", deviations, deviations, optimize=True) / (batch_size - 1)
+    inv_covariance = (covariance + 0.01 * np.identity(channels)[:, :, None]).astype(np.float32)
 
     return mean, inv_covariance
 
@@ -108,13 +105,10 @@ def generate_embedding(features: Tensor | Any, return_nodes: list, index: Tensor
 def get_anomaly_map(distances: np.ndarray, image_size: int) -> np.ndarray:
     # up-sample
     distances = torch.tensor(distances)
-    anomaly_map = F_torch.interpolate(distances.unsqueeze(1), size=(image_size, image_size), mode="bilinear", align_corners=False).squeeze().numpy()
-
-    # apply gaussian smoothing on the score map
-    for i in range(anomaly_map.shape[0]):
-        anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
+    anomaly_map = F_torch.interpolate(distances.unsqueeze(1), size=(image_size, image_size), mode="bilinear", align_corners=False).squeeze(1).numpy()
 
-    return anomaly_map
+    # apply gaussian smoothing on the score map, per image
+    return gaussian_filter(anomaly_map, sigma=(0, 4, 4))
 
 
 def de_normalization(
@@ -125,7 +119,7 @@ def de_normalization(
     r"""De-normalize the input tensor.
 
     Args:
-        x (np.ndarray): The input tensor of shape (batch_size, channels, height, width).
+        x (np.ndarray): The input tensor of shape (channels, height, width). A uint8 tensor is only transposed.
         mean (tuple[float]): The mean of the data.
         std (tuple[float]): The standard deviation of the data.
 
@@ -140,6 +134,9 @@ def de_normalization(
     Returns:
         x (np.ndarray): The de-normalized tensor.
     """
+    if x.dtype == np.uint8:
+        return x.transpose(1, 2, 0)
+
     if mean is None:
         mean = np.array([0.485, 0.456, 0.406])
     if std is None:
@@ -175,12 +172,9 @@ def embedding_concat(x: Tensor, y: Tensor) -> Tensor:
     scale_ratio = int(height_x / height_y)
     x = F_torch.unfold(x, kernel_size=scale_ratio, dilation=1, stride=scale_ratio)
     x = x.view(batch_size, channels_x, -1, height_y, width_y)
-    out = torch.zeros(batch_size, channels_x + channels_y, x.size(2), height_y, width_y, device=x.device)
-
-    # Concatenate x and y
-    for i in range(x.size(2)):
-        out[:, :, i, :, :] = torch.cat((x[:, :, i, :, :], y), 1)
-    out = out.view(batch_size, -1, height_y * width_y)
+    # Concatenate x and y, y repeated for every position of the x cells
+    out = torch.cat((x, y.unsqueeze(2).expand(-1, -1, x.size(2), -1, -1)), 1)
+    out = out.reshape(batch_size, -1, height_y * width_y)
     out = F_torch.fold(out, kernel_size=scale_ratio, output_size=(height_x, width_x), stride=scale_ratio)
 
     return out
@@ -0,0 +1,192 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Named spans around the pipeline stages, aggregated into percentiles and exported as Chrome trace JSON.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from omegaconf import DictConfig
+
+__all__ = [
+    "Profiler", "get_profiler", "configure_profiler",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *args) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start_time")
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self) -> None:
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *args) -> None:
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.profiler.add(self.name, self.start_time, time.perf_counter())
+
+
+class Profiler:
+    r"""Record the time spent in named spans.
+
+    A disabled profiler hands out one shared no-op context manager, so the spans left in the code cost a method call.
+    Spans opened in DataLoader worker processes are recorded in those processes and are lost, profile with
+    ``DATALOADER.NUM_WORKERS: 0`` to see the decode and transform spans.
+
+    Args:
+        enabled (bool, optional): Record the spans. Defaults to False.
+        synchronize (bool, optional): Wait for the CUDA kernels at the end of every span, so that the spans cover the device
+            time instead of the launch time. Defaults to False.
+
+    Examples:
+        >>> from padim.utils import Profiler
+        >>> profiler = Profiler(enabled=True)
+        >>> with profiler.span("model.backbone"):
+        ...     features = feature_extractor(images)
+        >>> print(profiler.format_summary())
+        >>> profiler.export_chrome_trace("trace.json")
+    """
+
+    def __init__(self, enabled: bool = False, synchronize: bool = False) -> None:
+        self.enabled = enabled
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.events: list[tuple[str, float, float, int]] = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def span(self, name: str) -> _Span | _NullSpan:
+        """Context manager recording the time spent in its body under ``name``."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def add(self, name: str, start_time: float, end_time: float) -> None:
+        """Record a span measured elsewhere, the times come from :func:`time.perf_counter`."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.events.append((name, start_time, end_time, threading.get_ident()))
+
+    def reset(self) -> None:
+        with self.lock:
+            self.events = []
+            self.origin = time.perf_counter()
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Count, total, mean and percentiles of every span, in milliseconds, the spans with the largest total first."""
+        durations = defaultdict(list)
+        with self.lock:
+            for name, start_time, end_time, _ in self.events:
+                durations[name].append((end_time - start_time) * 1000)
+
+        summary = {}
+        for name, values in durations.items():
+            values = np.asarray(values)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            summary[name] = {
+                "count": len(values),
+                "total_ms": float(values.sum()),
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(p50),
+                "p90_ms": float(p90),
+                "p99_ms": float(p99),
+                "max_ms": float(values.max()),
+            }
+        return dict(sorted(summary.items(), key=lambda item: item[1]["total_ms"], reverse=True))
+
+    def format_summary(self) -> str:
+        lines = [f"{'span':<32}{'count':>8}{'total ms':>12}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:<32}{stats['count']:>8}{stats['total_ms']:>12.2f}{stats['mean_ms']:>10.3f}{stats['p50_ms']:>10.3f}"
+                         f"{stats['p90_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+        return "\n".join(lines)
+
+    def report(self, trace_path: str | Path | None = None) -> None:
+        """Log the summary and export the Chrome trace to ``trace_path`` if given, nothing happens when disabled."""
+        if not self.enabled:
+            return
+        logger.info("Profile:\n" + self.format_summary())
+        if trace_path is not None:
+            self.export_chrome_trace(trace_path)
+
+    def export_chrome_trace(self, path: str | Path) -> None:
+        """Write the spans in the Chrome trace event format, which Perfetto and ``chrome://tracing`` open."""
+        pid = os.getpid()
+        with self.lock:
+            trace_events: list[dict[str, Any]] = [{
+                "name": name,
+                "cat": name.split(".", 1)[0],
+                "ph": "X",
+                "ts": (start_time - self.origin) * 1e6,
+                "dur": (end_time - start_time) * 1e6,
+                "pid": pid,
+                "tid": tid,
+            } for name, start_time, end_time, tid in self.events]
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        logger.info(f"Saved {len(trace_events)} profiler spans to '{path}'")
+
+
+_profiler = Profiler()
+
+
+def get_profiler() -> Profiler:
+    """The process-wide profiler used by the trainer, the evaler, the model and the datasets."""
+    return _profiler
+
+
+def configure_profiler(profile_dict: DictConfig | dict | None) -> Profiler:
+    r"""Configure the process-wide profiler from the ``PROFILE`` config.
+
+    Args:
+        profile_dict (DictConfig | dict, optional): ``ENABLED`` and ``SYNCHRONIZE``. None disables the profiler.
+
+    Returns:
+        Profiler: the process-wide profiler.
+    """
+    profile_dict = profile_dict or {}
+    _profiler.enabled = profile_dict.get("ENABLED", False)
+    _profiler.synchronize = profile_dict.get("SYNCHRONIZE", False) and torch.cuda.is_available()
+    _profiler.reset()
+    return _profiler
@@ -0,0 +1,181 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Vectorized OpenCV renderer of the anomaly visualizations
+"""
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+__all__ = [
+    "VisualRenderer",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class VisualRenderer(object):
+    r"""Render heat map overlays and segmentation contours with OpenCV colormaps on a pool of worker threads.
+
+    OpenCV releases the GIL while it colors, blends, encodes and writes an image, so the threads run in parallel and the
+    caller only pays for submitting the work. Call :meth:`close` to wait for the pending files.
+
+    Args:
+        save_dir (str | Path): Directory the images are written to.
+        num_workers (int, optional): Number of rendering threads. Defaults to 4.
+        top_k (int, optional): Only render the ``top_k`` most anomalous images. Defaults to None (render all).
+        alpha (float, optional): Opacity of the heat map over the image. Defaults to 0.5.
+        mean (tuple[float], optional): Normalization mean of the input images. Defaults to the ImageNet mean.
+        std (tuple[float], optional): Normalization std of the input images. Defaults to the ImageNet std.
+
+    Examples:
+        >>> import numpy as np
+        >>> from padim.utils import VisualRenderer
+        >>> renderer = VisualRenderer("results/eval/visual", top_k=10)
+        >>> images = np.random.rand(32, 3, 224, 224).astype(np.float32)
+        >>> scores = np.random.rand(32, 1, 224, 224).astype(np.float32)
+        >>> gts = np.zeros((32, 1, 224, 224), dtype=np.float32)
+        >>> renderer.render_segmentation(images, scores, gts, threshold=0.5)
+        >>> renderer.close()
+    """
+
+    def __init__(
+            self,
+            save_dir: str | Path,
+            num_workers: int = 4,
+            top_k: int = None,
+            alpha: float = 0.5,
+            mean: tuple[float] = (0.485, 0.456, 0.406),
+            std: tuple[float] = (0.229, 0.224, 0.225),
+    ) -> None:
+        self.save_dir = Path(save_dir)
+        self.save_dir.mkdir(exist_ok=True, parents=True)
+        self.top_k = top_k
+        self.alpha = alpha
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="render")
+        self.futures: list[Future] = []
+
+    def select(self, scores: np.ndarray) -> np.ndarray:
+        """Indices of the images to render, the most anomalous first when ``top_k`` is set."""
+        if self.top_k is None or self.top_k >= len(scores):
+            return np.arange(len(scores))
+        image_scores = scores.reshape(len(scores), -1).max(axis=1)
+        return np.argsort(-image_scores, kind="stable")[:self.top_k]
+
+    def to_bgr(self, images: np.ndarray) -> np.ndarray:
+        """De-normalize a batch of CHW RGB images into HWC BGR uint8 images."""
+        images = images.transpose(0, 2, 3, 1)
+        if images.dtype != np.uint8:
+            images = np.clip((images * self.std + self.mean) * 255.0, 0, 255).astype(np.uint8)
+        return np.ascontiguousarray(images[..., ::-1])
+
+    @staticmethod
+    def to_heat_map(scores: np.ndarray) -> np.ndarray:
+        """Color a (H, W) score map in ``[0, 1]`` with the jet colormap."""
+        heat_map = (np.clip(scores, 0, 1) * 255).astype(np.uint8)
+        return cv2.applyColorMap(heat_map, cv2.COLORMAP_JET)
+
+    def render_segmentation(
+            self,
+            images: np.ndarray,
+            scores: np.ndarray,
+            gts: np.ndarray,
+            threshold: float,
+            names: list[str] = None,
+    ) -> None:
+        """Submit the image / ground truth / heat map / predicted mask / segmentation result panels of every selected image.
+
+        Args:
+            images (np.ndarray): Normalized (N, 3, H, W) float images, or uint8 images.
+            scores (np.ndarray): Normalized (N, 1, H, W) anomaly scores.
+            gts (np.ndarray): (N, 1, H, W) ground truth masks in ``[0, 1]``.
+            threshold (float): Normalized pixel threshold of the predicted mask.
+            names (list[str], optional): File names, defaults to the image indices.
+        """
+        index = self.select(scores)
+        bgr_images = self.to_bgr(images[index])
+        for i, bgr_image in zip(index, bgr_images):
+            name = names[i] if names is not None else f"{i}.png"
+            self.futures.append(self.executor.submit(
+                self._render_segmentation, bgr_image, scores[i, 0], gts[i, 0], threshold, self.save_dir / name,
+            ))
+
+    def render_score_map(self, images: np.ndarray, scores: np.ndarray, names: list[str] = None) -> None:
+        """Submit the image / heat map panels with the image score of every selected image.
+
+        Args:
+            images (np.ndarray): Normalized (N, 3, H, W) float images, or uint8 images.
+            scores (np.ndarray): Normalized (N, 1, H, W) anomaly scores.
+            names (list[str], optional): File names, defaults to the image indices.
+        """
+        index = self.select(scores)
+        bgr_images = self.to_bgr(images[index])
+        for i, bgr_image in zip(index, bgr_images):
+            name = names[i] if names is not None else f"{i}.png"
+            self.futures.append(self.executor.submit(self._render_score_map, bgr_image, scores[i, 0], self.save_dir / name))
+
+    def _render_segmentation(self, image: np.ndarray, scores: np.ndarray, gt: np.ndarray, threshold: float, save_path: Path) -> None:
+        heat_map = cv2.addWeighted(image, 1 - self.alpha, self.to_heat_map(scores), self.alpha, 0)
+
+        mask = (scores > threshold).astype(np.uint8) * 255
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        segmentation = cv2.drawContours(image.copy(), contours, -1, (0, 0, 255), 2)
+
+        gt = cv2.cvtColor((np.clip(gt, 0, 1) * 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+        mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+        panels = [
+            self._label(image, "Image"),
+            self._label(gt, "GroundTruth"),
+            self._label(heat_map, "Predicted heat map"),
+            self._label(mask, "Predicted mask"),
+            self._label(segmentation, "Segmentation result"),
+        ]
+        self._write(save_path, np.hstack(panels))
+
+    def _render_score_map(self, image: np.ndarray, scores: np.ndarray, save_path: Path) -> None:
+        heat_map = cv2.addWeighted(image, 1 - self.alpha, self.to_heat_map(scores), self.alpha, 0)
+        heat_map = self._label(heat_map, "Predicted heat map")
+        text = f"score:{scores.max() * 100:.1f}%"
+        (text_width, _), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+        cv2.putText(heat_map, text, (heat_map.shape[1] - text_width - 4, 28), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+        self._write(save_path, np.hstack([self._label(image, "Image"), heat_map]))
+
+    @staticmethod
+    def _label(image: np.ndarray, text: str) -> np.ndarray:
+        image = image.copy()
+        cv2.putText(image, text, (4, 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+        return image
+
+    @staticmethod
+    def _write(save_path: Path, image: np.ndarray) -> None:
+        if not cv2.imwrite(str(save_path), image):
+            logger.warning(f"Failed to write '{save_path}'")
+
+    def wait(self) -> None:
+        """Block until every submitted image is written."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        """Wait for the pending images and stop the worker threads."""
+        self.wait()
+        self.executor.shutdown()
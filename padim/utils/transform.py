@@ -18,8 +18,11 @@ import logging
 
 import albumentations as A
 import cv2
+import torch
 from albumentations.pytorch import ToTensorV2
 from omegaconf import DictConfig
+from torch import Tensor
+from torch.nn import functional as F_torch
 
 logger = logging.getLogger(__name__)
 
@@ -53,3 +56,108 @@ def get_data_transform(transform_dict: DictConfig) -> list:
     logger.info(f"transform_list: {transform_list}")
 
     return transform_list
+
+
+def create_image_and_mask_transforms(transform_dict: DictConfig | dict, batched: bool = False) -> tuple[A.Compose, A.Compose]:
+    r"""Create the image transform and the mask transform.
+
+    Both resize and crop uint8 arrays into uint8 tensors, the normalization is left to the model input
+    (see :meth:`padim.models.PaDiM.normalize_input`) so that the images stay 1 byte per value until they are batched.
+
+    Args:
+        transform_dict (DictConfig | dict): transform config.
+        batched (bool, optional): The resize and crop are applied to whole batches by :class:`BatchTransform`, the
+            per-sample transforms only convert to tensors. Defaults to False.
+
+    Returns:
+        tuple[A.Compose, A.Compose]: image transform and mask transform.
+    """
+    excluded_keys = ["NORMALIZE", "RESIZE", "CENTER_CROP"] if batched else ["NORMALIZE"]
+    transform_dict = {key: value for key, value in transform_dict.items() if key not in excluded_keys}
+    image_transforms = A.Compose(get_data_transform(transform_dict))
+    mask_transforms = A.Compose(get_data_transform(transform_dict))
+
+    return image_transforms, mask_transforms
+
+
+def get_normalize_mean_and_std(transform_dict: DictConfig | dict) -> tuple[tuple[float, ...], tuple[float, ...]]:
+    r"""Get the normalization mean and std of a transform config, an identity normalization if there is none.
+
+    Args:
+        transform_dict (DictConfig | dict): transform config.
+
+    Returns:
+        tuple[tuple[float, ...], tuple[float, ...]]: mean and std.
+    """
+    normalize_transform = transform_dict.get("NORMALIZE", {})
+    if not normalize_transform:
+        return (0.0, 0.0, 0.0), (1.0, 1.0, 1.0)
+
+    return tuple(normalize_transform.get("MEAN")), tuple(normalize_transform.get("STD"))
+
+
+class BatchTransform(object):
+    r"""Resize, center-crop and normalize a whole batch of images at once with torch ops.
+
+    It reproduces :func:`get_data_transform` exactly: the nearest interpolation of ``torch.nn.functional.interpolate``
+    picks the same source pixels as ``cv2.INTER_NEAREST``, and the crop offsets are those of ``A.CenterCrop``.
+    All images of a batch must have the same size.
+
+    Args:
+        transform_dict (DictConfig | dict): transform config.
+        normalize (bool, optional): Apply ``NORMALIZE`` and return float images, else keep the input dtype, as for the
+            masks. Defaults to True.
+
+    Examples:
+        >>> import torch
+        >>> from padim.utils import BatchTransform
+        >>> transform = BatchTransform({"RESIZE": {"HEIGHT": 256, "WIDTH": 256}, "CENTER_CROP": {"HEIGHT": 224, "WIDTH": 224}})
+        >>> images = torch.randint(0, 256, (32, 3, 900, 900), dtype=torch.uint8)
+        >>> transform(images).shape
+            torch.Size([32, 3, 224, 224])
+    """
+
+    def __init__(self, transform_dict: DictConfig | dict, normalize: bool = True) -> None:
+        resize_transform = transform_dict.get("RESIZE", {})
+        center_crop_transform = transform_dict.get("CENTER_CROP", {})
+        self.resize_size = (resize_transform.get("HEIGHT"), resize_transform.get("WIDTH")) if resize_transform else None
+        self.crop_size = (center_crop_transform.get("HEIGHT"), center_crop_transform.get("WIDTH")) if center_crop_transform else None
+
+        self.mean = self.std = None
+        if normalize:
+            mean, std = get_normalize_mean_and_std(transform_dict)
+            self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+            self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    def __call__(self, images: Tensor) -> Tensor:
+        """Transform a (B, C, H, W) batch of uint8 images."""
+        if self.resize_size is not None and tuple(images.shape[-2:]) != self.resize_size:
+            images = F_torch.interpolate(images, size=self.resize_size, mode="nearest")
+
+        if self.crop_size is not None:
+            height, width = images.shape[-2:]
+            crop_height, crop_width = self.crop_size
+            if crop_height > height or crop_width > width:
+                raise ValueError(f"Crop size {self.crop_size} is larger than the image size {(height, width)}")
+            top = (height - crop_height) // 2
+            left = (width - crop_width) // 2
+            images = images[..., top:top + crop_height, left:left + crop_width]
+
+        if self.mean is not None:
+            mean = self.mean.to(images.device)
+            std = self.std.to(images.device)
+            images = (images.float() / 255.0 - mean) / std
+
+        return images
+
+
+def create_batch_transforms(transform_dict: DictConfig | dict) -> tuple[BatchTransform, BatchTransform]:
+    r"""Create the batched image transform and the batched mask transform, the masks are not normalized.
+
+    Args:
+        transform_dict (DictConfig | dict): transform config.
+
+    Returns:
+        tuple[BatchTransform, BatchTransform]: image transform and mask transform.
+    """
+    return BatchTransform(transform_dict, normalize=True), BatchTransform(transform_dict, normalize=False)
@@ -0,0 +1,140 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import argparse
+import logging
+import os
+from pathlib import Path
+
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+from padim.datasets import FolderDataset, MVTecDataset
+from padim.datasets.utils import BatchTransformLoader, create_dataloader, measure_loader_throughput
+from padim.utils import create_batch_transforms, create_image_and_mask_transforms, select_device
+from padim.utils.logger import configure_logger
+
+logger = logging.getLogger("padim")
+
+
+def get_opts() -> argparse.Namespace:
+    """Get parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser object.
+    """
+    parser = argparse.ArgumentParser(description="Measure the data loader throughput and write the fastest settings to the config.")
+    parser.add_argument("config", metavar="FILE", help="Path to config file.")
+    parser.add_argument("--output", type=str, default=None, help="Write the tuned config here, <config>.tuned.yaml by default. "
+                                                                  "Comments of the config are not kept.")
+    parser.add_argument("--max-batches", type=int, default=20, help="Batches measured per candidate.")
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[], help="Also tune TRAIN.HYP.IMGS_PER_BATCH over these values.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the best settings.")
+    parser.add_argument("--log-level", type=str, default="INFO", help="<DEBUG, INFO, WARNING, ERROR>")
+    opts = parser.parse_args()
+
+    return opts
+
+
+def create_train_datasets(config: DictConfig) -> FolderDataset | MVTecDataset:
+    """Create the training dataset the same way as :class:`padim.engine.Trainer`."""
+    batched = config.DATASETS.get("TRANSFORM_BACKEND", "albumentations") == "torch"
+    image_transforms, mask_transforms = create_image_and_mask_transforms(config.DATASETS.TRANSFORMS, batched)
+    center_crop_dict = config.DATASETS.TRANSFORMS.CENTER_CROP
+    mask_size = (center_crop_dict.get("HEIGHT"), center_crop_dict.get("WIDTH"))
+    cache_dir = config.DATASETS.get("CACHE_DIR")
+    reduced_decode = config.DATASETS.get("REDUCED_DECODE", False)
+
+    if config.TASK == "classification":
+        return FolderDataset(config.DATASETS.ROOT.get("TRAIN"), image_transforms, mask_size, True, cache_dir, reduced_decode)
+    return MVTecDataset(config.DATASETS.ROOT, config.DATASETS.CATEGORY, image_transforms, mask_transforms, mask_size, True,
+                        cache_dir, reduced_decode)
+
+
+def measure(config: DictConfig, datasets, device: torch.device, dataloader_dict: dict, batch_size: int, max_batches: int) -> float:
+    dataloader = create_dataloader(datasets, batch_size, device, dataloader_dict)
+    if config.DATASETS.get("TRANSFORM_BACKEND", "albumentations") == "torch":
+        dataloader = BatchTransformLoader(dataloader, *create_batch_transforms(config.DATASETS.TRANSFORMS))
+
+    images_per_second = measure_loader_throughput(dataloader, max_batches)
+    logger.info(f"batch size {batch_size}, {dataloader_dict}: {images_per_second:.1f} images/s")
+    return images_per_second
+
+
+def autotune(args: argparse.Namespace):
+    """Greedily tune the data loader settings one at a time, keeping the best value of each before tuning the next one.
+
+    Args:
+        args (Namespace): The arguments from the command line.
+    """
+    configure_logger(level=args.log_level)
+
+    # the saved config loses the comments and the layout of the input, which is never overwritten
+    config_path = Path(args.config)
+    output_path = Path(args.output) if args.output else config_path.with_suffix(".tuned.yaml")
+    if output_path.resolve() == config_path.resolve():
+        raise ValueError(f"The tuned config would overwrite the input config '{config_path}', choose another --output")
+
+    config = OmegaConf.load(config_path)
+    device = select_device(config["DEVICE"])
+    datasets = create_train_datasets(config)
+
+    best_dict = {
+        "NUM_WORKERS": 4,
+        "PREFETCH_FACTOR": 2,
+        "PIN_MEMORY": True,
+        "PERSISTENT_WORKERS": True,
+        "PREFETCH_QUEUE_SIZE": 2,
+    }
+    best_dict.update(OmegaConf.to_container(config.get("DATALOADER", OmegaConf.create())))
+    best_batch_size = config.TRAIN.HYP.get("IMGS_PER_BATCH")
+
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    candidates = [
+        ("NUM_WORKERS", sorted({0, 1, 2, 4, 8, num_cpus} & set(range(num_cpus + 1)))),
+        ("PREFETCH_FACTOR", [2, 4, 8]),
+        ("PREFETCH_QUEUE_SIZE", [1, 2, 4]),
+    ]
+    if device.type == "cuda":
+        candidates.append(("PIN_MEMORY", [False, True]))
+
+    best_images_per_second = measure(config, datasets, device, best_dict, best_batch_size, args.max_batches)
+    for key, values in candidates:
+        for value in values:
+            if value == best_dict[key]:
+                continue
+            candidate_dict = {**best_dict, key: value}
+            images_per_second = measure(config, datasets, device, candidate_dict, best_batch_size, args.max_batches)
+            if images_per_second > best_images_per_second:
+                best_images_per_second, best_dict = images_per_second, candidate_dict
+
+    for batch_size in args.batch_sizes:
+        if batch_size == best_batch_size:
+            continue
+        images_per_second = measure(config, datasets, device, best_dict, batch_size, args.max_batches)
+        if images_per_second > best_images_per_second:
+            best_images_per_second, best_batch_size = images_per_second, batch_size
+
+    logger.info(f"Best: batch size {best_batch_size}, {best_dict}: {best_images_per_second:.1f} images/s")
+    if args.dry_run:
+        return
+
+    config.DATALOADER = best_dict
+    config.TRAIN.HYP.IMGS_PER_BATCH = best_batch_size
+    OmegaConf.save(config, output_path)
+    logger.info(f"Saved tuned config to '{output_path}'")
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    autotune(opts)
@@ -0,0 +1,420 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Benchmark suite on synthetic MVTec-shaped data.
+
+Run the benchmarks, every backbone and resolution in its own process so that the peak memory is measured per case:
+
+    python tools/benchmark.py run --backbones resnet18 wide_resnet50_2 --image-sizes 224 320 --output results/benchmark/new.json
+
+Measure how the bulk scoring throughput scales with CPU worker processes, counts above the available cores are skipped:
+
+    python tools/benchmark.py run --processes 1 2 4 8 16 --output results/benchmark/parallel.json
+
+Compare two result files, the exit code is 1 when a metric regressed by more than its threshold:
+
+    python tools/benchmark.py compare results/benchmark/base.json results/benchmark/new.json --threshold 0.1
+"""
+import argparse
+import json
+import logging
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+
+from padim.datasets import MVTecDataset, create_synthetic_mvtec
+from padim.datasets.utils import create_dataloader, measure_loader_throughput
+from padim.engine import ParallelScorer, get_available_cores
+from padim.models import PaDiM, create_manifest, get_model_tensors, load_checkpoint, save_checkpoint
+from padim.models.module import AnomalyMap, POST_PROCESS_MODES
+from padim.utils import create_image_and_mask_transforms, select_device
+from padim.utils.logger import configure_logger
+
+logger = logging.getLogger("padim")
+
+RETURN_NODES = ["layer1", "layer2", "layer3"]
+
+# metric name prefix: True if higher is better
+METRIC_DIRECTIONS = {
+    "fit_seconds": False,
+    "feature_extraction_seconds": False,
+    "gaussian_fit_seconds": False,
+    "fit_peak_memory_mb": False,
+    "peak_memory_mb": False,
+    "latency_ms_per_image": False,
+    "score_latency_ms_per_image": False,
+    "cascade_score_latency_ms_per_image": False,
+    "cascade_work_saved": True,
+    "anomaly_map_ms_per_image": False,
+    "post_process_ms_per_image": False,
+    "images_per_second": True,
+    "parallel_images_per_second": True,
+    "loader_images_per_second": True,
+    "checkpoint_mb": False,
+    "checkpoint_load_seconds": False,
+    "pool_gaussian_mb": False,
+    "pool_score_latency_ms_per_image": False,
+    "pool_image_roc_auc": True,
+    "pool_pixel_roc_auc": True,
+}
+
+
+def get_opts() -> argparse.Namespace:
+    """Get parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser object.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark PaDiM on synthetic data and compare benchmark results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument("--backbones", type=str, nargs="+", default=["resnet18"], help="Backbones to benchmark.")
+    run_parser.add_argument("--image-sizes", type=int, nargs="+", default=[224], help="Model input resolutions.")
+    run_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32], help="Batch sizes of the latency measurement.")
+    run_parser.add_argument("--num-train", type=int, default=64, help="Synthetic training images.")
+    run_parser.add_argument("--num-test", type=int, default=16, help="Synthetic normal and defective test images, each.")
+    run_parser.add_argument("--num-workers", type=int, default=2, help="DataLoader workers.")
+    run_parser.add_argument("--repeats", type=int, default=5, help="Timed repeats of every latency measurement.")
+    run_parser.add_argument("--cascade-rank", type=int, default=16, help="Rank of the cascaded scoring bounds.")
+    run_parser.add_argument("--pool-strides", type=int, nargs="*", default=[1, 2, 4],
+                            help="Embedding pooling strides whose model size, latency and accuracy on the synthetic defects "
+                                 "are measured, the accuracy is only meaningful with --pretrained.")
+    run_parser.add_argument("--processes", type=int, nargs="*", default=[],
+                            help="Worker process counts of the CPU data-parallel throughput measurement, e.g. 1 2 4 8.")
+    run_parser.add_argument("--device", type=str, default="cpu", help="<cpu, cuda>")
+    run_parser.add_argument("--pretrained", action="store_true", help="Download the pretrained backbone weights, "
+                                                                      "by default the backbone is randomly initialized.")
+    run_parser.add_argument("--data-dir", type=str, default=None, help="Keep the synthetic datasets in this directory.")
+    run_parser.add_argument("--output", type=str, default="results/benchmark/benchmark.json", help="Result file.")
+
+    case_parser = subparsers.add_parser("case", help=argparse.SUPPRESS)
+    case_parser.add_argument("case", type=str, help="JSON encoded case.")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files.")
+    compare_parser.add_argument("base", type=str, help="Baseline result file.")
+    compare_parser.add_argument("new", type=str, help="New result file.")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Allowed relative regression of every metric.")
+    compare_parser.add_argument("--metric-threshold", type=str, nargs="*", default=[],
+                                help="Per metric allowed relative regression, e.g. checkpoint_mb=0 fit_seconds=0.2.")
+
+    parser.add_argument("--log-level", type=str, default="INFO", help="<DEBUG, INFO, WARNING, ERROR>")
+    opts = parser.parse_args()
+
+    return opts
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_function(function: Callable[[], Any], device: torch.device, repeats: int) -> float:
+    """Median time of ``function`` in seconds, after one warm-up call."""
+    function()
+    synchronize(device)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        synchronize(device)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def get_peak_memory_mb(device: torch.device) -> float:
+    """Peak resident memory of this process, or the peak allocated device memory on CUDA."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def get_directory_size_mb(path: Path) -> float:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) / 2 ** 20
+
+
+def run_case(case: dict[str, Any]) -> dict[str, Any]:
+    """Benchmark one backbone at one resolution. Runs in a fresh process, the peak memory only covers this case."""
+    device = select_device(case["device"])
+    image_size = case["image_size"]
+    transforms_dict = {
+        "RESIZE": {"HEIGHT": image_size, "WIDTH": image_size},
+        "CENTER_CROP": {"HEIGHT": image_size, "WIDTH": image_size},
+        "NORMALIZE": {"MEAN": [0.485, 0.456, 0.406], "STD": [0.229, 0.224, 0.225]},
+    }
+    mask_size = (image_size, image_size)
+    image_transforms, mask_transforms = create_image_and_mask_transforms(transforms_dict)
+    train_datasets = MVTecDataset(case["data_root"], case["category"], image_transforms, mask_transforms, mask_size, True)
+    dataloader_dict = {"NUM_WORKERS": case["num_workers"]}
+    batch_size = max(case["batch_sizes"])
+    results: dict[str, Any] = {"backbone": case["backbone"], "image_size": image_size}
+
+    # data loading alone
+    train_loader = create_dataloader(train_datasets, batch_size, device, dataloader_dict)
+    results["loader_images_per_second"] = measure_loader_throughput(train_loader)
+
+    # fit
+    model = PaDiM(case["backbone"], RETURN_NODES, case["pretrained"], mask_size).to(device)
+    start_time = time.perf_counter()
+    embeddings = []
+    for batch_data in train_loader:
+        embeddings.append(model(batch_data["image"].to(device, non_blocking=True)))
+    embeddings = torch.vstack(embeddings)
+    synchronize(device)
+    results["feature_extraction_seconds"] = time.perf_counter() - start_time
+    gaussian_start_time = time.perf_counter()
+    model.multi_variate_gaussian.fit(embeddings)
+    synchronize(device)
+    results["gaussian_fit_seconds"] = time.perf_counter() - gaussian_start_time
+    results["fit_seconds"] = time.perf_counter() - start_time
+    results["fit_peak_memory_mb"] = get_peak_memory_mb(device)
+    del embeddings
+
+    # inference latency and throughput
+    model.eval()
+    results["latency_ms_per_image"] = {}
+    results["score_latency_ms_per_image"] = {}
+    results["anomaly_map_ms_per_image"] = {}
+    images_per_second = 0.0
+    for batch_size in case["batch_sizes"]:
+        images = torch.randint(0, 256, (batch_size, 3, image_size, image_size), dtype=torch.uint8, device=device)
+        with torch.no_grad():
+            seconds = time_function(lambda: model(images), device, case["repeats"])
+            score_seconds = time_function(lambda: model.predict(images, threshold=float("inf")), device, case["repeats"])
+            embedding = model.generate_embedding(model.feature_extractor(model.normalize_input(images)))
+            gaussian = model.multi_variate_gaussian
+            anomaly_map_seconds = time_function(lambda: model.anomaly_map(embedding, gaussian.mean, gaussian.inv_covariance),
+                                                device, case["repeats"])
+        results["latency_ms_per_image"][str(batch_size)] = seconds * 1000 / batch_size
+        results["score_latency_ms_per_image"][str(batch_size)] = score_seconds * 1000 / batch_size
+        results["anomaly_map_ms_per_image"][str(batch_size)] = anomaly_map_seconds * 1000 / batch_size
+        images_per_second = max(images_per_second, batch_size / seconds)
+    results["images_per_second"] = images_per_second
+
+    # anomaly map post-processing modes, timed and compared to the reference at the largest batch size
+    results["post_process_ms_per_image"] = {}
+    results["post_process_max_error"] = {}
+    distances = torch.rand((batch_size, 1, *embedding.shape[-2:]), device=device) * 100
+    reference = None
+    for mode in POST_PROCESS_MODES:
+        anomaly_map = AnomalyMap(mask_size, post_process_mode=mode)
+        with torch.no_grad():
+            seconds = time_function(lambda: anomaly_map.post_process(distances), device, case["repeats"])
+            output = anomaly_map.post_process(distances)
+        if reference is None:
+            reference = output
+        results["post_process_ms_per_image"][mode] = seconds * 1000 / batch_size
+        results["post_process_max_error"][mode] = (output - reference).abs().max().item()
+
+    # cascaded scoring of the test images, thresholded at the 90th percentile of their exact scores
+    test_datasets = MVTecDataset(case["data_root"], case["category"], image_transforms, mask_transforms, mask_size, False)
+    test_images = torch.stack([test_datasets[i]["image"] for i in range(len(test_datasets))]).to(device)
+    with torch.no_grad():
+        threshold = float(model.predict(test_images, threshold=float("inf"))["scores"].quantile(0.9))
+        model.cascade_rank = case["cascade_rank"]
+        model.predict(test_images[:1], threshold=threshold)
+        model.cascade.reset()
+        cascade_seconds = time_function(lambda: model.predict(test_images, threshold=threshold), device, case["repeats"])
+    report = model.cascade.report()
+    results["cascade_score_latency_ms_per_image"] = cascade_seconds * 1000 / len(test_images)
+    results["cascade_work_saved"] = report["work_saved"]
+    results["cascade_candidates_fraction"] = report["candidates"] / report["images"]
+    model.cascade_rank = None
+
+    # checkpoint, the randomly initialized backbone has to be embedded to be loaded again
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint_path = Path(checkpoint_dir) / "model"
+        save_checkpoint(checkpoint_path,
+                        create_manifest(model, transforms_dict, mask_size),
+                        get_model_tensors(model, include_backbone=not case["pretrained"]))
+        results["checkpoint_mb"] = get_directory_size_mb(checkpoint_path)
+        results["checkpoint_includes_backbone"] = not case["pretrained"]
+        start_time = time.perf_counter()
+        load_checkpoint(checkpoint_path, device)
+        synchronize(device)
+        results["checkpoint_load_seconds"] = time.perf_counter() - start_time
+
+        # bulk scoring throughput of the worker processes, each scoring whole batches on its share of the cores
+        if case["processes"] and device.type == "cpu":
+            results["parallel_images_per_second"] = {}
+            batches = [torch.randint(0, 256, (batch_size, 3, image_size, image_size), dtype=torch.uint8)
+                       for _ in range(2 * max(case["processes"]))]
+            for num_processes in case["processes"]:
+                with ParallelScorer(checkpoint_path, num_processes) as scorer:
+                    list(scorer.map(batches[:num_processes]))
+                    start_time = time.perf_counter()
+                    list(scorer.map(batches))
+                    seconds = time.perf_counter() - start_time
+                results["parallel_images_per_second"][f"procs{num_processes}"] = len(batches) * batch_size / seconds
+
+    results["peak_memory_mb"] = get_peak_memory_mb(device)
+
+    # embedding pooling: the Gaussian is refitted from the training images at every stride and the test images scored
+    if case["pool_strides"]:
+        targets = np.array([int(test_datasets[i]["target"]) for i in range(len(test_datasets))])
+        masks = np.stack([np.asarray(test_datasets[i]["mask"]) for i in range(len(test_datasets))]).reshape(len(targets), -1) > 0
+        for name in ["pool_gaussian_mb", "pool_score_latency_ms_per_image", "pool_image_roc_auc", "pool_pixel_roc_auc"]:
+            results[name] = {}
+        gaussian = model.multi_variate_gaussian
+        for stride in case["pool_strides"]:
+            model.pool_stride = stride
+            with torch.no_grad():
+                for batch_data in train_loader:
+                    gaussian.update(model.extract_embedding(model.normalize_input(batch_data["image"].to(device))))
+                gaussian.finalize()
+                seconds = time_function(lambda: model(test_images), device, case["repeats"])
+                anomaly_maps = model(test_images).cpu().numpy().reshape(len(targets), -1)
+            key = f"stride{stride}"
+            results["pool_gaussian_mb"][key] = (gaussian.mean.numel() + gaussian.inv_covariance.numel()) * 4 / 2 ** 20
+            results["pool_score_latency_ms_per_image"][key] = seconds * 1000 / len(targets)
+            results["pool_image_roc_auc"][key] = float(roc_auc_score(targets, anomaly_maps.max(axis=1)))
+            results["pool_pixel_roc_auc"][key] = float(roc_auc_score(masks.ravel(), anomaly_maps.ravel()))
+        model.pool_stride = 1
+    return results
+
+
+def run(args: argparse.Namespace) -> None:
+    data_dir = Path(args.data_dir) if args.data_dir is not None else Path(tempfile.mkdtemp(prefix="padim-benchmark-"))
+    category = "synthetic"
+
+    # a worker process needs at least one core
+    num_cores = len(get_available_cores())
+    processes = [num_processes for num_processes in args.processes if num_processes <= num_cores]
+    if len(processes) < len(args.processes):
+        logger.warning(f"Skip {sorted(set(args.processes) - set(processes))} worker processes, only {num_cores} cores are available.")
+
+    all_results = []
+    try:
+        for image_size in args.image_sizes:
+            # the synthetic images are larger than the input, like the MVTec images, so that resizing is measured too
+            data_root = data_dir / f"size_{image_size}"
+            if not (data_root / category).is_dir():
+                create_synthetic_mvtec(data_root, category, (image_size * 2, image_size * 2),
+                                       args.num_train, args.num_test, args.num_test)
+
+            for backbone in args.backbones:
+                case = {
+                    "backbone": backbone,
+                    "image_size": image_size,
+                    "batch_sizes": args.batch_sizes,
+                    "num_workers": args.num_workers,
+                    "repeats": args.repeats,
+                    "cascade_rank": args.cascade_rank,
+                    "processes": processes,
+                    "pool_strides": args.pool_strides,
+                    "device": args.device,
+                    "pretrained": args.pretrained,
+                    "data_root": str(data_root),
+                    "category": category,
+                }
+                logger.info(f"Benchmark {backbone} at {image_size}x{image_size}")
+                completed = subprocess.run([sys.executable, __file__, "--log-level", "ERROR", "case", json.dumps(case)],
+                                           stdout=subprocess.PIPE, check=True, text=True)
+                results = json.loads(completed.stdout.strip().splitlines()[-1])
+                logger.info(json.dumps(results))
+                all_results.append(results)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": args.device,
+            "num_threads": torch.get_num_threads(),
+            "args": {key: value for key, value in vars(args).items() if key != "command"},
+        },
+        "results": all_results,
+    }
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(output, f, indent=2)
+    logger.info(f"Saved benchmark results to '{output_path}'")
+
+
+def flatten_metrics(results: dict[str, Any]) -> dict[str, float]:
+    """Flatten the per batch size and per mode metrics into ``name@bs<batch size>`` and ``name@<mode>`` entries."""
+    metrics = {}
+    for name, value in results.items():
+        if name not in METRIC_DIRECTIONS:
+            continue
+        if isinstance(value, dict):
+            for key, key_value in value.items():
+                metrics[f"{name}@bs{key}" if key.isdigit() else f"{name}@{key}"] = key_value
+        else:
+            metrics[name] = value
+    return metrics
+
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.base) as f:
+        base_results = {(r["backbone"], r["image_size"]): r for r in json.load(f)["results"]}
+    with open(args.new) as f:
+        new_results = {(r["backbone"], r["image_size"]): r for r in json.load(f)["results"]}
+    metric_thresholds = {key: float(value) for key, value in (item.split("=", 1) for item in args.metric_threshold)}
+
+    regressions = []
+    print(f"{'case':<28}{'metric':<34}{'base':>12}{'new':>12}{'change':>10}")
+    for key in sorted(base_results.keys() & new_results.keys()):
+        base_metrics = flatten_metrics(base_results[key])
+        new_metrics = flatten_metrics(new_results[key])
+        for metric in sorted(base_metrics.keys() & new_metrics.keys()):
+            name = metric.split("@")[0]
+            base_value, new_value = base_metrics[metric], new_metrics[metric]
+            change = (new_value - base_value) / base_value if base_value else 0.0
+            # positive when the new value is worse
+            regression = -change if METRIC_DIRECTIONS[name] else change
+            threshold = metric_thresholds.get(metric, metric_thresholds.get(name, args.threshold))
+            flag = ""
+            if regression > threshold:
+                flag = " REGRESSION"
+                regressions.append((key, metric))
+            print(f"{f'{key[0]}@{key[1]}':<28}{metric:<34}{base_value:>12.4g}{new_value:>12.4g}{change:>+10.1%}{flag}")
+
+    for key in sorted(base_results.keys() ^ new_results.keys()):
+        print(f"{key[0]}@{key[1]} is only in {'the baseline' if key in base_results else 'the new results'}")
+
+    if regressions:
+        print(f"{len(regressions)} metrics regressed beyond their threshold")
+        return 1
+    print("No regression")
+    return 0
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    configure_logger(level=opts.log_level)
+    if opts.command == "run":
+        run(opts)
+    elif opts.command == "case":
+        print(json.dumps(run_case(json.loads(opts.case))))
+    else:
+        sys.exit(compare(opts))
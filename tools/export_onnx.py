@@ -0,0 +1,88 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Export the backbone of a checkpoint to ONNX for the NumPy backend :class:`padim.deploy.NumpyPaDiM`:
+
+    python tools/export_onnx.py results/train/mvtec_bottle/model --output results/train/mvtec_bottle/backbone.onnx
+
+The exported graph takes normalized float images and returns the features of the return nodes, named after them.
+Exporting needs the ``onnx`` package, scoring the export needs ``onnxruntime`` and NumPy only.
+"""
+import argparse
+import logging
+from pathlib import Path
+
+import torch
+from torch import Tensor, nn
+
+from padim.models import load_checkpoint
+from padim.utils.logger import configure_logger
+
+logger = logging.getLogger("padim")
+
+
+class BackboneExport(nn.Module):
+    """Return the backbone features as a tuple in the order of the return nodes."""
+
+    def __init__(self, feature_extractor: nn.Module, return_nodes: list[str]) -> None:
+        super().__init__()
+        self.feature_extractor = feature_extractor
+        self.return_nodes = return_nodes
+
+    def forward(self, x: Tensor) -> tuple[Tensor, ...]:
+        features = self.feature_extractor(x)
+        return tuple(features[name] for name in self.return_nodes)
+
+
+def get_opts() -> argparse.Namespace:
+    """Get parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser object.
+    """
+    parser = argparse.ArgumentParser(description="Export the backbone of a checkpoint to ONNX.")
+    parser.add_argument("checkpoint", type=str, help="Checkpoint directory.")
+    parser.add_argument("--output", type=str, default=None, help="ONNX file, 'backbone.onnx' next to the checkpoint by default.")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version.")
+    parser.add_argument("--log-level", type=str, default="INFO", help="<DEBUG, INFO, WARNING, ERROR>")
+    opts = parser.parse_args()
+
+    return opts
+
+
+def export(args: argparse.Namespace) -> None:
+    checkpoint = load_checkpoint(args.checkpoint)
+    model = checkpoint["model"].eval()
+    if model.tiler is not None:
+        raise ValueError("Tiled checkpoints are not supported by the NumPy backend")
+    output_path = Path(args.output) if args.output is not None else Path(args.checkpoint).parent / "backbone.onnx"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    return_nodes = list(model.return_nodes)
+    images = torch.zeros(1, 3, *checkpoint["mask_size"])
+    torch.onnx.export(BackboneExport(model.feature_extractor.eval(), return_nodes),
+                      (images,),
+                      str(output_path),
+                      input_names=["images"],
+                      output_names=return_nodes,
+                      dynamic_axes={"images": {0: "batch"}, **{name: {0: "batch"} for name in return_nodes}},
+                      opset_version=args.opset,
+                      dynamo=False)
+    logger.info(f"Exported the {model.backbone} backbone to '{output_path}'")
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    configure_logger(level=opts.log_level)
+    export(opts)
@@ -0,0 +1,121 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import argparse
+import logging
+import sys
+
+from omegaconf import DictConfig, OmegaConf
+
+from padim.datasets import FolderDataset, MVTecDataset
+from padim.models import MemoryPlanner, Tiler, create_roi_mask, format_bytes, parse_bytes
+from padim.utils.logger import configure_logger
+
+logger = logging.getLogger("padim")
+
+
+def get_opts() -> argparse.Namespace:
+    """Get parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser object.
+    """
+    parser = argparse.ArgumentParser(description="Predict the peak memory of the fit and the inference of a config.")
+    parser.add_argument("config", metavar="FILE", help="Path to config file.")
+    parser.add_argument("--budget", type=str, default=None, help="Memory budget, e.g. 8GB, to suggest batch and chunk sizes.")
+    parser.add_argument("--num-train", type=int, default=None, help="Number of training images, counted from the dataset by default.")
+    parser.add_argument("--num-val", type=int, default=None, help="Number of validation images, counted from the dataset by default.")
+    parser.add_argument("--log-level", type=str, default="WARNING", help="<DEBUG, INFO, WARNING, ERROR>")
+    opts = parser.parse_args()
+
+    return opts
+
+
+def count_images(config: DictConfig, train: bool) -> int:
+    """Count the dataset images from the file lists, no image is decoded."""
+    if config.TASK == "classification":
+        root = config.DATASETS.ROOT.get("TRAIN") if train else config.DATASETS.ROOT.get("VAL")
+        return len(FolderDataset(root, train=train))
+    return len(MVTecDataset(config.DATASETS.ROOT, config.DATASETS.CATEGORY, train=train))
+
+
+def print_phase(name: str, plan: dict[str, int]) -> None:
+    print(f"{name}")
+    for key, value in plan.items():
+        print(f"  {key:<22}{format_bytes(value):>12}")
+
+
+def plan(args: argparse.Namespace) -> int:
+    configure_logger(level=args.log_level)
+    config = OmegaConf.load(args.config)
+
+    try:
+        num_train = args.num_train if args.num_train is not None else count_images(config, True)
+        num_val = args.num_val if args.num_val is not None else count_images(config, False)
+    except (FileNotFoundError, OSError) as e:
+        print(f"Cannot count the dataset images ({e}), pass --num-train and --num-val")
+        return 2
+
+    calibration_dict = config.TRAIN.get("CALIBRATION")
+    if calibration_dict:
+        num_train -= min(max(int(round(num_train * calibration_dict.get("HOLDOUT_RATIO", 0.1))), 1), num_train - 1)
+
+    center_crop_dict = config.DATASETS.TRANSFORMS.CENTER_CROP
+    image_size = (center_crop_dict.get("HEIGHT"), center_crop_dict.get("WIDTH"))
+    tiling_dict = config.MODEL.get("TILING", {})
+    tiler = None
+    if tiling_dict.get("ENABLED", False):
+        tiler = Tiler(tiling_dict.TILE_SIZE, tiling_dict.get("STRIDE"), tiling_dict.get("BLEND", "mean"))
+    roi_dict = config.MODEL.get("ROI", {})
+    roi_mask = create_roi_mask(image_size, roi_dict.get("BOXES"), roi_dict.get("MASK_PATH"))
+    planner = MemoryPlanner(config.MODEL.BACKBONE, config.MODEL.RETURN_NODES, image_size, tiler,
+                            tiling_dict.get("GAUSSIAN", "per_tile"), tiling_dict.get("TILES_PER_BATCH"), roi_mask,
+                            config.MODEL.get("POOL_STRIDE", 1), config.MODEL.get("NUM_FEATURES"))
+    train_batch_size = config.TRAIN.HYP.get("IMGS_PER_BATCH")
+    val_batch_size = config.VAL.get("IMGS_PER_BATCH")
+    chunk_size = config.MODEL.get("CHUNK_SIZE")
+    distance_budget = config.MODEL.get("DISTANCE_MEMORY_BUDGET")
+    distance_budget = None if distance_budget is None else parse_bytes(distance_budget)
+
+    print(f"{config.MODEL.BACKBONE} at {image_size[0]}x{image_size[1]}: features {planner.feature_shapes}, "
+          f"{planner.num_features} of {planner.max_features} channels at {planner.embedding_size[0]}x{planner.embedding_size[1]} positions"
+          + (f", {planner.num_tiles} tiles of {tiler.tile_size[0]}x{tiler.tile_size[1]}" if tiler is not None else "")
+          + (f", {planner.num_positions} positions in the region of interest" if roi_mask is not None else ""))
+    print(f"{num_train} training images, {num_val} validation images\n")
+    fit = planner.plan_fit(num_train, train_batch_size)
+    print_phase(f"Fit (batch size {train_batch_size})", fit)
+    print_phase(f"Inference (batch size {val_batch_size or num_val}, chunk size {chunk_size})",
+                planner.plan_inference(val_batch_size or num_val, chunk_size, distance_budget))
+    validation = planner.plan_validation(num_val, val_batch_size, chunk_size, distance_budget)
+    print_phase("Validation", validation)
+    print(f"Checkpoint: {format_bytes(planner.checkpoint_bytes())}, "
+          f"{format_bytes(planner.checkpoint_bytes(include_backbone=True))} with the backbone")
+
+    if args.budget is None:
+        return 0
+
+    budget = parse_bytes(args.budget)
+    suggestion = planner.suggest(budget, num_train, num_val)
+    print(f"\nSuggestions for a budget of {format_bytes(budget)}:")
+    print(f"  TRAIN.HYP.IMGS_PER_BATCH: {suggestion['TRAIN_BATCH_SIZE']}")
+    print(f"  VAL.IMGS_PER_BATCH: {suggestion['VAL_BATCH_SIZE']}")
+    print(f"  MODEL.CHUNK_SIZE: {suggestion['CHUNK_SIZE']}")
+    if not suggestion["fit_feasible"]:
+        print(f"  The Gaussian fit needs {format_bytes(fit['gaussian_fit'])} whatever the batch size, it does not fit in the budget")
+    fits = suggestion["fit_feasible"] and suggestion["TRAIN_BATCH_SIZE"] is not None and suggestion["VAL_BATCH_SIZE"] is not None
+    return 0 if fits else 1
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    sys.exit(plan(opts))
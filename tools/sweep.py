@@ -0,0 +1,373 @@
+# Copyright 2023 AlphaBetter Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+Sweep the embedding and Gaussian settings of a config from one backbone pass per crop size:
+
+    python tools/sweep.py ./configs/mvtec.yaml --num-features 50 100 200 --pool-strides 1 2 --epsilons 0.01 0.1 \
+        --return-nodes layer1.1.relu_1,layer2.1.relu_1,layer3.1.relu_1 layer1.1.relu_1,layer2.1.relu_1 \
+        --target 0.95 --output results/sweep/mvtec_bottle.json
+
+The features of all return nodes are extracted once for the training and test images of every crop size, the training
+images as :class:`padim.engine.Trainer` fits them: without the calibration hold-out, in batches of
+``TRAIN.HYP.IMGS_PER_BATCH`` and with the backbone in train mode, whose BatchNorm layers use the batch statistics. Every
+combination of return nodes, number of features, covariance regularization and pooling stride is fitted and scored from
+them on a thread pool. The result is a table of the image and pixel ROC AUC, the latency and the model size, with the
+Pareto optimal configurations marked, and the cheapest configuration that reaches the target.
+"""
+import argparse
+import copy
+import itertools
+import json
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+from sklearn.metrics import roc_auc_score
+from torch import Tensor
+
+from padim.datasets import MVTecDataset
+from padim.datasets.utils import create_dataloader
+from padim.engine import Trainer
+from padim.models import PaDiM
+from padim.models.module import AnomalyMap, FeatureExtractor, MultiVariateGaussian
+from padim.utils import create_image_and_mask_transforms, get_normalize_mean_and_std, select_device
+from padim.utils.logger import configure_logger
+
+logger = logging.getLogger("padim")
+
+METRICS = ["image_roc_auc", "pixel_roc_auc"]
+
+
+def get_opts() -> argparse.Namespace:
+    """Get parser.
+
+    Returns:
+        argparse.ArgumentParser: The parser object.
+    """
+    parser = argparse.ArgumentParser(description="Sweep the embedding and Gaussian settings of a config from shared backbone features.")
+    parser.add_argument("config", metavar="FILE", help="Path to config file.")
+    parser.add_argument("--return-nodes", type=str, nargs="+", default=None,
+                        help="Comma separated return node sets, the config's by default.")
+    parser.add_argument("--num-features", type=int, nargs="+", default=None, help="Selected channels, the config's by default.")
+    parser.add_argument("--crop-sizes", type=int, nargs="+", default=None, help="Square crop sizes, the config's by default.")
+    parser.add_argument("--epsilons", type=float, nargs="+", default=None, help="Covariance regularization, the config's by default.")
+    parser.add_argument("--pool-strides", type=int, nargs="+", default=None, help="Embedding pooling strides, the config's by default.")
+    parser.add_argument("--workers", type=int, default=2, help="Configurations fitted and scored at a time.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per test and scoring batch, the training images are "
+                                                                   "batched as in training.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repeats of every latency measurement.")
+    parser.add_argument("--metric", type=str, default="image_roc_auc", choices=METRICS, help="Accuracy metric of the target.")
+    parser.add_argument("--target", type=float, default=None, help="Accuracy to reach, e.g. 0.95.")
+    parser.add_argument("--output", type=str, default=None, help="JSON file of all results.")
+    parser.add_argument("--log-level", type=str, default="INFO", help="<DEBUG, INFO, WARNING, ERROR>")
+    opts = parser.parse_args()
+
+    return opts
+
+
+class ComputeGate(object):
+    """Let many workers compute at once, or one worker time its scoring alone so that the latencies are not measured
+    under contention. A waiting timer holds back new computations."""
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.computing = 0
+        self.timers_waiting = 0
+        self.timing = False
+
+    @contextmanager
+    def compute(self) -> Iterator[None]:
+        with self.condition:
+            self.condition.wait_for(lambda: not self.timing and not self.timers_waiting)
+            self.computing += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.computing -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self.condition:
+            self.timers_waiting += 1
+            self.condition.wait_for(lambda: not self.timing and not self.computing)
+            self.timers_waiting -= 1
+            self.timing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.timing = False
+                self.condition.notify_all()
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_function(function: Callable[[], Any], device: torch.device, repeats: int) -> float:
+    """Median time of ``function`` in seconds, after one warm-up call."""
+    function()
+    synchronize(device)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        synchronize(device)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def get_transforms_dict(config: DictConfig, crop_size: int) -> dict[str, Any]:
+    """The config transforms with a square center crop of ``crop_size``, resized to at least the crop."""
+    transforms_dict = copy.deepcopy(OmegaConf.to_container(config.DATASETS.TRANSFORMS))
+    transforms_dict["CENTER_CROP"] = {"HEIGHT": crop_size, "WIDTH": crop_size}
+    for key in ["HEIGHT", "WIDTH"]:
+        transforms_dict["RESIZE"][key] = max(transforms_dict["RESIZE"][key], crop_size)
+    return transforms_dict
+
+
+def extract_features(
+        config: DictConfig,
+        feature_extractor: FeatureExtractor,
+        transforms_dict: dict[str, Any],
+        crop_size: int,
+        train: bool,
+        device: torch.device,
+        batch_size: int,
+) -> tuple[dict[str, Tensor], np.ndarray, np.ndarray]:
+    """Backbone features of a split on the host, and the image labels and the masks of the test split.
+
+    The training split is extracted as the trainer fits it, the test split with the backbone in eval mode.
+    """
+    image_transforms, mask_transforms = create_image_and_mask_transforms(transforms_dict)
+    datasets = MVTecDataset(config.DATASETS.ROOT, config.DATASETS.CATEGORY, image_transforms, mask_transforms,
+                            (crop_size, crop_size), train, config.DATASETS.get("CACHE_DIR"),
+                            config.DATASETS.get("REDUCED_DECODE", False))
+    if train:
+        datasets, _ = Trainer.split_calibration_datasets(datasets, config)
+        batch_size = config.TRAIN.HYP.IMGS_PER_BATCH
+    feature_extractor.train(train)
+    dataloader = create_dataloader(datasets, batch_size, device, config.get("DATALOADER"))
+    normalize_mean, normalize_std = get_normalize_mean_and_std(transforms_dict)
+    input_mean = torch.tensor(normalize_mean, device=device).view(1, -1, 1, 1)
+    input_std = torch.tensor(normalize_std, device=device).view(1, -1, 1, 1)
+
+    features: dict[str, list[Tensor]] = {}
+    targets = []
+    masks = []
+    with torch.no_grad():
+        for batch_data in dataloader:
+            image = batch_data["image"].to(device, non_blocking=True)
+            if image.dtype == torch.uint8:
+                image = (image.float() / 255.0 - input_mean) / input_std
+            for name, feature in feature_extractor(image).items():
+                features.setdefault(name, []).append(feature.cpu())
+            targets.append(np.asarray(batch_data["target"].cpu()))
+            mask = batch_data["mask"].float()
+            masks.append((mask / 255.0 if batch_data["mask"].dtype == torch.uint8 else mask).cpu().numpy() > 0.5)
+    return {name: torch.cat(feature) for name, feature in features.items()}, np.concatenate(targets), np.concatenate(masks)
+
+
+def time_backbone(backbone: str, return_nodes: list[str], crop_size: int, device: torch.device, batch_size: int, repeats: int) -> float:
+    """Backbone milliseconds per image, the graph is cut after the last return node."""
+    feature_extractor = FeatureExtractor(backbone, return_nodes).to(device).eval()
+    images = torch.randn(batch_size, 3, crop_size, crop_size, device=device)
+    with torch.no_grad():
+        seconds = time_function(lambda: feature_extractor(images), device, repeats)
+    return seconds * 1000 / batch_size
+
+
+def evaluate(
+        candidate: dict[str, Any],
+        split_features: dict[int, tuple],
+        device: torch.device,
+        gate: ComputeGate,
+        seed: int,
+        batch_size: int,
+        repeats: int,
+) -> dict[str, Any]:
+    """Fit and score one configuration from the shared features."""
+    train_features, test_features, targets, masks = split_features[candidate["crop_size"]]
+    return_nodes = candidate["return_nodes"]
+    max_features = sum(train_features[name].shape[1] for name in return_nodes)
+    num_features = candidate["num_features"]
+    result = dict(candidate)
+    if num_features > max_features:
+        result["error"] = f"{num_features} features of {max_features} channels"
+        return result
+    index = torch.tensor(random.Random(seed).sample(range(max_features), num_features))
+    pool_stride = candidate["pool_stride"]
+
+    def embed(features: dict[str, Tensor], start: int, end: int) -> Tensor:
+        return PaDiM.assemble_embedding({name: features[name][start:end].to(device) for name in return_nodes},
+                                        return_nodes, index, pool_stride)
+
+    anomaly_map = AnomalyMap((candidate["crop_size"], candidate["crop_size"]))
+    with gate.compute(), torch.no_grad():
+        gaussian = MultiVariateGaussian(num_features, max_features, candidate["epsilon"]).to(device)
+        num_train = len(train_features[return_nodes[0]])
+        for start in range(0, num_train, batch_size):
+            gaussian.update(embed(train_features, start, start + batch_size))
+        mean, inv_covariance = gaussian.finalize()
+
+        num_test = len(targets)
+        anomaly_maps = torch.cat([anomaly_map(embed(test_features, start, start + batch_size), mean, inv_covariance).cpu()
+                                  for start in range(0, num_test, batch_size)]).numpy().reshape(num_test, -1)
+    result["image_roc_auc"] = float(roc_auc_score(targets, anomaly_maps.max(axis=1)))
+    result["pixel_roc_auc"] = float(roc_auc_score(masks.ravel(), anomaly_maps.ravel())) if masks.any() else float("nan")
+    result["size_mb"] = (mean.numel() + inv_covariance.numel()) * mean.element_size() / 2 ** 20 + index.numel() * 8 / 2 ** 20
+    result["positions"] = mean.shape[1]
+
+    latency_batch = min(batch_size, num_test)
+    with gate.exclusive(), torch.no_grad():
+        seconds = time_function(lambda: anomaly_map(embed(test_features, 0, latency_batch), mean, inv_covariance), device, repeats)
+    result["scoring_ms_per_image"] = seconds * 1000 / latency_batch
+    return result
+
+
+def get_pareto_front(results: list[dict[str, Any]], metric: str) -> set[int]:
+    """Indices of the results no other result beats in accuracy, latency and size at once."""
+    front = set()
+    for i, result in enumerate(results):
+        dominated = False
+        for other in results:
+            if other is result:
+                continue
+            no_worse = (other[metric] >= result[metric] and other["latency_ms_per_image"] <= result["latency_ms_per_image"]
+                        and other["size_mb"] <= result["size_mb"])
+            better = (other[metric] > result[metric] or other["latency_ms_per_image"] < result["latency_ms_per_image"]
+                      or other["size_mb"] < result["size_mb"])
+            if no_worse and better:
+                dominated = True
+                break
+        if not dominated:
+            front.add(i)
+    return front
+
+
+def print_table(results: list[dict[str, Any]], node_sets: list[list[str]], metric: str) -> None:
+    front = get_pareto_front(results, metric)
+    for i, return_nodes in enumerate(node_sets):
+        print(f"nodes #{i}: {', '.join(return_nodes)}")
+    print(f"{'crop':>6}{'nodes':>7}{'features':>10}{'epsilon':>9}{'stride':>8}{'positions':>11}{'image AUC':>11}{'pixel AUC':>11}"
+          f"{'latency ms':>12}{'size MB':>10}  pareto")
+    for i in sorted(range(len(results)), key=lambda i: -results[i][metric]):
+        result = results[i]
+        print(f"{result['crop_size']:>6}{'#' + str(node_sets.index(result['return_nodes'])):>7}{result['num_features']:>10}"
+              f"{result['epsilon']:>9g}{result['pool_stride']:>8}{result['positions']:>11}{result['image_roc_auc']:>11.3f}"
+              f"{result['pixel_roc_auc']:>11.3f}{result['latency_ms_per_image']:>12.2f}{result['size_mb']:>10.1f}"
+              f"  {'*' if i in front else ''}")
+
+
+def sweep(args: argparse.Namespace) -> int:
+    configure_logger(level=args.log_level)
+    config = OmegaConf.load(args.config)
+    if config.TASK != "segmentation":
+        logger.error("The sweep scores the labelled MVTec test split, set TASK: segmentation")
+        return 2
+    device = select_device(config["DEVICE"])
+    seed = config.get("SEED") or 0
+    model_dict = config.MODEL
+    crop_dict = config.DATASETS.TRANSFORMS.CENTER_CROP
+
+    node_sets = [name.split(",") for name in args.return_nodes] if args.return_nodes else [list(model_dict.RETURN_NODES)]
+    all_nodes = list(dict.fromkeys(itertools.chain.from_iterable(node_sets)))
+    default_num_features = model_dict.get("NUM_FEATURES") or PaDiM.num_features_dict[model_dict.BACKBONE]
+    grid = {
+        "crop_size": args.crop_sizes or [crop_dict.HEIGHT],
+        "return_nodes": node_sets,
+        "num_features": args.num_features or [default_num_features],
+        "epsilon": args.epsilons or [model_dict.get("COVARIANCE_EPSILON", 0.01)],
+        "pool_stride": args.pool_strides or [model_dict.get("POOL_STRIDE", 1)],
+    }
+    candidates = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    logger.info(f"Sweep {len(candidates)} configurations over {len(grid['crop_size'])} crop sizes.")
+
+    # one backbone pass over both splits per crop size, all return nodes at once
+    feature_extractor = FeatureExtractor(model_dict.BACKBONE, all_nodes).to(device)
+    initial_state = copy.deepcopy(feature_extractor.state_dict())
+    split_features = {}
+    for crop_size in grid["crop_size"]:
+        start_time = time.perf_counter()
+        # the training pass updates the BatchNorm running statistics the test pass uses, as in training
+        feature_extractor.load_state_dict(initial_state)
+        transforms_dict = get_transforms_dict(config, crop_size)
+        train_features, _, _ = extract_features(config, feature_extractor, transforms_dict, crop_size, True, device, args.batch_size)
+        test_features, targets, masks = extract_features(config, feature_extractor, transforms_dict, crop_size, False, device,
+                                                         args.batch_size)
+        split_features[crop_size] = (train_features, test_features, targets, masks)
+        logger.info(f"Extracted the features of {len(targets)} test and {len(train_features[all_nodes[0]])} training images "
+                    f"at {crop_size}x{crop_size} in {time.perf_counter() - start_time:.1f} s.")
+    del feature_extractor
+
+    backbone_ms = {(crop_size, tuple(return_nodes)): time_backbone(model_dict.BACKBONE, return_nodes, crop_size, device,
+                                                                   args.batch_size, args.repeats)
+                   for crop_size in grid["crop_size"] for return_nodes in node_sets}
+
+    gate = ComputeGate()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(lambda candidate: evaluate(candidate, split_features, device, gate, seed, args.batch_size,
+                                                               args.repeats), candidates))
+    for result in results:
+        if "error" in result:
+            logger.warning(f"Skip {result}")
+    results = [result for result in results if "error" not in result]
+    for result in results:
+        result["backbone_ms_per_image"] = backbone_ms[(result["crop_size"], tuple(result["return_nodes"]))]
+        result["latency_ms_per_image"] = result["backbone_ms_per_image"] + result["scoring_ms_per_image"]
+
+    print_table(results, node_sets, args.metric)
+    if args.output is not None:
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump({"config": args.config, "backbone": model_dict.BACKBONE, "results": results}, f, indent=2)
+        logger.info(f"Saved the sweep results to '{output_path}'")
+
+    if args.target is None:
+        return 0
+    reached = [result for result in results if result[args.metric] >= args.target]
+    if not reached:
+        print(f"No configuration reaches {args.metric} >= {args.target}")
+        return 1
+    best = min(reached, key=lambda result: (result["latency_ms_per_image"], result["size_mb"]))
+    print(f"\nCheapest configuration with {args.metric} >= {args.target}: {best[args.metric]:.3f} at "
+          f"{best['latency_ms_per_image']:.2f} ms per image and {best['size_mb']:.1f} MB")
+    print(OmegaConf.to_yaml({
+        "MODEL": {
+            "RETURN_NODES": best["return_nodes"],
+            "NUM_FEATURES": best["num_features"],
+            "COVARIANCE_EPSILON": best["epsilon"],
+            "POOL_STRIDE": best["pool_stride"],
+        },
+        "DATASETS": {"TRANSFORMS": {"CENTER_CROP": {"HEIGHT": best["crop_size"], "WIDTH": best["crop_size"]}}},
+    }))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(sweep(get_opts()))